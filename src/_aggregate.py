@@ -0,0 +1,126 @@
+'''
+Aggregate cube of the final data for dashboards (kilobytes instead of the full export).
+
+Dimensions: district, suburb, genus, age_group, location_type, found_in_dataset
+Measures (tree counts):
+- trees
+- removed: found in 2017, but not in 2020
+- added: found in 2020, but not in 2017
+- with_predictions: trees with by_radius_prediction
+- predicted_genus / predicted_age_group: missing value, prediction with probability >= _export.PREDICTION_CUTOFF (as in reduced export)
+
+The base cube (all dimensions) is built in one groupby over the data, the rollups (GROUPING_SETS) are summed up
+from it. Only the rollups are stored.
+Shares (i.e. removed trees per suburb) are measure / trees of the same row.
+
+Stored as compact JSON: dimension values are dictionary encoded, each rollup is a list of rows
+[dimension value index, ..., measure, ...].
+'''
+import json
+from typing import Any, Dict, List
+
+import pandas as pd
+
+from _export import DATA_PATH, PREDICTION_CUTOFF, get_unique_location_type
+
+
+DIMENSIONS = ["district_id", "suburb_id", "genus", "age_group", "location_type", "found_in_dataset"]
+MEASURES = ["trees", "removed", "added", "with_predictions", "predicted_genus", "predicted_age_group"]
+
+GROUPING_SETS: List[List[str]] = [
+    [],
+    ["district_id"],
+    ["suburb_id"],
+    ["genus"],
+    ["age_group"],
+    ["location_type"],
+    ["found_in_dataset"],
+    ["district_id", "genus"],
+    ["district_id", "age_group"],
+    ["district_id", "location_type"],
+    ["district_id", "found_in_dataset"],
+    ["suburb_id", "genus"],
+    ["suburb_id", "age_group"],
+    ["suburb_id", "location_type"],
+    ["suburb_id", "found_in_dataset"],
+    ["genus", "age_group"],
+    ["genus", "location_type"],
+    ["genus", "found_in_dataset"],
+    ["age_group", "location_type"],
+]
+
+UNKNOWN = "unknown"
+
+
+def _get_prediction_probability(tree_data: Dict[str, Any], key: str) -> float:
+    try:
+        return tree_data["predictions"]["by_radius_prediction"][key]["probability"]
+    except:
+        return 0.0
+
+
+def _get_aggregate_frame(final_data: List[Dict[str, Any]]) -> pd.DataFrame:
+    df = pd.DataFrame({
+        "district_id": [x["geo_info"]["district_id"] for x in final_data],
+        "suburb_id": [x["geo_info"]["suburb_id"] for x in final_data],
+        "genus": [x["tree_taxonomy"]["genus"] for x in final_data],
+        "age_group": [x["tree_age"]["age_group_2020"] for x in final_data],
+        "location_type": [get_unique_location_type(x.get("tree_location_type")) for x in final_data],
+        "found_2017": [x["found_in_dataset"]["2017"] for x in final_data],
+        "found_2020": [x["found_in_dataset"]["2020"] for x in final_data],
+        "with_predictions": [x.get("predictions") is not None for x in final_data],
+        "genus_probability": [_get_prediction_probability(x, "genus") for x in final_data],
+        "age_group_probability": [_get_prediction_probability(x, "age_group") for x in final_data],
+    })
+
+    df["found_in_dataset"] = (
+        df["found_2017"].map({True: "2017", False: ""}) + df["found_2020"].map({True: "2020", False: ""})
+    ).str.replace("20172020", "2017_2020")
+    df["trees"] = 1
+    df["removed"] = (df["found_2017"] & ~df["found_2020"]).astype(int)
+    df["added"] = (~df["found_2017"] & df["found_2020"]).astype(int)
+    df["with_predictions"] = df["with_predictions"].astype(int)
+    df["predicted_genus"] = (df["genus"].isna() & (df["genus_probability"] >= PREDICTION_CUTOFF)).astype(int)
+    df["predicted_age_group"] = (df["age_group"].isna() & (df["age_group_probability"] >= PREDICTION_CUTOFF)).astype(int)
+
+    df["age_group"] = df["age_group"].map(lambda x: str(int(x)) if pd.notna(x) else UNKNOWN)
+    for dimension in ["district_id", "suburb_id", "genus"]:
+        df[dimension] = df[dimension].fillna(UNKNOWN)
+
+    return df[DIMENSIONS + MEASURES]
+
+
+def create_aggregate_cube(final_data: List[Dict[str, Any]]) -> Dict[str, Any]:
+    df = _get_aggregate_frame(final_data)
+
+    dictionaries: Dict[str, List[str]] = {dimension: sorted(df[dimension].unique().tolist()) for dimension in DIMENSIONS}
+    for dimension in DIMENSIONS:
+        df[dimension] = df[dimension].map({value: i for i, value in enumerate(dictionaries[dimension])})
+
+    base_cube = df.groupby(DIMENSIONS, sort=True)[MEASURES].sum().reset_index()
+
+    rollups: Dict[str, List[List[int]]] = {}
+    for grouping_set in GROUPING_SETS:
+        if len(grouping_set) == 0:
+            rollup = base_cube[MEASURES].sum().to_frame().T
+        else:
+            rollup = base_cube.groupby(grouping_set, sort=True)[MEASURES].sum().reset_index()
+        rollups["|".join(grouping_set)] = rollup[grouping_set + MEASURES].astype(int).values.tolist()
+
+    names: Dict[str, Dict[str, str]] = {"district_id": {}, "suburb_id": {}}
+    for tree_data in final_data:
+        names["district_id"][tree_data["geo_info"]["district_id"] or UNKNOWN] = tree_data["geo_info"]["district"]
+        names["suburb_id"][tree_data["geo_info"]["suburb_id"] or UNKNOWN] = tree_data["geo_info"]["suburb"]
+
+    return {
+        "dimensions": DIMENSIONS,
+        "measures": MEASURES,
+        "dictionaries": dictionaries,
+        "names": names,
+        "rollups": rollups,  # "district_id|genus": [[district index, genus index, trees, removed, ...], ...]
+    }
+
+
+def save_aggregate_cube(out_file_name: str, aggregate_cube: Dict[str, Any]) -> None:
+    with open(f"{DATA_PATH}/{out_file_name}.json", "w") as f:
+        json.dump(aggregate_cube, f, ensure_ascii=False, separators=(",", ":"))
@@ -0,0 +1,476 @@
+'''
+Differential harness: run the reference implementation and an alternative (faster) implementation of a stage
+on the same input, then diff the results and report mismatches and speedup.
+
+The trees are matched by a canonical key (independent of the tree_id, which was a random uuid4 in earlier runs):
+(utm_x, utm_y, tree_nr, found_in_dataset 2017, found_in_dataset 2020, n-th occurrence in input order)
+
+Checks (run from /src, inputs are read from /data/tmp resp. the original csv data):
+- ingest: _process_dataset_2017/2020 vs. columnar ingest (records)
+- merge: in-memory merge vs. merge of the utm groups of the store (_tree_store.iter_utm_groups, records and order)
+- neighbours: process_tree_neighbours vs. neighbour graph (pair sets, skip set of the close pair cleanup)
+- predict: DBSCAN clusters vs. neighbour vote (predictions)
+- locate: location types tree by tree vs. partitioned by suburb (location types)
+- locate_raster: location types tree by tree vs. raster lookup with exact check near boundaries (_location_raster)
+- locate_simplified: location types with the OSM buffer layers vs. the dissolved / simplified layers
+  (differences expected for trees within the max. error of a boundary and osm_id of dissolved features)
+- store: data_final.jsonln of the stages in memory (_stages.py, --engine vote) vs. out-of-core (_store_stages.py),
+  records and order (reruns the whole process chain from the csv data, overwrites /data/tmp, no limit)
+
+Usage:
+$ python _differential.py neighbours --limit 20000  # only the first 20000 trees of the input
+'''
+import argparse
+import copy
+from datetime import datetime
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from _tmp_data import TMP_DATA_DIR, load_list_tmp_data
+
+
+DIFFERENTIAL_STORE_FILE = f"{TMP_DATA_DIR}/differential_store.sqlite"  # merge check (keeps tree_store.sqlite)
+FLOAT_TOLERANCE = 1e-9  # record values, i.e. lat/lng
+DISTANCE_TOLERANCE = 0.01  # in meter, pair distances (rounded to cm)
+PROBABILITY_TOLERANCE = 0.01
+MAX_EXAMPLES = 10  # mismatch examples per category in the report
+
+
+# *******
+# canonical keys
+# *******
+def get_canonical_key(tree_data: Dict[str, Any]) -> Tuple[Any, ...]:
+    found_in_dataset = tree_data.get("found_in_dataset") or {}
+    return (
+        tree_data["geo_info"]["utm_x"],
+        tree_data["geo_info"]["utm_y"],
+        tree_data["base_info"]["tree_nr"],
+        found_in_dataset.get("2017"),
+        found_in_dataset.get("2020"),
+    )
+
+
+def get_canonical_keys(tree_data_list: List[Dict[str, Any]]) -> Dict[str, Tuple[Any, ...]]:
+    '''
+    tree_id: canonical key (with the n-th occurrence of equal keys, i.e. equal source rows)
+    '''
+    occurrences: Dict[Tuple[Any, ...], int] = {}
+    canonical_keys: Dict[str, Tuple[Any, ...]] = {}
+    for tree_data in tree_data_list:
+        key = get_canonical_key(tree_data)
+        occurrences[key] = occurrences.get(key, -1) + 1
+        canonical_keys[tree_data["tree_id"]] = key + (occurrences[key],)
+
+    return canonical_keys
+
+
+def _by_canonical_key(tree_data_list: List[Dict[str, Any]]) -> Dict[Tuple[Any, ...], Dict[str, Any]]:
+    canonical_keys = get_canonical_keys(tree_data_list)
+    return {canonical_keys[tree_data["tree_id"]]: tree_data for tree_data in tree_data_list}
+
+
+# *******
+# diffs
+# *******
+def _diff_values(reference: Any, alternative: Any, tolerance: float, path: str = "") -> List[str]:
+    ''' paths of differing values (numbers are equal within tolerance) '''
+    if isinstance(reference, dict) and isinstance(alternative, dict):
+        differences: List[str] = []
+        for key in list(reference.keys()) + [x for x in alternative.keys() if x not in reference]:
+            if key not in reference or key not in alternative:
+                differences.append(f"{path}.{key}")
+                continue
+            differences += _diff_values(reference[key], alternative[key], tolerance, f"{path}.{key}")
+        return differences
+
+    if isinstance(reference, list) and isinstance(alternative, list) and len(reference) == len(alternative):
+        differences = []
+        for i, (x, y) in enumerate(zip(reference, alternative)):
+            differences += _diff_values(x, y, tolerance, f"{path}[{i}]")
+        return differences
+
+    numbers = (int, float)
+    if isinstance(reference, numbers) and isinstance(alternative, numbers) and not isinstance(reference, bool) and not isinstance(alternative, bool):
+        return [] if abs(reference - alternative) <= tolerance else [path]
+
+    return [] if reference == alternative else [path]
+
+
+def _add_example(report: Dict[str, Any], category: str, example: Any) -> None:
+    report["mismatches"][category] = report["mismatches"].get(category, 0) + 1
+    if len(report["examples"].get(category, [])) < MAX_EXAMPLES:
+        report["examples"].setdefault(category, []).append(example)
+
+
+def _new_report() -> Dict[str, Any]:
+    return {"mismatches": {}, "examples": {}}
+
+
+def diff_records(
+    reference: List[Dict[str, Any]],
+    alternative: List[Dict[str, Any]],
+    tolerance: float = FLOAT_TOLERANCE,
+    attributes: Optional[List[str]] = None,
+    report: Optional[Dict[str, Any]] = None
+) -> Dict[str, Any]:
+    '''
+    Trees only in one of both results and differing values (all attributes except tree_id or only the given ones)
+    '''
+    if report is None:
+        report = _new_report()
+
+    reference_by_key = _by_canonical_key(reference)
+    alternative_by_key = _by_canonical_key(alternative)
+
+    for key in reference_by_key.keys() - alternative_by_key.keys():
+        _add_example(report, "only_in_reference", key)
+    for key in alternative_by_key.keys() - reference_by_key.keys():
+        _add_example(report, "only_in_alternative", key)
+
+    for key in reference_by_key.keys() & alternative_by_key.keys():
+        reference_tree, alternative_tree = reference_by_key[key], alternative_by_key[key]
+        for attribute in (attributes if attributes is not None else reference_tree.keys() | alternative_tree.keys()):
+            if attribute == "tree_id":
+                continue
+            for path in _diff_values(reference_tree.get(attribute), alternative_tree.get(attribute), tolerance, attribute):
+                _add_example(report, path.split("[")[0], {"key": key, "reference": reference_tree.get(attribute), "alternative": alternative_tree.get(attribute)})
+
+    return report
+
+
+def diff_order(reference: List[Dict[str, Any]], alternative: List[Dict[str, Any]], report: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    ''' first position where the trees (canonical keys) of both results differ '''
+    if report is None:
+        report = _new_report()
+
+    reference_keys = get_canonical_keys(reference)
+    alternative_keys = get_canonical_keys(alternative)
+    for i, (reference_tree, alternative_tree) in enumerate(zip(reference, alternative)):
+        if reference_keys[reference_tree["tree_id"]] != alternative_keys[alternative_tree["tree_id"]]:
+            _add_example(report, "order", {"position": i, "reference": reference_keys[reference_tree["tree_id"]], "alternative": alternative_keys[alternative_tree["tree_id"]]})
+            break
+
+    return report
+
+
+def diff_pairs(
+    category: str,
+    reference_pairs: List[List[Any]],
+    reference_keys: Dict[str, Tuple[Any, ...]],
+    alternative_pairs: List[List[Any]],
+    alternative_keys: Dict[str, Tuple[Any, ...]],
+    tolerance: float = DISTANCE_TOLERANCE,
+    report: Optional[Dict[str, Any]] = None
+) -> Dict[str, Any]:
+    ''' pairs [tree_id_1, tree_id_2, distance] as unordered pairs of canonical keys '''
+    if report is None:
+        report = _new_report()
+
+    def _get_pair_set(pairs: List[List[Any]], canonical_keys: Dict[str, Tuple[Any, ...]]) -> Dict[frozenset, float]:
+        return {frozenset([canonical_keys[pair[0]], canonical_keys[pair[1]]]): pair[2] for pair in pairs}
+
+    reference_set = _get_pair_set(reference_pairs, reference_keys)
+    alternative_set = _get_pair_set(alternative_pairs, alternative_keys)
+
+    for pair in reference_set.keys() - alternative_set.keys():
+        _add_example(report, f"{category}_only_in_reference", [tuple(pair), reference_set[pair]])
+    for pair in alternative_set.keys() - reference_set.keys():
+        _add_example(report, f"{category}_only_in_alternative", [tuple(pair), alternative_set[pair]])
+    for pair in reference_set.keys() & alternative_set.keys():
+        if abs(reference_set[pair] - alternative_set[pair]) > tolerance:
+            _add_example(report, f"{category}_distance", [tuple(pair), reference_set[pair], alternative_set[pair]])
+
+    return report
+
+
+def diff_skip_sets(
+    input_data: List[Dict[str, Any]],
+    reference_output: List[Dict[str, Any]],
+    alternative_output: List[Dict[str, Any]],
+    report: Optional[Dict[str, Any]] = None
+) -> Dict[str, Any]:
+    ''' trees of the input dropped by only one of both implementations '''
+    if report is None:
+        report = _new_report()
+
+    input_keys = get_canonical_keys(input_data)
+    reference_kept = {input_keys[x["tree_id"]] for x in reference_output if x["tree_id"] in input_keys}
+    alternative_kept = {input_keys[x["tree_id"]] for x in alternative_output if x["tree_id"] in input_keys}
+
+    for key in alternative_kept - reference_kept:
+        _add_example(report, "skipped_only_by_reference", key)
+    for key in reference_kept - alternative_kept:
+        _add_example(report, "skipped_only_by_alternative", key)
+
+    return report
+
+
+def diff_predictions(
+    reference: Dict[str, Optional[Dict[str, Any]]],
+    alternative: Dict[str, Optional[Dict[str, Any]]],
+    canonical_keys: Dict[str, Tuple[Any, ...]],
+    tolerance: float = PROBABILITY_TOLERANCE,
+    report: Optional[Dict[str, Any]] = None
+) -> Dict[str, Any]:
+    ''' predictions by tree_id (same input trees, hence same ids) '''
+    if report is None:
+        report = _new_report()
+
+    for tree_id in reference.keys() | alternative.keys():
+        reference_prediction, alternative_prediction = reference.get(tree_id), alternative.get(tree_id)
+        for path in _diff_values(reference_prediction, alternative_prediction, tolerance, "predictions"):
+            _add_example(report, path, {"key": canonical_keys.get(tree_id), "reference": reference_prediction, "alternative": alternative_prediction})
+
+    return report
+
+
+def diff_location_types(reference: List[Dict[str, Any]], alternative: List[Dict[str, Any]], report: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    return diff_records(reference, alternative, DISTANCE_TOLERANCE, ["tree_location_type", "nearest_road"], report)
+
+
+# *******
+# checks
+# *******
+def _run_timed(function: Callable[..., Any], *args: Any) -> Tuple[Any, float]:
+    start = datetime.now()
+    result = function(*args)
+    return result, (datetime.now() - start).total_seconds()
+
+
+def _check_ingest(limit: Optional[int]) -> Dict[str, Any]:
+    from _geo import create_suburb_polygons
+    from _ingest_columnar import process_dataset
+    from _process_dataset_2017 import process_dataset_2017
+    from _process_dataset_2020 import process_dataset_2020
+
+    create_suburb_polygons()
+
+    report = _new_report()
+    report["reference_seconds"], report["alternative_seconds"] = 0.0, 0.0
+    for year, reference_function in [("2017", process_dataset_2017), ("2020", process_dataset_2020)]:
+        reference, reference_seconds = _run_timed(reference_function)
+        alternative, alternative_seconds = _run_timed(process_dataset, year)
+        report["reference_seconds"] += reference_seconds
+        report["alternative_seconds"] += alternative_seconds
+        diff_records(reference[:limit], alternative[:limit], report=report)
+
+    return report
+
+
+def _check_merge(limit: Optional[int]) -> Dict[str, Any]:
+    from _merge_datasets import merge_datasets, merge_trees
+    from _tree_store import close_store, get_store, iter_utm_groups, remove_store, write_records
+
+    datasets = {year: load_list_tmp_data(f"data_{year}.jsonln")[:limit] for year in ["2017", "2020"]}
+
+    def _alternative(datasets: Dict[str, List[Dict[str, Any]]]) -> List[Dict[str, Any]]:
+        close_store()
+        get_store(DIFFERENTIAL_STORE_FILE)
+        for year, tree_data_list in datasets.items():
+            write_records(f"data_{year}", [tree_data_list])
+
+        merged_data: List[Dict[str, Any]] = []
+        for trees_2017, trees_2020 in iter_utm_groups():
+            merged_tree = merge_trees(trees_2017, trees_2020)
+            if merged_tree is not None:
+                merged_data.append(merged_tree)
+        return merged_data
+
+    reference, reference_seconds = _run_timed(merge_datasets, copy.deepcopy(datasets))  # the merge changes the records
+    try:
+        alternative, alternative_seconds = _run_timed(_alternative, datasets)
+    finally:
+        remove_store(DIFFERENTIAL_STORE_FILE)
+
+    report = _new_report()
+    report["reference_seconds"], report["alternative_seconds"] = reference_seconds, alternative_seconds
+    diff_records(reference, alternative, report=report)
+    return diff_order(reference, alternative, report=report)
+
+
+def _check_neighbours(limit: Optional[int]) -> Dict[str, Any]:
+    from _geo import create_suburb_polygons, find_neighbouring_suburbs
+    from _neighbour_graph import build_neighbour_graph, get_close_pairs, get_neighbour_pairs
+    from _tree_neighbours import RADIUS, cleanup_close_pairs, process_tree_neighbours
+
+    create_suburb_polygons()
+    find_neighbouring_suburbs()
+    merged_data = load_list_tmp_data("data_merged.jsonln")[:limit]
+    canonical_keys = get_canonical_keys(merged_data)
+
+    def _alternative(merged_data: List[Dict[str, Any]]) -> Tuple[List[Any], List[Any]]:
+        graph = build_neighbour_graph(merged_data)
+        return get_close_pairs(graph), get_neighbour_pairs(graph, radius=RADIUS)
+
+    (reference_close, reference_all), reference_seconds = _run_timed(process_tree_neighbours, merged_data)
+    (alternative_close, alternative_all), alternative_seconds = _run_timed(_alternative, merged_data)
+
+    report = _new_report()
+    report["reference_seconds"], report["alternative_seconds"] = reference_seconds, alternative_seconds
+    diff_pairs("close_pairs", reference_close, canonical_keys, alternative_close, canonical_keys, report=report)
+    diff_pairs("all_pairs", reference_all, canonical_keys, alternative_all, canonical_keys, report=report)
+    diff_skip_sets(
+        merged_data,
+        cleanup_close_pairs(merged_data, reference_close),
+        cleanup_close_pairs(merged_data, alternative_close),
+        report=report
+    )
+
+    return report
+
+
+def _check_predict(limit: Optional[int]) -> Dict[str, Any]:
+    from _predict_genus_age import _get_reduced_data, _load_neighbour_pairs
+    from predictions._clustered_neighbour_trees import train_neighbouring_tree_cluster
+    from predictions._neighbour_vote import predict_by_neighbour_vote
+
+    merged_data = load_list_tmp_data("data_merged_cleanup.jsonln")[:limit]
+    tree_ids = {x["tree_id"] for x in merged_data}
+    neighbours_pairs = [x for x in load_list_tmp_data("neighbours_all_pairs.jsonln") if x[0] in tree_ids and x[1] in tree_ids]
+    df = _get_reduced_data(merged_data)
+
+    reference, reference_seconds = _run_timed(train_neighbouring_tree_cluster, df.copy(), _load_neighbour_pairs(neighbours_pairs))
+    alternative, alternative_seconds = _run_timed(predict_by_neighbour_vote, df, neighbours_pairs)
+
+    report = _new_report()
+    report["reference_seconds"], report["alternative_seconds"] = reference_seconds, alternative_seconds
+    diff_predictions(reference, alternative, get_canonical_keys(merged_data), report=report)
+
+    # ***
+    # edge case: no tree has all features (each tree predicted as None)
+    df_unlabelled = df.assign(year_sprout=None)
+    diff_predictions(
+        train_neighbouring_tree_cluster(df_unlabelled.copy(), _load_neighbour_pairs(neighbours_pairs)),
+        predict_by_neighbour_vote(df_unlabelled, neighbours_pairs),
+        get_canonical_keys(merged_data),
+        report=report
+    )
+    return report
+
+
+def _check_locate(limit: Optional[int]) -> Dict[str, Any]:
+    from _osm_type import get_array_location_types, get_suburb_data, get_tree_location_types, run_location_types
+
+    merged_data = load_list_tmp_data("data_merged_cleanup.jsonln")[:limit]
+    get_suburb_data()
+
+    reference, reference_seconds = _run_timed(get_tree_location_types, copy.deepcopy(merged_data))
+    alternative, alternative_seconds = _run_timed(
+        lambda x: run_location_types(x, get_array_location_types, get_suburb_data), copy.deepcopy(merged_data)
+    )
+
+    report = _new_report()
+    report["reference_seconds"], report["alternative_seconds"] = reference_seconds, alternative_seconds
+    diff_skip_sets(merged_data, reference, alternative, report=report)
+    return diff_location_types(reference, alternative, report=report)
+
+
+def _check_locate_raster(limit: Optional[int]) -> Dict[str, Any]:
+    from _location_raster import get_array_raster_location_types, load_location_rasters
+    from _osm_type import get_tree_location_types, run_location_types
+
+    merged_data = load_list_tmp_data("data_merged_cleanup.jsonln")[:limit]
+    load_location_rasters()
+
+    reference, reference_seconds = _run_timed(get_tree_location_types, copy.deepcopy(merged_data))
+    alternative, alternative_seconds = _run_timed(
+        lambda x: run_location_types(x, get_array_raster_location_types, load_location_rasters), copy.deepcopy(merged_data)
+    )
+
+    report = _new_report()
+    report["reference_seconds"], report["alternative_seconds"] = reference_seconds, alternative_seconds
+    diff_skip_sets(merged_data, reference, alternative, report=report)
+    return diff_location_types(reference, alternative, report=report)
+
+
+def _check_locate_simplified(limit: Optional[int]) -> Dict[str, Any]:
+    from _osm_type import OSM_SIMPLIFIED_DATA_DIR, get_suburb_data, get_tree_location_types
+
+    merged_data = load_list_tmp_data("data_merged_cleanup.jsonln")[:limit]
+
+    get_suburb_data()
+    reference, reference_seconds = _run_timed(get_tree_location_types, copy.deepcopy(merged_data))
+    get_suburb_data(OSM_SIMPLIFIED_DATA_DIR)
+    alternative, alternative_seconds = _run_timed(get_tree_location_types, copy.deepcopy(merged_data))
+
+    report = _new_report()
+    report["reference_seconds"], report["alternative_seconds"] = reference_seconds, alternative_seconds
+    diff_skip_sets(merged_data, reference, alternative, report=report)
+    return diff_location_types(reference, alternative, report=report)
+
+
+def _check_store(limit: Optional[int]) -> Dict[str, Any]:
+    import _stages
+    import _store_stages
+    from _tmp_data import flush_tmp_data
+    from _tree_store import remove_store
+
+    def _reference() -> List[Dict[str, Any]]:
+        for run_stage in [
+            _stages.ingest_2017, _stages.ingest_2020, _stages.merge, _stages.neighbours,
+            lambda: _stages.predict(engine="vote"), _stages.locate, _stages.combine
+        ]:
+            run_stage()
+        flush_tmp_data()
+        return load_list_tmp_data("data_final.jsonln")
+
+    def _alternative() -> List[Dict[str, Any]]:
+        remove_store()
+        for run_stage in [
+            _store_stages.ingest, _store_stages.merge, _store_stages.neighbours,
+            lambda: _store_stages.predict(engine="vote"), _store_stages.locate, _store_stages.combine
+        ]:
+            run_stage()
+        return load_list_tmp_data("data_final.jsonln")
+
+    reference, reference_seconds = _run_timed(_reference)
+    alternative, alternative_seconds = _run_timed(_alternative)
+
+    report = _new_report()
+    report["reference_seconds"], report["alternative_seconds"] = reference_seconds, alternative_seconds
+    diff_records(reference, alternative, report=report)
+    return diff_order(reference, alternative, report=report)
+
+
+CHECKS: Dict[str, Callable[[Optional[int]], Dict[str, Any]]] = {
+    "ingest": _check_ingest,
+    "merge": _check_merge,
+    "neighbours": _check_neighbours,
+    "predict": _check_predict,
+    "locate": _check_locate,
+    "locate_raster": _check_locate_raster,
+    "locate_simplified": _check_locate_simplified,
+    "store": _check_store,
+}
+
+
+def print_report(check_name: str, report: Dict[str, Any]) -> None:
+    speedup = report["reference_seconds"] / report["alternative_seconds"] if report["alternative_seconds"] > 0 else float("inf")
+
+    print(f"----- {check_name} -----")
+    print(f"  reference    {report['reference_seconds']:>9.1f} s")
+    print(f"  alternative  {report['alternative_seconds']:>9.1f} s")
+    print(f"  speedup      {speedup:>9.1f} x")
+
+    if len(report["mismatches"]) == 0:
+        print("  no mismatches")
+        return
+
+    for category, count in sorted(report["mismatches"].items()):
+        print(f"  {category}: {count} mismatches, i.e.")
+        for example in report["examples"][category][:3]:
+            print(f"    {example}")
+
+
+def run_check(check_name: str, limit: Optional[int] = None) -> Dict[str, Any]:
+    report = CHECKS[check_name](limit)
+    print_report(check_name, report)
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare reference and alternative implementation of a stage.")
+    parser.add_argument("check", choices=list(CHECKS.keys()))
+    parser.add_argument("--limit", type=int, default=None, help="only the first <limit> trees of the input")
+    args = parser.parse_args()
+
+    run_check(args.check, args.limit)
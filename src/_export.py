@@ -1,13 +1,139 @@
-import json
-import tarfile
-from typing import Any, Dict, List, Optional
 import os
+import shutil
+import sqlite3
+import tarfile
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+from _json_codec import loads
 
 
 DATA_PATH = "../data/exports"
 
+# ***
+# typed columns of the FlatGeobuf and Parquet exports (nested objects flattened with "_", lists joined with ", ")
+FLAT_FULL_PROPERTIES: Dict[str, str] = {
+    "tree_id": "str",
+    "dataset_completeness": "float",
+    "base_info_completeness": "float",
+    "tree_taxonomy_completeness": "float",
+    "tree_measures_completeness": "float",
+    "tree_age_completeness": "float",
+    "base_info_object_type": "str",
+    "base_info_tree_nr": "str",
+    "base_info_year_planting": "int",
+    "geo_info_utm_x": "int",
+    "geo_info_utm_y": "int",
+    "geo_info_lat": "float",
+    "geo_info_lng": "float",
+    "geo_info_suburb": "str",
+    "geo_info_suburb_id": "str",
+    "geo_info_district": "str",
+    "geo_info_district_id": "str",
+    "tree_taxonomy_genus": "str",
+    "tree_taxonomy_genus_name_german": "str",
+    "tree_taxonomy_species": "str",
+    "tree_taxonomy_type": "str",
+    "tree_taxonomy_name_german": "str",
+    "tree_measures_height": "int",
+    "tree_measures_treetop_radius": "int",
+    "tree_measures_bole_radius": "int",
+    "tree_age_year_sprout": "int",
+    "tree_age_age_in_2020": "int",
+    "tree_age_age_group_2020": "int",
+    "found_in_dataset_2017": "bool",
+    "found_in_dataset_2020": "bool",
+    "predictions_by_radius_prediction_genus_prediction": "str",
+    "predictions_by_radius_prediction_genus_probability": "float",
+    "predictions_by_radius_prediction_age_group_prediction": "int",
+    "predictions_by_radius_prediction_age_group_probability": "float",
+    "predictions_by_radius_prediction_year_sprout_prediction": "int",
+    "predictions_by_radius_prediction_year_sprout_probability": "float",
+    **{
+        f"tree_location_type_{category}_{attribute}": attribute_type
+        for category in ["highway", "green_spaces_leisure", "green_spaces_agriculture"]
+        for attribute, attribute_type in [("type", "str"), ("name", "str"), ("osm_id", "int64"), ("wikidata_id", "str")]
+    },
+    "nearest_road_distance": "float",
+    "nearest_road_osm_id": "int64",
+    "nearest_road_type": "str",
+    "nearest_road_name": "str",
+}
+
+PARQUET_ROW_GROUP_SIZE = 5000  # rows: small enough for useful min/max statistics (i.e. utm / lat / lng of a compact area)
+PARQUET_DICTIONARY_COLUMNS = ["tree_taxonomy_genus", "geo_info_suburb"]
+PREDICTION_CUTOFF = 0.5  # min. probability of a predicted genus / age group in the reduced export (see _parameter_sweep.py)
+HILBERT_ORDER = 16  # 2^16 cells per axis: < 1 meter in Cologne
+
+# ***
+# SQLite export: normalized tables (one row per tree resp. per tree and prediction / location category)
+SQLITE_SCHEMA: List[str] = [
+    """CREATE TABLE suburbs (
+        suburb_id TEXT PRIMARY KEY, suburb TEXT, district_id TEXT, district TEXT
+    )""",
+    """CREATE TABLE trees (
+        id INTEGER PRIMARY KEY, tree_id TEXT NOT NULL UNIQUE,
+        dataset_completeness REAL, base_info_completeness REAL, tree_taxonomy_completeness REAL,
+        tree_measures_completeness REAL, tree_age_completeness REAL,
+        object_type TEXT, tree_nr TEXT, year_planting INTEGER,
+        utm_x INTEGER, utm_y INTEGER, lat REAL, lng REAL, suburb_id TEXT REFERENCES suburbs (suburb_id),
+        found_in_2017 INTEGER, found_in_2020 INTEGER
+    )""",
+    """CREATE TABLE taxonomy (
+        tree INTEGER PRIMARY KEY REFERENCES trees (id),
+        genus TEXT, genus_name_german TEXT, species TEXT, type TEXT, name_german TEXT
+    )""",
+    """CREATE TABLE measures (
+        tree INTEGER PRIMARY KEY REFERENCES trees (id), height INTEGER, treetop_radius INTEGER, bole_radius INTEGER
+    )""",
+    """CREATE TABLE ages (
+        tree INTEGER PRIMARY KEY REFERENCES trees (id), year_sprout INTEGER, age_in_2020 INTEGER, age_group_2020 INTEGER
+    )""",
+    """CREATE TABLE predictions (
+        tree INTEGER REFERENCES trees (id), attribute TEXT, prediction, probability REAL,
+        PRIMARY KEY (tree, attribute)
+    ) WITHOUT ROWID""",
+    """CREATE TABLE location_types (
+        tree INTEGER REFERENCES trees (id), category TEXT, type TEXT, name TEXT, osm_id INTEGER, wikidata_id TEXT,
+        PRIMARY KEY (tree, category)
+    ) WITHOUT ROWID""",
+    """CREATE TABLE nearest_roads (
+        tree INTEGER PRIMARY KEY REFERENCES trees (id), distance REAL, osm_id INTEGER, type TEXT, name TEXT
+    )""",
+    "CREATE VIRTUAL TABLE trees_rtree USING rtree (id, min_lng, max_lng, min_lat, max_lat)",
+]
+SQLITE_INDEXES: List[str] = [  # created after the bulk insert
+    "CREATE INDEX taxonomy_genus ON taxonomy (genus)",
+    "CREATE INDEX trees_suburb_id ON trees (suburb_id)",
+    "CREATE INDEX ages_age_group_2020 ON ages (age_group_2020)",
+]
+SQLITE_INSERTS: Dict[str, str] = {  # table: insert statement
+    "suburbs": "INSERT OR IGNORE INTO suburbs VALUES (?, ?, ?, ?)",
+    "trees": f"INSERT INTO trees VALUES ({', '.join(['?'] * 17)})",
+    "taxonomy": "INSERT INTO taxonomy VALUES (?, ?, ?, ?, ?, ?)",
+    "measures": "INSERT INTO measures VALUES (?, ?, ?, ?)",
+    "ages": "INSERT INTO ages VALUES (?, ?, ?, ?)",
+    "predictions": "INSERT INTO predictions VALUES (?, ?, ?, ?)",
+    "location_types": "INSERT INTO location_types VALUES (?, ?, ?, ?, ?, ?)",
+    "nearest_roads": "INSERT INTO nearest_roads VALUES (?, ?, ?, ?, ?)",
+    "trees_rtree": "INSERT INTO trees_rtree VALUES (?, ?, ?, ?, ?)",
+}
+SQLITE_INSERT_CHUNK_SIZE = 10000  # trees per executemany
+
+FLAT_REDUCED_PROPERTIES: Dict[str, str] = {
+    "tree_id": "str",
+    "district_number": "str",
+    "lat": "float",
+    "lng": "float",
+    "in_dataset_2020": "bool",
+    "genus": "str",
+    "age_group": "int",
+    "location_type": "str",
+}
+
 
-def _get_unique_location_type(location_type_data: Dict[str, Any]) -> str:
+def get_unique_location_type(location_type_data: Dict[str, Any]) -> str:
     if location_type_data is None:
         return "unknown"
 
@@ -69,14 +195,14 @@ def create_reduced_data(tree_data_list: List[Dict[str, Any]]) -> List[Dict[str,
             "in_dataset_2020": tree_data["found_in_dataset"]["2020"],
             "genus": None,
             "age_group": None,
-            "location_type": _get_unique_location_type(tree_data["tree_location_type"])
+            "location_type": get_unique_location_type(tree_data["tree_location_type"])
         }
 
         if tree_data["tree_age"]["age_group_2020"] is not None:
             new_tree_data["age_group"] = tree_data["tree_age"]["age_group_2020"]
         else:
             try: 
-                if tree_data["predictions"]["by_radius_prediction"]["age_group"]["probability"] >= 0.5:
+                if tree_data["predictions"]["by_radius_prediction"]["age_group"]["probability"] >= PREDICTION_CUTOFF:
                     new_tree_data["age_group"] = tree_data["predictions"]["by_radius_prediction"]["age_group"]["prediction"]
             except:
                 pass
@@ -85,7 +211,7 @@ def create_reduced_data(tree_data_list: List[Dict[str, Any]]) -> List[Dict[str,
             new_tree_data["genus"] = tree_data["tree_taxonomy"]["genus"]
         else:
             try: 
-                if tree_data["predictions"]["by_radius_prediction"]["genus"]["probability"] >= 0.5:
+                if tree_data["predictions"]["by_radius_prediction"]["genus"]["probability"] >= PREDICTION_CUTOFF:
                     new_tree_data["genus"] = tree_data["predictions"]["by_radius_prediction"]["genus"]["prediction"]
             except:
                 pass
@@ -98,3 +224,273 @@ def create_reduced_data(tree_data_list: List[Dict[str, Any]]) -> List[Dict[str,
 def save_compressed_data(out_file_name: str, in_file_path: str) -> None:
     with tarfile.open(f"{DATA_PATH}/{out_file_name}.tar.gz", "w:gz") as tar:
         tar.add(in_file_path, arcname=os.path.basename(in_file_path))
+
+
+def load_compressed_data(file_name: str) -> List[Dict[str, Any]]:
+    '''
+    Records of a compressed export (empty if there is none yet)
+    '''
+    file_path = f"{DATA_PATH}/{file_name}.tar.gz"
+    if not os.path.exists(file_path):
+        return []
+
+    tree_data_list: List[Dict[str, Any]] = []
+    with tarfile.open(file_path, "r:gz") as tar:
+        for member in tar.getmembers():
+            if member.isfile() is False:
+                continue
+            for line in tar.extractfile(member):
+                try:
+                    tree_data_list.append(loads(line))
+                except:
+                    continue
+
+    return tree_data_list
+
+
+def create_delta(previous_data: List[Dict[str, Any]], current_data: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    '''
+    Changes from the previous to the current export (by tree_id):
+    {"change": "added", "tree": {...}}, {"change": "changed", "tree": {...}}, {"change": "removed", "tree_id": "..."}
+    '''
+    previous_by_id: Dict[str, Dict[str, Any]] = {x["tree_id"]: x for x in previous_data}
+    current_ids = set()
+
+    delta: List[Dict[str, Any]] = []
+    for tree_data in current_data:
+        current_ids.add(tree_data["tree_id"])
+        previous_tree_data = previous_by_id.get(tree_data["tree_id"])
+        if previous_tree_data is None:
+            delta.append({"change": "added", "tree": tree_data})
+        elif previous_tree_data != tree_data:
+            delta.append({"change": "changed", "tree": tree_data})
+
+    for tree_id in previous_by_id.keys():
+        if tree_id not in current_ids:
+            delta.append({"change": "removed", "tree_id": tree_id})
+
+    return delta
+
+
+# ***
+# FlatGeobuf (with packed Hilbert R-tree index: clients can read only the features in a bounding box)
+def flatten_tree_data(tree_data: Dict[str, Any], prefix: str = "") -> Dict[str, Any]:
+    '''
+    {"geo_info": {"lat": 50.9}, "tree_taxonomy": {"name_german": ["a", "b"]}}
+    -> {"geo_info_lat": 50.9, "tree_taxonomy_name_german": "a, b"}
+    '''
+    flat_data: Dict[str, Any] = {}
+    for key, value in tree_data.items():
+        if isinstance(value, dict):
+            flat_data.update(flatten_tree_data(value, f"{prefix}{key}_"))
+        elif isinstance(value, list):
+            flat_data[f"{prefix}{key}"] = ", ".join(str(x) for x in value)
+        else:
+            flat_data[f"{prefix}{key}"] = value
+    return flat_data
+
+
+def _get_flatgeobuf_features(tree_data_list: List[Dict[str, Any]], properties: Dict[str, str]) -> Iterator[Dict[str, Any]]:
+    for tree_data in tree_data_list:
+        flat_data = flatten_tree_data(tree_data)
+        lat = flat_data.get("geo_info_lat", flat_data.get("lat"))  # full resp. reduced data
+        lng = flat_data.get("geo_info_lng", flat_data.get("lng"))
+        if lat is None or lng is None:
+            continue
+
+        yield {
+            "geometry": {"type": "Point", "coordinates": (lng, lat)},
+            "properties": {column: flat_data.get(column) for column in properties.keys()}
+        }
+
+
+def save_flatgeobuf_data(out_file_name: str, tree_data_list: List[Dict[str, Any]], properties: Dict[str, str]) -> None:
+    '''
+    Point features (lng, lat) with the given typed columns, trees without coordinates are skipped.
+    '''
+    import fiona
+
+    schema = {"geometry": "Point", "properties": properties}
+
+    with fiona.open(
+        f"{DATA_PATH}/{out_file_name}.fgb", "w", driver="FlatGeobuf", schema=schema, crs="EPSG:4326", SPATIAL_INDEX="YES"
+    ) as f:
+        f.writerecords(_get_flatgeobuf_features(tree_data_list, properties))
+
+
+# ***
+# Parquet (partitioned by district, Hilbert sorted row groups: predicate and bounding box pushdown)
+def get_hilbert_keys(x: np.ndarray, y: np.ndarray, order: int = HILBERT_ORDER) -> np.ndarray:
+    '''
+    Position on the Hilbert curve of each point (coordinates scaled to the bounding box of all points)
+    '''
+    n = 1 << order
+
+    def _scale(values: np.ndarray) -> np.ndarray:
+        value_range = max(values.max() - values.min(), 1e-9)
+        return np.minimum(((values - values.min()) / value_range * n).astype(np.int64), n - 1)
+
+    x, y = _scale(np.asarray(x, dtype=float)), _scale(np.asarray(y, dtype=float))
+    keys = np.zeros(len(x), dtype=np.int64)
+
+    s = n >> 1
+    while s > 0:
+        rx = (x & s) > 0
+        ry = (y & s) > 0
+        keys += s * s * ((3 * rx.astype(np.int64)) ^ ry.astype(np.int64))
+
+        # ***
+        # rotate quadrant
+        is_flipped = ~ry & rx
+        x = np.where(is_flipped, n - 1 - x, x)
+        y = np.where(is_flipped, n - 1 - y, y)
+        x, y = np.where(~ry, y, x), np.where(~ry, x, y)
+
+        s >>= 1
+
+    return keys
+
+
+def save_parquet_data(out_dir_name: str, tree_data_list: List[Dict[str, Any]], properties: Dict[str, str] = FLAT_FULL_PROPERTIES) -> None:
+    '''
+    One file per district (hive style: <out_dir_name>.parquet/district_id=<id>/part-0.parquet),
+    rows sorted by Hilbert key of utm_x / utm_y.
+    '''
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    arrow_types = {"str": pa.string(), "int": pa.int64(), "int64": pa.int64(), "float": pa.float64(), "bool": pa.bool_()}
+    columns = [column for column in properties.keys() if column != "geo_info_district_id"]  # partition key
+    schema = pa.schema([(column, arrow_types[properties[column]]) for column in columns])
+
+    out_dir_path = f"{DATA_PATH}/{out_dir_name}.parquet"
+    if os.path.exists(out_dir_path):  # no stale partitions of a previous export
+        shutil.rmtree(out_dir_path)
+
+    flat_data_by_district: Dict[str, List[Dict[str, Any]]] = {}
+    for tree_data in tree_data_list:
+        flat_data = flatten_tree_data(tree_data)
+        district_id = flat_data.get("geo_info_district_id") or "__HIVE_DEFAULT_PARTITION__"
+        flat_data_by_district.setdefault(district_id, []).append(flat_data)
+
+    for district_id, flat_data_list in flat_data_by_district.items():
+        hilbert_keys = get_hilbert_keys(
+            np.array([x["geo_info_utm_x"] or 0 for x in flat_data_list], dtype=float),
+            np.array([x["geo_info_utm_y"] or 0 for x in flat_data_list], dtype=float),
+        )
+        flat_data_list = [flat_data_list[i] for i in np.argsort(hilbert_keys, kind="stable")]
+
+        table = pa.Table.from_pydict(
+            {column: [x.get(column) for x in flat_data_list] for column in columns}, schema=schema
+        )
+
+        os.makedirs(f"{out_dir_path}/district_id={district_id}")
+        pq.write_table(
+            table,
+            f"{out_dir_path}/district_id={district_id}/part-0.parquet",
+            row_group_size=PARQUET_ROW_GROUP_SIZE,
+            use_dictionary=PARQUET_DICTIONARY_COLUMNS,
+            write_statistics=True,
+            compression="zstd"
+        )
+
+
+# ***
+# SQLite (normalized tables, R*Tree on lng / lat, built in one transaction)
+def _get_sqlite_rows(tree_data: Dict[str, Any], row_id: int) -> Dict[str, List[Tuple[Any, ...]]]:
+    ''' rows of each table of one tree '''
+    geo_info = tree_data["geo_info"]
+    taxonomy = tree_data["tree_taxonomy"]
+    measures = tree_data["tree_measures"]
+    age = tree_data["tree_age"]
+    found_in_dataset = tree_data.get("found_in_dataset") or {}
+
+    rows: Dict[str, List[Tuple[Any, ...]]] = {
+        "suburbs": [(geo_info["suburb_id"], geo_info["suburb"], geo_info["district_id"], geo_info["district"])] if geo_info["suburb_id"] is not None else [],
+        "trees": [(
+            row_id, tree_data["tree_id"],
+            tree_data["dataset_completeness"], tree_data["base_info_completeness"], tree_data["tree_taxonomy_completeness"],
+            tree_data["tree_measures_completeness"], tree_data["tree_age_completeness"],
+            tree_data["base_info"]["object_type"], tree_data["base_info"]["tree_nr"], tree_data["base_info"]["year_planting"],
+            geo_info["utm_x"], geo_info["utm_y"], geo_info["lat"], geo_info["lng"], geo_info["suburb_id"],
+            found_in_dataset.get("2017"), found_in_dataset.get("2020")
+        )],
+        "taxonomy": [(
+            row_id, taxonomy["genus"], taxonomy["genus_name_german"], taxonomy["species"], taxonomy["type"],
+            ", ".join(taxonomy["name_german"]) if taxonomy["name_german"] is not None else None
+        )],
+        "measures": [(row_id, measures["height"], measures["treetop_radius"], measures["bole_radius"])],
+        "ages": [(row_id, age["year_sprout"], age["age_in_2020"], age["age_group_2020"])],
+        "predictions": [],
+        "location_types": [],
+        "nearest_roads": [],
+        "trees_rtree": [(row_id, geo_info["lng"], geo_info["lng"], geo_info["lat"], geo_info["lat"])] if geo_info["lat"] is not None else [],
+    }
+
+    predictions = (tree_data.get("predictions") or {}).get("by_radius_prediction") or {}
+    for attribute, prediction in predictions.items():
+        rows["predictions"].append((row_id, attribute, prediction["prediction"], prediction["probability"]))
+
+    for category, location_type in (tree_data.get("tree_location_type") or {}).items():
+        rows["location_types"].append((
+            row_id, category, location_type["type"], location_type["name"], location_type["osm_id"], location_type["wikidata_id"]
+        ))
+
+    nearest_road = tree_data.get("nearest_road")
+    if nearest_road is not None:
+        rows["nearest_roads"].append((row_id, nearest_road["distance"], nearest_road["osm_id"], nearest_road["type"], nearest_road["name"]))
+
+    return rows
+
+
+def save_sqlite_data(out_file_name: str, tree_data_list: List[Dict[str, Any]]) -> None:
+    '''
+    One SQLite database (<out_file_name>.sqlite), trees in Hilbert order of utm_x / utm_y (trees.id).
+    Spatial filter with the R*Tree (32 bit floats, rounded outwards: filter exactly on trees.lat / lng if needed):
+
+        SELECT t.tree_id, x.genus FROM trees_rtree AS r
+        JOIN trees AS t ON t.id = r.id JOIN taxonomy AS x ON x.tree = t.id
+        WHERE r.max_lng >= 6.95 AND r.min_lng <= 6.96 AND r.max_lat >= 50.93 AND r.min_lat <= 50.94
+
+    Written to a temporary file first: readers of the previous export aren't affected until it's complete.
+    '''
+    out_file_path = f"{DATA_PATH}/{out_file_name}.sqlite"
+    tmp_file_path = f"{out_file_path}.tmp"
+    if os.path.exists(tmp_file_path):
+        os.remove(tmp_file_path)
+
+    hilbert_keys = get_hilbert_keys(
+        np.array([x["geo_info"]["utm_x"] or 0 for x in tree_data_list], dtype=float),
+        np.array([x["geo_info"]["utm_y"] or 0 for x in tree_data_list], dtype=float),
+    ) if len(tree_data_list) > 0 else np.array([], dtype=np.int64)
+
+    connection = sqlite3.connect(tmp_file_path)
+    try:
+        # ***
+        # bulk load: nothing to recover if it fails (temporary file)
+        connection.execute("PRAGMA journal_mode = OFF")
+        connection.execute("PRAGMA synchronous = OFF")
+        connection.execute("PRAGMA locking_mode = EXCLUSIVE")
+        connection.execute("PRAGMA temp_store = MEMORY")
+        connection.execute("PRAGMA cache_size = -65536")  # 64 MB
+
+        with connection:  # one transaction
+            for statement in SQLITE_SCHEMA:
+                connection.execute(statement)
+
+            order = np.argsort(hilbert_keys, kind="stable")
+            for start in range(0, len(order), SQLITE_INSERT_CHUNK_SIZE):
+                table_rows: Dict[str, List[Tuple[Any, ...]]] = {table: [] for table in SQLITE_INSERTS.keys()}
+                for row_id, i in enumerate(order[start:start+SQLITE_INSERT_CHUNK_SIZE], start=start + 1):
+                    for table, rows in _get_sqlite_rows(tree_data_list[i], row_id).items():
+                        table_rows[table].extend(rows)
+                for table, rows in table_rows.items():
+                    connection.executemany(SQLITE_INSERTS[table], rows)
+
+            for statement in SQLITE_INDEXES:
+                connection.execute(statement)
+            connection.execute("ANALYZE")
+    finally:
+        connection.close()
+
+    os.replace(tmp_file_path, out_file_path)
@@ -35,6 +35,9 @@ def create_suburb_polygons():
     '''
     global SUBURB_POLYGONS
 
+    if len(SUBURB_POLYGONS) > 0:  # already created (i.e. by a preceding stage in the same process)
+        return
+
     with open("../data/geo_data/cologne_districts_reduced_polygons.geojson") as f:
         features = json.load(f)["features"]
 
@@ -0,0 +1,370 @@
+'''
+Columnar ingest of the original "Baumkataster" csv datasets 2017 and 2020.
+
+Creates the same records as process_dataset_2017 / process_dataset_2020, but parses and normalizes each
+column as a whole (instead of row by row) with one shared column mapping for both releases:
+- typed parsing of integer columns (same rules as int(): optional sign and surrounding whitespace)
+- sentinel values ("unbekannt", "?", ...) replaced by None
+- suburb polygon match, age groups and completeness scores as array operations
+- year_sprout regression once per unique (genus, bole_radius)
+'''
+import json
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+from shapely import contains_xy
+import utm
+
+import _geo
+from _tree_id import get_tree_id
+from predictions._age_regression import predict_year_sprout
+
+
+PLANTING_AGE = 10
+AGE_GROUPS = [(1, 26), (26, 41), (41, 1000)]  # age_in_2020: [lower, upper)
+
+# ***
+# shared column mapping: attribute -> csv column of the respective release
+DATASETS: Dict[str, Dict[str, Any]] = {
+    "2017": {
+        "file_path": "../data/original_data/Bestand_Einzelbaeume_Koeln_0.csv",
+        "delimiter": ";",
+        "unknown_values": ["unbekannt"],
+        "unknown_object_types": ["NN", "Unbekannt", "unknown"],
+        "columns": {
+            "utm_x": "X_Koordina",
+            "utm_y": "Y_Koordina",
+            "height": "HöHE",
+            "treetop_radius": "KRONE",
+            "bole_radius": "STAMMBIS",
+            "object_type": "Objekttyp",
+            "tree_nr": "Baum-Nr.",
+            "age_estimation": "AlterSchätzung",  # estimated age in 2017
+            "genus": "Gattung",
+            "species": "Art",
+            "type": "Sorte",
+            "name_german": "DeutscherN",
+        }
+    },
+    "2020": {
+        "file_path": "../data/original_data/20200610_Baumbestand_Koeln.csv",
+        "delimiter": ",",
+        "unknown_values": ["unbekannt", "?"],
+        "unknown_object_types": ["NN", "Unbekannt", "unknown", "?"],
+        "columns": {
+            "utm_x": "x_koordina",
+            "utm_y": "y_koordina",
+            "height": "H_HE",
+            "treetop_radius": "KRONE",
+            "bole_radius": "STAMMBIS",
+            "object_type": "objekttyp",
+            "tree_nr": "baumnr",
+            "year_planting": "PFLANZJAH",
+            "genus": "Gattung",
+            "species": "Art",
+            "type": "Sorte",
+            "name_german": "DeutscherN",
+        }
+    }
+}
+
+COMPLETENESS_ATTRIBUTES = {  # attribute: number of values
+    "base_info": 3,
+    "tree_taxonomy": 5,
+    "tree_measures": 3,
+    "tree_age": 3,
+}
+
+
+# **************************
+# typed parsing / normalization of columns
+# **************************
+def _parse_int(column: pd.Series) -> Tuple[np.ndarray, np.ndarray]:
+    '''
+    returns values and mask of valid values (parsable like int(): also single underscores between digits),
+    values as python ints (object array) if a value exceeds int64 (like int() in the row-wise ingest)
+    '''
+    is_valid = np.array(column.str.fullmatch(r"\s*[+-]?\d+(?:_\d+)*\s*").fillna(False), dtype=bool)
+    valid_values = column[is_valid].str.strip().str.replace("_", "", regex=False)
+    try:
+        values = np.zeros(len(column), dtype=np.int64)
+        values[is_valid] = np.array(valid_values.astype(np.int64))
+    except OverflowError:
+        values = np.zeros(len(column), dtype=object)
+        values[is_valid] = [int(x) for x in valid_values]
+    return values, is_valid
+
+
+def _to_objects(values: np.ndarray, is_valid: np.ndarray) -> np.ndarray:
+    ''' python values (int, float, str, ...) or None '''
+    objects = values.astype(object)
+    objects[~is_valid] = None
+    return objects
+
+
+def _positive_int_or_none(column: pd.Series) -> Tuple[np.ndarray, np.ndarray]:
+    values, is_valid = _parse_int(column)
+    is_valid &= np.asarray(values > 0, dtype=bool)
+    return values, is_valid
+
+
+def _text_or_none(column: pd.Series, unknown_values: List[str]) -> np.ndarray:
+    values = column.to_numpy(dtype=object)
+    is_valid = (column.str.len() > 0) & ~column.isin(unknown_values)
+    return _to_objects(values, is_valid.to_numpy(dtype=bool))
+
+
+# **************************
+# derived columns
+# **************************
+def _get_lat_lng(utm_x: np.ndarray, utm_y: np.ndarray, utm_valid: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    '''
+    Coordinates out of UTM range are rejected (like the strict range check in utm.to_latlon for a single pair),
+    all others are converted in one call.
+    '''
+    is_valid = utm_valid & np.asarray((utm_x >= 100000) & (utm_x < 1000000) & (utm_y >= 0) & (utm_y <= 10000000), dtype=bool)
+
+    lat = np.full(len(utm_x), None, dtype=object)
+    lng = np.full(len(utm_x), None, dtype=object)
+    if is_valid.any():
+        valid_lat, valid_lng = utm.to_latlon(utm_x[is_valid].astype(np.int64), utm_y[is_valid].astype(np.int64), 32, 'U')
+        lat[is_valid] = list(valid_lat)
+        lng[is_valid] = list(valid_lng)
+
+    return lat, lng, is_valid
+
+
+def _get_suburb_index(lat: np.ndarray, lng: np.ndarray) -> np.ndarray:
+    ''' index of first matching polygon in _geo.SUBURB_POLYGONS or -1 '''
+    suburb_index = np.full(len(lat), -1, dtype=np.int64)
+    lat = lat.astype(float)
+    lng = lng.astype(float)
+
+    for i, polygon_data in enumerate(_geo.SUBURB_POLYGONS):
+        not_matched = suburb_index == -1
+        is_in_polygon = contains_xy(polygon_data["polygon"], lng[not_matched], lat[not_matched])
+        suburb_index[np.flatnonzero(not_matched)[is_in_polygon]] = i
+
+    return suburb_index
+
+
+def _get_year_sprout(genus: np.ndarray, bole_radius: np.ndarray, bole_radius_valid: np.ndarray) -> np.ndarray:
+    year_sprout = np.full(len(genus), None, dtype=object)
+    has_values = (genus != None) & bole_radius_valid
+
+    predictions: Dict[Tuple[str, int], Optional[int]] = {}
+    for i in np.flatnonzero(has_values):
+        key = (genus[i], int(bole_radius[i]))
+        if key not in predictions:
+            try:
+                predictions[key] = predict_year_sprout(key[0], key[1])
+            except:
+                predictions[key] = None
+        year_sprout[i] = predictions[key]
+
+    return year_sprout
+
+
+def _get_age_groups(age_in_2020: np.ndarray) -> np.ndarray:
+    has_age = age_in_2020 != None
+    age = np.where(has_age, age_in_2020, 0).astype(np.int64)
+
+    age_group = np.full(len(age_in_2020), None, dtype=object)
+    for j, (lower_boundary, upper_boundary) in enumerate(AGE_GROUPS):
+        age_group[has_age & (age >= lower_boundary) & (age < upper_boundary)] = j
+
+    return age_group
+
+
+def _get_completeness(value_counts: Dict[str, np.ndarray]) -> Dict[str, np.ndarray]:
+    '''
+    Same float arithmetic as the row-wise ingest: the scores are only computed for the (few) unique
+    combinations of counts and mapped back.
+    '''
+    counts = np.column_stack([value_counts[k] for k in COMPLETENESS_ATTRIBUTES.keys()])
+    unique_counts, inverse = np.unique(counts, axis=0, return_inverse=True)
+    inverse = inverse.ravel()
+
+    unique_scores: List[List[float]] = []
+    for count_combination in unique_counts.tolist():
+        scores = []
+        tmp_completeness_collected = 0.0
+        for count, (k, num_values) in zip(count_combination, COMPLETENESS_ATTRIBUTES.items()):
+            collected_types_perc = round(count / num_values, 2)
+            scores.append(collected_types_perc)
+            tmp_completeness_collected += collected_types_perc
+        scores.append(round(tmp_completeness_collected / len(COMPLETENESS_ATTRIBUTES), 2))
+        unique_scores.append(scores)
+
+    unique_scores_array = np.array(unique_scores, dtype=object)
+    completeness = {f"{k}_completeness": unique_scores_array[inverse, i] for i, k in enumerate(COMPLETENESS_ATTRIBUTES.keys())}
+    completeness["dataset_completeness"] = unique_scores_array[inverse, len(COMPLETENESS_ATTRIBUTES)]
+
+    return completeness
+
+
+def _count_values(*columns: np.ndarray) -> np.ndarray:
+    return np.sum([column != None for column in columns], axis=0)
+
+
+# **************************
+#
+# **************************
+def _load_meta_data() -> Tuple[Dict[str, Any], Dict[str, Any]]:
+    with open("../data/meta/object_types.json") as f:
+        object_types = json.load(f)
+
+    with open("../data/meta/genus_name_german.json") as f:
+        genus_name_german = json.load(f)
+
+    return object_types, genus_name_german
+
+
+def process_dataset(year: str) -> List[Dict[str, Any]]:
+    '''
+    year: "2017" or "2020"
+    Expects the suburb polygons to be created (_geo.create_suburb_polygons)
+    '''
+    dataset = DATASETS[year]
+    df = pd.read_csv(dataset["file_path"], sep=dataset["delimiter"], dtype=str, keep_default_na=False).fillna("")
+
+    return _process_rows(df, year, *_load_meta_data(), {})
+
+
+def iter_dataset_chunks(year: str, chunk_size: int) -> Iterator[List[Dict[str, Any]]]:
+    '''
+    Same records as process_dataset, read and processed chunk_size csv rows at a time (out-of-core mode, see _tree_store.py)
+    '''
+    dataset = DATASETS[year]
+    object_types, genus_name_german = _load_meta_data()
+    tree_id_key_counts: Dict[str, int] = {}  # tree ids are unique across the chunks
+
+    for df in pd.read_csv(dataset["file_path"], sep=dataset["delimiter"], dtype=str, keep_default_na=False, chunksize=chunk_size):
+        yield _process_rows(df.fillna("").reset_index(drop=True), year, object_types, genus_name_german, tree_id_key_counts)
+
+
+def _process_rows(
+    df: pd.DataFrame,
+    year: str,
+    object_types: Dict[str, Any],
+    genus_name_german: Dict[str, Any],
+    tree_id_key_counts: Dict[str, int]
+) -> List[Dict[str, Any]]:
+    dataset = DATASETS[year]
+    columns = dataset["columns"]
+
+    # ***
+    # ignore if geo data is not valid / missing
+    utm_x, utm_x_valid = _parse_int(df[columns["utm_x"]])
+    utm_y, utm_y_valid = _parse_int(df[columns["utm_y"]])
+    lat, lng, is_valid = _get_lat_lng(utm_x, utm_y, utm_x_valid & utm_y_valid)
+
+    df = df[is_valid].reset_index(drop=True)
+    utm_x, utm_y = utm_x[is_valid].astype(np.int64), utm_y[is_valid].astype(np.int64)  # within UTM range
+    lat, lng = lat[is_valid], lng[is_valid]
+
+    # ***
+    # measures
+    height = _to_objects(*_positive_int_or_none(df[columns["height"]]))
+    treetop_radius = _to_objects(*_positive_int_or_none(df[columns["treetop_radius"]]))
+    bole_radius_values, bole_radius_valid = _positive_int_or_none(df[columns["bole_radius"]])
+    bole_radius = _to_objects(bole_radius_values, bole_radius_valid)
+
+    # ***
+    # base info
+    object_type = np.array(df[columns["object_type"]].map(object_types["en"]), dtype=object)
+    object_type[pd.isna(object_type) | np.isin(object_type, dataset["unknown_object_types"])] = None
+
+    tree_nr = _text_or_none(df[columns["tree_nr"]], [])
+
+    if year == "2017":
+        age_estimation, age_estimation_valid = _positive_int_or_none(df[columns["age_estimation"]])
+        year_planting = _to_objects(2017 - age_estimation + PLANTING_AGE, age_estimation_valid)
+    else:
+        year_planting = _to_objects(*_positive_int_or_none(df[columns["year_planting"]]))
+
+    # ***
+    # suburb / district
+    suburb_index = _get_suburb_index(lat, lng)
+    suburb_properties = [polygon_data["properties"] for polygon_data in _geo.SUBURB_POLYGONS] + [{}]  # -1: no match
+
+    # ***
+    # taxonomy
+    taxo_genus = _text_or_none(df[columns["genus"]], dataset["unknown_values"])
+    taxo_species = _text_or_none(df[columns["species"]], dataset["unknown_values"])
+    taxo_type = _text_or_none(df[columns["type"]], dataset["unknown_values"])
+    taxo_name_german = _text_or_none(df[columns["name_german"]], dataset["unknown_values"])
+    taxo_genus_name_german = np.array([
+        genus_name_german[x]["name_german"] if genus_name_german.get(x) is not None else None for x in taxo_genus
+    ], dtype=object)
+
+    # ***
+    # age
+    year_sprout = _get_year_sprout(taxo_genus, bole_radius_values, bole_radius_valid)
+    has_year_sprout = year_sprout != None
+    age_in_2020 = _to_objects(2020 - np.where(has_year_sprout, year_sprout, 0).astype(np.int64), has_year_sprout)
+    age_group = _get_age_groups(age_in_2020)
+
+    # ***
+    # completeness
+    completeness = _get_completeness({
+        "base_info": _count_values(object_type, tree_nr, year_planting),
+        "tree_taxonomy": _count_values(taxo_genus, taxo_genus_name_german, taxo_species, taxo_type, taxo_name_german),
+        "tree_measures": _count_values(height, treetop_radius, bole_radius),
+        "tree_age": _count_values(year_sprout, age_in_2020, age_group),
+    })
+
+    # ***
+    # assemble records (same layout as row-wise ingest)
+    lines: List[Dict[str, Any]] = []
+    for i in range(len(df)):
+        suburb_polygon_feature = suburb_properties[suburb_index[i]]
+
+        lines.append({
+            "tree_id": get_tree_id(year, int(utm_x[i]), int(utm_y[i]), tree_nr[i], tree_id_key_counts),
+            "dataset_completeness": completeness["dataset_completeness"][i],
+            "base_info_completeness": completeness["base_info_completeness"][i],
+            "tree_taxonomy_completeness": completeness["tree_taxonomy_completeness"][i],
+            "tree_measures_completeness": completeness["tree_measures_completeness"][i],
+            "tree_age_completeness": completeness["tree_age_completeness"][i],
+            "base_info":
+            {
+                "object_type": object_type[i],
+                "tree_nr": tree_nr[i],
+                "year_planting": year_planting[i]
+            },
+            "geo_info":
+            {
+                "utm_x": int(utm_x[i]),
+                "utm_y": int(utm_y[i]),
+                "lat": lat[i],
+                "lng": lng[i],
+                "suburb": suburb_polygon_feature.get("NAME"),
+                "suburb_id": suburb_polygon_feature.get("NUMMER"),
+                "district": suburb_polygon_feature.get("STADTBEZIRK"),
+                "district_id": suburb_polygon_feature.get("NR_STADTBEZIRK"),
+            },
+            "tree_taxonomy":
+            {
+                "genus": taxo_genus[i],
+                "genus_name_german": taxo_genus_name_german[i],
+                "species": taxo_species[i],
+                "type": taxo_type[i],
+                "name_german": [x.strip() for x in taxo_name_german[i].split(",")] if taxo_name_german[i] is not None else None,
+            },
+            "tree_measures":
+            {
+                "height": height[i],
+                "treetop_radius": treetop_radius[i],
+                "bole_radius": bole_radius[i],
+            },
+            "tree_age":
+            {
+                "year_sprout": year_sprout[i],
+                "age_in_2020": age_in_2020[i],
+                "age_group_2020": age_group[i],
+            }
+        })
+
+    return lines
@@ -0,0 +1,350 @@
+'''
+Raster fast path for the location types (same result as _osm_type.get_tree_location_types).
+
+compile_location_rasters rasterizes the OSM layers of each suburb once: one grid per category over the bounding box
+of the suburb polygon (cells of approx. RASTER_RESOLUTION meter), cell values:
+- 0: no feature touches the cell
+- i + 1: the cell lies within the i-th feature of the suburb file and no preceding feature touches it
+- BOUNDARY: a feature boundary (might) pass the cell (marked conservatively, also for invalid geometries)
+
+Features are matched in file order (first match wins), hence they are rasterized in reverse order: preceding
+features overwrite the cells of the following ones. A tree in a 0 resp. i + 1 cell gets its location type by lookup,
+trees in BOUNDARY cells (or outside the grid) are checked against the exact geometry.
+
+The grids are stored run-length encoded (rows concatenated: run k starts at flat cell index starts[k] with values[k])
+in /data/geo_data/osm_raster/<layer>.npz, a lookup is a binary search. Rasters of changed layers (other content
+hash of the layer file, i.e. after osm/simplify_buffer.py or a new OSM extract) are ignored, i.e. the trees of
+this suburb and category are checked against the exact geometry.
+
+$ python _location_raster.py --resolution 0.5 [--simplified]
+'''
+import argparse
+import hashlib
+from math import cos, radians
+import os
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+from shapely import is_valid
+from shapely.geometry import Point, Polygon
+
+import _osm_type
+from _osm_type import OSM_DATA_DIR, OSM_SIMPLIFIED_DATA_DIR, get_district_suburb_slug, get_location_type, get_suburb_data
+from _partition import get_worker_context
+
+
+OSM_RASTER_DIR = "../data/geo_data/osm_raster"
+RASTER_RESOLUTION = 0.5  # in meter (approx.)
+BOUNDARY = np.iinfo(np.uint16).max  # max. 65534 features per suburb and category
+METER_PER_DEGREE_LAT = 111132.0
+METER_PER_DEGREE_LNG = 111320.0  # * cos(lat)
+
+LOCATION_RASTERS: Dict[str, Dict[str, Any]] = {}  # by suburb, read from RASTER_FILE when needed
+RASTER_FILE: Optional[Any] = None  # np.load of the npz file
+RASTER_DATA_DIR: Optional[str] = None  # OSM layers of RASTER_FILE
+
+
+def _get_layer_hash(data_dir: str, location_category: str, district_suburb: str) -> str:
+    ''' content hash of the OSM layer file ("" if missing) '''
+    try:
+        with open(f"{data_dir}/{location_category}/{district_suburb}.json", "rb") as f:
+            return hashlib.sha1(f.read()).hexdigest()
+    except OSError:
+        return ""
+
+
+def get_raster_path(data_dir: str) -> str:
+    return f"{OSM_RASTER_DIR}/{os.path.basename(data_dir.rstrip('/'))}.npz"
+
+
+# ***
+# compile
+def _get_grid(suburb_polygon: Polygon, resolution: float) -> np.ndarray:
+    ''' [min lng, min lat, cell width, cell height (in degree), columns, rows] '''
+    min_lng, min_lat, max_lng, max_lat = suburb_polygon.bounds
+    cell_height = resolution / METER_PER_DEGREE_LAT
+    cell_width = resolution / (METER_PER_DEGREE_LNG * cos(radians((min_lat + max_lat) / 2)))
+
+    min_lng, min_lat = min_lng - cell_width, min_lat - cell_height  # margin: trees on the bounding box
+    columns = int(np.ceil((max_lng - min_lng) / cell_width)) + 1
+    rows = int(np.ceil((max_lat - min_lat) / cell_height)) + 1
+
+    return np.array([min_lng, min_lat, cell_width, cell_height, columns, rows], dtype=np.float64)
+
+
+def _to_grid(coordinates: List[List[float]], grid: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    ''' lng, lat -> x, y in cells (cell c spans [c, c + 1)) '''
+    lng_lat = np.asarray(coordinates, dtype=np.float64)
+    return (lng_lat[:, 0] - grid[0]) / grid[2], (lng_lat[:, 1] - grid[1]) / grid[3]
+
+
+def _get_interior_mask(rings: List[Tuple[np.ndarray, np.ndarray]], row_0: int, row_1: int, column_0: int, column_1: int) -> np.ndarray:
+    '''
+    Cells of the window whose center lies within the rings (even-odd rule, holes included):
+    number of ring crossings left of the center of each cell
+    '''
+    crossings = np.zeros((row_1 - row_0, column_1 - column_0 + 1), dtype=np.int32)
+
+    for x, y in rings:
+        x_0, y_0, x_1, y_1 = x[:-1], y[:-1], x[1:], y[1:]
+        # rows whose center (row + 0.5) lies in [min y, max y) of the edge
+        first_row = np.maximum(np.ceil(np.minimum(y_0, y_1) - 0.5).astype(np.int64), row_0)
+        last_row = np.minimum(np.ceil(np.maximum(y_0, y_1) - 0.5).astype(np.int64), row_1)
+        row_counts = np.maximum(last_row - first_row, 0)
+        if row_counts.sum() == 0:
+            continue
+
+        edges = np.repeat(np.arange(len(x_0)), row_counts)
+        rows = first_row[edges] + np.arange(row_counts.sum()) - np.repeat(np.cumsum(row_counts) - row_counts, row_counts)
+        center_y = rows + 0.5
+        crossing_x = x_0[edges] + (center_y - y_0[edges]) * (x_1 - x_0)[edges] / (y_1 - y_0)[edges]
+
+        # the crossing counts for all cells whose center is right of it
+        first_column = np.clip(np.floor(crossing_x - 0.5).astype(np.int64) + 1 - column_0, 0, column_1 - column_0)
+        np.add.at(crossings, (rows - row_0, first_column), 1)
+
+    return np.cumsum(crossings, axis=1)[:, :-1] % 2 == 1
+
+
+def _get_boundary_cells(rings: List[Tuple[np.ndarray, np.ndarray]]) -> Tuple[np.ndarray, np.ndarray]:
+    '''
+    Rows, columns of all cells the rings might pass: points along each edge (distance <= 1 cell) and their
+    neighbouring cells (each cell the edge passes is within half a cell of one of these points)
+    '''
+    all_rows: List[np.ndarray] = []
+    all_columns: List[np.ndarray] = []
+    for x, y in rings:
+        dx, dy = x[1:] - x[:-1], y[1:] - y[:-1]
+        steps = np.maximum(np.ceil(np.hypot(dx, dy)).astype(np.int64), 1)
+        edges = np.repeat(np.arange(len(dx)), steps)
+        t = (np.arange(steps.sum()) - np.repeat(np.cumsum(steps) - steps, steps)) / np.repeat(steps, steps)
+
+        point_x = np.append(x[:-1][edges] + dx[edges] * t, x[-1])
+        point_y = np.append(y[:-1][edges] + dy[edges] * t, y[-1])
+        all_columns.append(np.floor(point_x).astype(np.int64))
+        all_rows.append(np.floor(point_y).astype(np.int64))
+
+    rows, columns = np.concatenate(all_rows), np.concatenate(all_columns)
+    offsets = [(i, j) for i in (-1, 0, 1) for j in (-1, 0, 1)]
+    return np.concatenate([rows + i for i, _ in offsets]), np.concatenate([columns + j for _, j in offsets])
+
+
+def _rasterize_features(features: List[Dict[str, Any]], grid: np.ndarray) -> np.ndarray:
+    columns, rows = int(grid[4]), int(grid[5])
+    raster = np.zeros((rows, columns), dtype=np.uint16)
+
+    for i in reversed(range(len(features))):
+        coordinates = features[i]["geometry"]["coordinates"]
+        rings = [_to_grid(ring, grid) for ring in coordinates if len(ring) > 0]
+        if len(rings) == 0:
+            continue
+
+        min_x, max_x = min(x.min() for x, _ in rings), max(x.max() for x, _ in rings)
+        min_y, max_y = min(y.min() for _, y in rings), max(y.max() for _, y in rings)
+        column_0, column_1 = max(int(np.floor(min_x)) - 1, 0), min(int(np.floor(max_x)) + 2, columns)
+        row_0, row_1 = max(int(np.floor(min_y)) - 1, 0), min(int(np.floor(max_y)) + 2, rows)
+        if column_0 >= column_1 or row_0 >= row_1:  # outside the grid
+            continue
+
+        # matched within the stored bounding box only: exact check if the geometry exceeds it (or is invalid)
+        polygon = Polygon(coordinates[0], coordinates[1:])
+        bbox = features[i]["properties"]["bounding_box"]  # min lat, min lng, max lat, max lng
+        min_lng, min_lat, max_lng, max_lat = polygon.bounds
+        if is_valid(polygon) is False or min_lng < bbox[1] or min_lat < bbox[0] or max_lng > bbox[3] or max_lat > bbox[2]:
+            raster[row_0:row_1, column_0:column_1] = BOUNDARY
+            continue
+
+        window = raster[row_0:row_1, column_0:column_1]
+        window[_get_interior_mask(rings, row_0, row_1, column_0, column_1)] = i + 1
+
+        boundary_rows, boundary_columns = _get_boundary_cells(rings)
+        in_grid = (boundary_rows >= 0) & (boundary_rows < rows) & (boundary_columns >= 0) & (boundary_columns < columns)
+        raster[boundary_rows[in_grid], boundary_columns[in_grid]] = BOUNDARY
+
+    return raster
+
+
+def _encode_runs(raster: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    flat = raster.ravel()
+    starts = np.flatnonzero(np.concatenate([[True], flat[1:] != flat[:-1]]))
+    return starts.astype(np.uint32 if flat.size < 2 ** 32 else np.int64), flat[starts]
+
+
+def compile_location_rasters(data_dir: str = OSM_DATA_DIR, resolution: float = RASTER_RESOLUTION) -> None:
+    from _geo import SUBURB_POLYGONS, create_suburb_polygons
+
+    create_suburb_polygons()
+    get_suburb_data(data_dir)
+
+    arrays: Dict[str, np.ndarray] = {}
+    for suburb_polygon in SUBURB_POLYGONS:
+        district_suburb = get_district_suburb_slug(suburb_polygon["properties"]["STADTBEZIRK"], suburb_polygon["properties"]["NAME"])
+        if _osm_type.SUBURBS_GEOJSON.get(district_suburb) is None:
+            continue
+
+        grid = _get_grid(suburb_polygon["polygon"], resolution)
+        arrays[f"{district_suburb}|grid"] = grid
+
+        for location_category, suburb_data in _osm_type.SUBURBS_GEOJSON[district_suburb].items():
+            if len(suburb_data["features"]) >= BOUNDARY:
+                continue
+            starts, values = _encode_runs(_rasterize_features(suburb_data["features"], grid))
+            arrays[f"{district_suburb}|{location_category}|starts"] = starts
+            arrays[f"{district_suburb}|{location_category}|values"] = values
+            arrays[f"{district_suburb}|{location_category}|feature_count"] = np.array(len(suburb_data["features"]))
+            arrays[f"{district_suburb}|{location_category}|layer_hash"] = np.array(_get_layer_hash(data_dir, location_category, district_suburb))
+
+        print(f"{district_suburb}: {int(grid[4])} x {int(grid[5])} cells")
+
+    os.makedirs(OSM_RASTER_DIR, exist_ok=True)
+    np.savez_compressed(get_raster_path(data_dir), **arrays)
+
+
+# ***
+# lookup
+def load_location_rasters(data_dir: str = OSM_DATA_DIR) -> None:
+    '''
+    OSM layers (_osm_type.get_suburb_data) and the raster file: the rasters of a suburb are read with its first lookup
+    (i.e. each worker of _partition.run_partitioned only reads the suburbs of its partitions)
+    '''
+    get_suburb_data(data_dir)
+    open_location_rasters(data_dir)
+
+
+def open_location_rasters(data_dir: str = OSM_DATA_DIR) -> None:
+    '''
+    Only the raster file (out-of-core mode: the OSM layers are loaded one suburb at a time, _osm_type.get_district_suburb_data)
+    '''
+    global RASTER_FILE
+    global RASTER_DATA_DIR
+
+    LOCATION_RASTERS.clear()
+    RASTER_FILE = np.load(get_raster_path(data_dir))
+    RASTER_DATA_DIR = data_dir
+
+
+def _get_suburb_rasters(district_suburb: str) -> Dict[str, Any]:
+    if LOCATION_RASTERS.get(district_suburb) is None:
+        suburb_rasters: Dict[str, Any] = {"grid": None, "categories": {}}
+        if RASTER_FILE is not None and f"{district_suburb}|grid" in RASTER_FILE.files:
+            suburb_rasters["grid"] = RASTER_FILE[f"{district_suburb}|grid"]
+            for key in RASTER_FILE.files:
+                if key.startswith(f"{district_suburb}|") and key != f"{district_suburb}|grid":
+                    _, location_category, name = key.split("|")
+                    suburb_rasters["categories"].setdefault(location_category, {})[name] = RASTER_FILE[key]
+        LOCATION_RASTERS[district_suburb] = suburb_rasters
+
+    return LOCATION_RASTERS[district_suburb]
+
+
+def _is_current_raster(district_suburb: str, location_category: str, category_raster: Dict[str, Any]) -> bool:
+    ''' layer file unchanged since compiled (hashed once per process, rasters without hash: changed) '''
+    if category_raster.get("is_current") is None:
+        category_raster["is_current"] = (
+            "layer_hash" in category_raster and RASTER_DATA_DIR is not None
+            and str(category_raster["layer_hash"]) == _get_layer_hash(RASTER_DATA_DIR, location_category, district_suburb)
+        )
+    return category_raster["is_current"]
+
+
+def _get_cell_values(district_suburb: str, location_category: str, feature_count: int, lat: np.ndarray, lng: np.ndarray) -> np.ndarray:
+    ''' BOUNDARY for trees outside the grid (resp. without current raster of this suburb / category) '''
+    suburb_rasters = _get_suburb_rasters(district_suburb)
+    category_raster = suburb_rasters["categories"].get(location_category)
+    if (
+        category_raster is None or int(category_raster["feature_count"]) != feature_count
+        or _is_current_raster(district_suburb, location_category, category_raster) is False
+    ):
+        return np.full(len(lat), BOUNDARY, dtype=np.uint16)
+
+    grid = suburb_rasters["grid"]
+    columns = np.floor((lng - grid[0]) / grid[2]).astype(np.int64)
+    rows = np.floor((lat - grid[1]) / grid[3]).astype(np.int64)
+    in_grid = (columns >= 0) & (columns < int(grid[4])) & (rows >= 0) & (rows < int(grid[5]))
+
+    flat_cells = np.where(in_grid, rows * int(grid[4]) + columns, 0).astype(category_raster["starts"].dtype)
+    runs = np.searchsorted(category_raster["starts"], flat_cells, side="right") - 1
+    return np.where(in_grid, category_raster["values"][runs], BOUNDARY)
+
+
+def _get_suburb_location_types(district_suburb: str, lat: np.ndarray, lng: np.ndarray) -> List[Optional[Dict[str, Any]]]:
+    ''' tree_location_type of each tree of one suburb (with OSM data) '''
+    tree_location_types: List[Optional[Dict[str, Any]]] = [None] * len(lat)
+
+    for location_category, suburb_data in _osm_type.SUBURBS_GEOJSON[district_suburb].items():
+        cell_values = _get_cell_values(district_suburb, location_category, len(suburb_data["features"]), lat, lng)
+
+        for i, cell_value in enumerate(cell_values.tolist()):
+            if cell_value == 0:
+                continue
+
+            if cell_value == BOUNDARY:
+                tree_point = Point(float(lng[i]), float(lat[i]))
+                location_type = _osm_type._check_suburb_polygons(suburb_data, tree_point, location_category)
+            else:
+                location_type = get_location_type(suburb_data["features"][cell_value - 1]["properties"], location_category)
+
+            if location_type is not None:
+                if tree_location_types[i] is None:
+                    tree_location_types[i] = {}
+                tree_location_types[i][location_category] = location_type
+
+    return tree_location_types
+
+
+def get_raster_location_types(tree_data_list: List[Dict[str, Any]]) -> List[Optional[Dict[str, Any]]]:
+    '''
+    Same as _osm_type.get_partition_location_types (i.e. for _partition.run_partitioned with context_init
+    load_location_rasters): trees with tree_location_type, None for trees without OSM data
+    '''
+    trees_by_suburb: Dict[str, List[int]] = {}
+    results: List[Optional[Dict[str, Any]]] = [None] * len(tree_data_list)
+    for i, tree_data in enumerate(tree_data_list):
+        tree_data["tree_location_type"] = None
+        district_suburb = get_district_suburb_slug(tree_data["geo_info"]["district"], tree_data["geo_info"]["suburb"])
+        if _osm_type.SUBURBS_GEOJSON.get(district_suburb) is None:
+            continue
+        trees_by_suburb.setdefault(district_suburb, []).append(i)
+        results[i] = tree_data
+
+    for district_suburb, tree_indices in trees_by_suburb.items():
+        lat = np.array([tree_data_list[i]["geo_info"]["lat"] for i in tree_indices], dtype=np.float64)
+        lng = np.array([tree_data_list[i]["geo_info"]["lng"] for i in tree_indices], dtype=np.float64)
+
+        for i, tree_location_type in zip(tree_indices, _get_suburb_location_types(district_suburb, lat, lng)):
+            tree_data_list[i]["tree_location_type"] = tree_location_type
+
+    return results
+
+
+def get_array_raster_location_types(tree_rows: List[int]) -> List[Optional[Tuple[int, Optional[Dict[str, Any]]]]]:
+    '''
+    Same as _osm_type.get_array_location_types (for _osm_type.run_location_types with context_init load_location_rasters)
+    '''
+    context = get_worker_context()
+    arrays = context["arrays"]
+
+    rows_by_suburb: Dict[str, List[int]] = {}
+    results: Dict[int, Optional[Tuple[int, Optional[Dict[str, Any]]]]] = {}
+    for row in tree_rows:
+        district_suburb = context["district_suburb_by_code"][int(arrays["suburb"][row])]
+        if _osm_type.SUBURBS_GEOJSON.get(district_suburb) is None:
+            results[row] = None
+            continue
+        rows_by_suburb.setdefault(district_suburb, []).append(row)
+
+    for district_suburb, rows in rows_by_suburb.items():
+        tree_location_types = _get_suburb_location_types(district_suburb, arrays["lat"][rows], arrays["lng"][rows])
+        for row, tree_location_type in zip(rows, tree_location_types):
+            results[row] = (row, tree_location_type)
+
+    return [results[row] for row in tree_rows]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Rasterize the OSM layers for the location types.")
+    parser.add_argument("--resolution", type=float, default=RASTER_RESOLUTION, help="cell size in meter (approx.)")
+    parser.add_argument("--simplified", action="store_true", help="rasterize the dissolved / simplified OSM layers")
+    args = parser.parse_args()
+
+    compile_location_rasters(OSM_SIMPLIFIED_DATA_DIR if args.simplified is True else OSM_DATA_DIR, args.resolution)
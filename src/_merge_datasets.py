@@ -1,7 +1,6 @@
 '''
 Merge data 2017 and 2020
 '''
-import json
 from typing import Any, Dict, List, Optional
 
 
@@ -11,13 +10,8 @@ from typing import Any, Dict, List, Optional
 PLANTING_AGE = 10
 
 
-def _add_to_list(tree_list: List[str], year: str, trees_by_utm: Dict[str, Any]) -> Dict[str, List[Dict[str, Any]]]:
-    for line in tree_list:
-        try:
-            tree_data = json.loads(line)
-        except:
-            continue
-
+def _add_to_list(tree_list: List[Dict[str, Any]], year: str, trees_by_utm: Dict[str, Any]) -> Dict[str, List[Dict[str, Any]]]:
+    for tree_data in tree_list:
         utm_values = f'{tree_data["geo_info"]["utm_x"]}_{tree_data["geo_info"]["utm_y"]}'
         if trees_by_utm.get(utm_values) is None:
             trees_by_utm[utm_values] = {"2017": [], "2020": []}
@@ -77,6 +71,54 @@ def _get_best_tree_from_treelist(tree_list: List[Dict[str, Any]]) -> Dict[str, A
 # with open("raw_trees_cologne_2020.jsonl") as f:
 #     trees_2020_list = f.read().split("\n")
 
+def merge_trees(trees_2017: List[Dict[str, Any]], trees_2020: List[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+    '''
+    Merged tree of the trees at the same utm coordinates (None if there are none)
+    '''
+    current_tree_2017: Optional[Dict[str, Any]] = None
+    current_tree_2020: Optional[Dict[str, Any]] = None
+
+    try:
+        current_tree_2017 = _get_best_tree_from_treelist(trees_2017)
+    except:
+        pass
+
+    try:
+        current_tree_2020 = _get_best_tree_from_treelist(trees_2020)
+    except:
+        pass
+
+    tmp_merged: Dict[str, Any] = {}
+
+    available_in_dataset = {
+        "2017": False if current_tree_2017 is None else True,
+        "2020": False if current_tree_2020 is None else True
+    }
+
+    if available_in_dataset["2017"] != available_in_dataset["2020"]:  # xor
+        # ***
+        # tree only in one of both sets
+        if available_in_dataset["2017"] is True:
+            tmp_merged = current_tree_2017
+        else:
+            tmp_merged = current_tree_2020
+    else:
+        # ***
+        # tree in both sets: prefer 2020 if equal complete, otherwise take best
+        if current_tree_2017["dataset_completeness"] == current_tree_2020["dataset_completeness"]:
+            tmp_merged = current_tree_2020
+        else:
+            tmp_merged = _get_best_tree_from_treelist([current_tree_2017, current_tree_2020])
+
+    # ***
+    #
+    try:
+        tmp_merged["found_in_dataset"]: Dict[str, bool] = available_in_dataset
+        return tmp_merged
+    except:
+        return None
+
+
 def merge_datasets(trees_data: Dict[str, List[Dict[str, Any]]]) -> List[Dict[str, Any]]:
     trees_by_utm: Dict[str, List[Dict[str, Any]]] = _add_to_list(trees_data["2017"], "2017", {})
     trees_by_utm = _add_to_list(trees_data["2020"], "2020", trees_by_utm)
@@ -84,48 +126,9 @@ def merge_datasets(trees_data: Dict[str, List[Dict[str, Any]]]) -> List[Dict[str
     merged_data: List[Dict[str, Any]] = []
 
     for utm_key, utm_vals in trees_by_utm.items():
-        current_tree_2017: Optional[Dict[str, Any]] = None
-        current_tree_2020: Optional[Dict[str, Any]] = None
-        
-        try:
-            current_tree_2017 = _get_best_tree_from_treelist(utm_vals["2017"])
-        except:
-            pass
-
-        try:
-            current_tree_2020 = _get_best_tree_from_treelist(utm_vals["2020"])
-        except:
-            pass
-        
-        tmp_merged: Dict[str, Any] = {}
-
-        available_in_dataset = {
-            "2017": False if current_tree_2017 is None else True,
-            "2020": False if current_tree_2020 is None else True
-        }
-
-        if available_in_dataset["2017"] != available_in_dataset["2020"]:  # xor
-            # ***
-            # tree only in one of both sets
-            if available_in_dataset["2017"] is True:
-                tmp_merged = current_tree_2017
-            else:
-                tmp_merged = current_tree_2020
-        else:
-            # ***
-            # tree in both sets: prefer 2020 if equal complete, otherwise take best
-            if current_tree_2017["dataset_completeness"] == current_tree_2020["dataset_completeness"]:
-                tmp_merged = current_tree_2020
-            else:
-                tmp_merged = _get_best_tree_from_treelist([current_tree_2017, current_tree_2020])
-
-        # ***
-        #
-        try:
-            tmp_merged["found_in_dataset"]: Dict[str, bool] = available_in_dataset
+        tmp_merged = merge_trees(utm_vals["2017"], utm_vals["2020"])
+        if tmp_merged is not None:
             merged_data.append(tmp_merged)
-        except:
-            continue
 
     return merged_data
 
@@ -0,0 +1,106 @@
+'''
+Assign the nearest OSM highway way (street) to each tree.
+
+The unbuffered highway lines from /data/geo_data/osm/highway are projected to UTM (zone 32U, same as the
+tree coordinates) and put into one STRtree. All trees are then matched in a single bulk nearest query.
+'''
+import json
+import os
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+from shapely import STRtree, linestrings, points
+import utm
+
+
+OSM_HIGHWAY_DIR = "../data/geo_data/osm/highway"
+
+HIGHWAY_PROPERTIES: List[Dict[str, Any]] = []
+HIGHWAY_INDEX: Optional[STRtree] = None
+
+
+def get_highway_data() -> None:
+    '''
+    Load each highway way once (suburb files overlap at their borders) and build the spatial index.
+    Closed ways (i.e. roundabouts, pedestrian areas) are stored as Polygon: use their outline as line.
+    '''
+    global HIGHWAY_INDEX
+
+    if HIGHWAY_INDEX is not None:  # already loaded
+        return
+
+    seen_osm_ids = set()
+    line_coordinates: List[List[List[float]]] = []
+
+    for file_name in sorted(os.listdir(OSM_HIGHWAY_DIR)):
+        try:
+            with open(f"{OSM_HIGHWAY_DIR}/{file_name}") as f:
+                suburb_data = json.load(f)
+        except:
+            continue
+
+        for osm_element in suburb_data["features"]:
+            osm_id = osm_element["properties"]["osm_id"]
+            if osm_id in seen_osm_ids:
+                continue
+
+            if osm_element["geometry"]["type"] == "LineString":
+                coordinates = osm_element["geometry"]["coordinates"]
+            elif osm_element["geometry"]["type"] == "Polygon":
+                coordinates = osm_element["geometry"]["coordinates"][0]
+            else:
+                continue
+
+            if len(coordinates) < 2:
+                continue
+
+            seen_osm_ids.add(osm_id)
+            line_coordinates.append(coordinates)
+            HIGHWAY_PROPERTIES.append({
+                "osm_id": osm_id,
+                "type": osm_element["properties"]["type"],
+                "name": osm_element["properties"]["name"],
+            })
+
+    if len(line_coordinates) == 0:  # no highway data: HIGHWAY_INDEX stays None (no nearest roads)
+        return
+
+    # ***
+    # project all coordinates in one call (lng, lat -> utm x, y)
+    line_indices = np.repeat(np.arange(len(line_coordinates)), [len(x) for x in line_coordinates])
+    lng_lat = np.array([pair for coordinates in line_coordinates for pair in coordinates], dtype=float)
+    utm_x, utm_y, _, _ = utm.from_latlon(lng_lat[:, 1], lng_lat[:, 0], force_zone_number=32, force_zone_letter="U")
+
+    lines = linestrings(np.column_stack([utm_x, utm_y]), indices=line_indices)
+    HIGHWAY_INDEX = STRtree(lines)
+
+
+def get_tree_nearest_roads(tree_data_list: List[Dict[str, Any]], max_distance: Optional[float] = None) -> List[Dict[str, Any]]:
+    '''
+    Adds "nearest_road" to each tree:
+    {"distance": 4.12, "osm_id": 25496381, "type": "residential", "name": "Burgwiesenstraße"}
+
+    or None (no highway data loaded or no way within max_distance meter)
+    '''
+    for tree_data in tree_data_list:
+        tree_data["nearest_road"]: Optional[Dict[str, Any]] = None
+
+    if HIGHWAY_INDEX is None or len(tree_data_list) == 0:
+        return tree_data_list
+
+    tree_points = points(
+        np.array([tree_data["geo_info"]["utm_x"] for tree_data in tree_data_list], dtype=float),
+        np.array([tree_data["geo_info"]["utm_y"] for tree_data in tree_data_list], dtype=float)
+    )
+
+    (tree_indices, line_indices), distances = HIGHWAY_INDEX.query_nearest(
+        tree_points, max_distance=max_distance, return_distance=True, all_matches=False
+    )
+
+    for tree_index, line_index, distance in zip(tree_indices, line_indices, distances):
+        tree_data_list[tree_index]["nearest_road"] = {
+            "distance": round(float(distance), 2),
+            **HIGHWAY_PROPERTIES[line_index]
+        }
+
+    return tree_data_list
@@ -0,0 +1,193 @@
+'''
+Neighbour graph of all trees up to a maximum radius, computed in one indexed pass.
+
+The candidates are found with an STRtree (dwithin on the UTM coordinates, with some slack), the exact
+distances are computed with the same haversine formula as _tree_neighbours. The graph is stored in
+compressed sparse row form (one row per tree, neighbours sorted by distance), hence any smaller radius
+or the k nearest neighbours can be sliced out afterwards without recomputation:
+
+    graph = load_neighbour_graph()
+    close_pairs = get_close_pairs(graph)
+    all_pairs_25m = get_neighbour_pairs(graph, radius=25)
+    all_pairs_10_nearest = get_neighbour_pairs(graph, k=10)
+
+Like process_tree_neighbours, trees without suburb (outside of Cologne) are not part of the graph.
+'''
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+from shapely import STRtree, points
+
+from _tmp_data import TMP_DATA_DIR
+from _tree_neighbours import MIN_TREE_DISTANCE
+
+
+NEIGHBOUR_RADII = [10, 25, 50, 100]  # in meter, the graph is built up to the largest one
+NEIGHBOUR_GRAPH_FILE = "neighbours_graph.npz"
+QUERY_CHUNK_SIZE = 20000  # trees per STRtree query: bounds memory of the candidate pairs
+
+# UTM (planar) and haversine (sphere) distances differ by less than 1% in Cologne
+SEARCH_SLACK_FACTOR = 1.01
+SEARCH_SLACK_METER = 1
+
+
+def _haversine(lng_1: np.ndarray, lat_1: np.ndarray, lng_2: np.ndarray, lat_2: np.ndarray) -> np.ndarray:
+    ''' vectorized _tree_neighbours._haversine: distance in meter '''
+    lng_1, lat_1, lng_2, lat_2 = map(np.radians, [lng_1, lat_1, lng_2, lat_2])
+
+    a = np.sin((lat_2 - lat_1) / 2)**2 + np.cos(lat_1) * np.cos(lat_2) * np.sin((lng_2 - lng_1) / 2)**2
+    return 2 * np.arcsin(np.sqrt(a)) * 6371 * 1000
+
+
+def iter_neighbour_edges(
+    utm_x: np.ndarray,
+    utm_y: np.ndarray,
+    lat: np.ndarray,
+    lng: np.ndarray,
+    max_radius: float = max(NEIGHBOUR_RADII)
+) -> Iterator[Tuple[np.ndarray, np.ndarray, np.ndarray]]:
+    '''
+    Edges (row, neighbour row, distance) within max_radius meter, QUERY_CHUNK_SIZE rows at a time
+    (unsorted, each pair in both directions)
+    '''
+    tree_points = points(utm_x, utm_y)
+    tree_index = STRtree(tree_points)
+    search_distance = max_radius * SEARCH_SLACK_FACTOR + SEARCH_SLACK_METER
+
+    for start in range(0, len(tree_points), QUERY_CHUNK_SIZE):
+        chunk_rows, chunk_columns = tree_index.query(
+            tree_points[start:start+QUERY_CHUNK_SIZE], predicate="dwithin", distance=search_distance
+        )
+        chunk_rows = chunk_rows + start
+
+        # ***
+        # exact distance of the candidates (without the tree itself)
+        is_other_tree = chunk_rows != chunk_columns
+        chunk_rows, chunk_columns = chunk_rows[is_other_tree], chunk_columns[is_other_tree]
+        chunk_distances = np.round(_haversine(lng[chunk_rows], lat[chunk_rows], lng[chunk_columns], lat[chunk_columns]), 2)
+
+        is_in_radius = chunk_distances <= max_radius
+        yield chunk_rows[is_in_radius], chunk_columns[is_in_radius], chunk_distances[is_in_radius]
+
+        print(f"  {min(start+QUERY_CHUNK_SIZE, len(tree_points))} / {len(tree_points)} trees")
+
+
+def build_neighbour_graph(merged_data: List[Dict[str, Any]], max_radius: float = max(NEIGHBOUR_RADII), k: Optional[int] = None) -> Dict[str, np.ndarray]:
+    '''
+    Neighbours within max_radius meter of each tree (if k is given: only the k nearest of these).
+
+    Returns the graph in compressed sparse row form:
+    - tree_ids: id of each row
+    - indptr: neighbours of row i are at indptr[i]:indptr[i+1]
+    - indices: row of the neighbour
+    - distances: in meter (rounded to cm), ascending within each row
+    '''
+    trees = [
+        tree_data for tree_data in merged_data
+        if tree_data["geo_info"]["suburb_id"] is not None and tree_data["geo_info"]["lat"] is not None
+    ]
+
+    tree_ids = np.array([tree_data["tree_id"] for tree_data in trees])
+    utm_x = np.array([tree_data["geo_info"]["utm_x"] for tree_data in trees], dtype=float)
+    utm_y = np.array([tree_data["geo_info"]["utm_y"] for tree_data in trees], dtype=float)
+    lat = np.array([tree_data["geo_info"]["lat"] for tree_data in trees], dtype=float)
+    lng = np.array([tree_data["geo_info"]["lng"] for tree_data in trees], dtype=float)
+
+    rows: List[np.ndarray] = []
+    columns: List[np.ndarray] = []
+    distances: List[np.ndarray] = []
+
+    for chunk_rows, chunk_columns, chunk_distances in iter_neighbour_edges(utm_x, utm_y, lat, lng, max_radius):
+        rows.append(chunk_rows)
+        columns.append(chunk_columns)
+        distances.append(chunk_distances)
+
+    all_rows = np.concatenate(rows) if len(rows) > 0 else np.array([], dtype=np.int64)
+    all_columns = np.concatenate(columns) if len(columns) > 0 else np.array([], dtype=np.int64)
+    all_distances = np.concatenate(distances) if len(distances) > 0 else np.array([], dtype=float)
+
+    # ***
+    # sort by row, then by distance
+    order = np.lexsort((all_distances, all_rows))
+    all_rows, all_columns, all_distances = all_rows[order], all_columns[order], all_distances[order]
+
+    if k is not None:
+        is_k_nearest = _get_rank_in_row(all_rows) < k
+        all_rows, all_columns, all_distances = all_rows[is_k_nearest], all_columns[is_k_nearest], all_distances[is_k_nearest]
+
+    indptr = np.zeros(len(trees) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(all_rows, minlength=len(trees)), out=indptr[1:])
+
+    return {
+        "tree_ids": tree_ids,
+        "indptr": indptr,
+        "indices": all_columns.astype(np.int32),
+        "distances": all_distances,
+    }
+
+
+def _get_rank_in_row(rows: np.ndarray) -> np.ndarray:
+    ''' position of each entry within its row (rows sorted) '''
+    if len(rows) == 0:
+        return np.array([], dtype=np.int64)
+    row_starts = np.flatnonzero(np.r_[True, rows[1:] != rows[:-1]])
+    row_lengths = np.diff(np.r_[row_starts, len(rows)])
+    return np.arange(len(rows)) - np.repeat(row_starts, row_lengths)
+
+
+def slice_neighbour_graph(
+    graph: Dict[str, np.ndarray],
+    radius: Optional[float] = None,
+    k: Optional[int] = None,
+    min_distance: float = 0
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    '''
+    Edges (row, neighbour row, distance) with min_distance <= distance <= radius, and (if k is given)
+    only the k nearest neighbours of each tree. Each pair appears in both directions (unless only
+    one of the trees is among the k nearest of the other).
+    '''
+    rows = np.repeat(np.arange(len(graph["tree_ids"])), np.diff(graph["indptr"]))
+    is_selected = graph["distances"] >= min_distance
+    if radius is not None:
+        is_selected &= graph["distances"] <= radius
+    if k is not None:
+        is_selected &= _get_rank_in_row(rows) < k
+
+    return rows[is_selected], graph["indices"][is_selected], graph["distances"][is_selected]
+
+
+def _to_pair_list(graph: Dict[str, np.ndarray], rows: np.ndarray, columns: np.ndarray, distances: np.ndarray) -> List[List[Any]]:
+    ''' each pair once: [tree_id_1, tree_id_2, distance] (format of process_tree_neighbours) '''
+    first, second = np.minimum(rows, columns), np.maximum(rows, columns)
+    _, unique_indices = np.unique(first.astype(np.int64) * len(graph["tree_ids"]) + second, return_index=True)
+
+    tree_ids = graph["tree_ids"]
+    return [
+        [str(tree_ids[first[i]]), str(tree_ids[second[i]]), float(distances[i])] for i in unique_indices
+    ]
+
+
+def get_neighbour_pairs(
+    graph: Dict[str, np.ndarray],
+    radius: Optional[float] = None,
+    k: Optional[int] = None,
+    min_distance: float = MIN_TREE_DISTANCE
+) -> List[List[Any]]:
+    ''' pairs of neighbouring trees (without the ones which are too close) '''
+    return _to_pair_list(graph, *slice_neighbour_graph(graph, radius, k, min_distance))
+
+
+def get_close_pairs(graph: Dict[str, np.ndarray], min_tree_distance: float = MIN_TREE_DISTANCE) -> List[List[Any]]:
+    ''' pairs of trees closer than min_tree_distance (probably the same tree) '''
+    rows, columns, distances = slice_neighbour_graph(graph)
+    is_close = distances < min_tree_distance
+    return _to_pair_list(graph, rows[is_close], columns[is_close], distances[is_close])
+
+
+def save_neighbour_graph(graph: Dict[str, np.ndarray], file_name: str = NEIGHBOUR_GRAPH_FILE) -> None:
+    np.savez(f"{TMP_DATA_DIR}/{file_name}", **graph)
+
+
+def load_neighbour_graph(file_name: str = NEIGHBOUR_GRAPH_FILE) -> Dict[str, np.ndarray]:
+    with np.load(f"{TMP_DATA_DIR}/{file_name}") as f:
+        return {key: f[key] for key in ["tree_ids", "indptr", "indices", "distances"]}
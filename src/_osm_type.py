@@ -1,27 +1,32 @@
-import json
 import os
-from typing import Any, Dict, List, Optional, Tuple
+from typing import Any, Callable, Dict, List, Optional, Tuple
 
 import requests
 from shapely.geometry import LineString, Point, Polygon
 from slugify import slugify
 
+from _json_codec import load
+from _partition import get_worker_context, run_partitioned
+from _shared_arrays import get_tree_arrays
+
 
 OSM_DATA_DIR = "../data/geo_data/osm_buffer"
+OSM_SIMPLIFIED_DATA_DIR = "../data/geo_data/osm_buffer_simplified"  # see osm/simplify_buffer.py
 SUBURBS_GEOJSON: Dict[str, Any] = {}
 
 
-def get_suburb_data() -> None:
+def get_suburb_data(data_dir: str = OSM_DATA_DIR) -> None:
     global SUBURBS_GEOJSON
 
+    SUBURBS_GEOJSON.clear()  # i.e. when switching to the simplified layers
     for dir_name in ["green_spaces_leisure", "green_spaces_agriculture", "highway"]:
-        file_names = os.listdir(f"{OSM_DATA_DIR}/{dir_name}")
+        file_names = os.listdir(f"{data_dir}/{dir_name}")
         for file_name in file_names:
             district_suburb_name = file_name.split(".")[0]
             
             try:
-                with open(f"{OSM_DATA_DIR}/{dir_name}/{file_name}") as f:
-                    suburb_data = json.load(f)
+                with open(f"{data_dir}/{dir_name}/{file_name}") as f:
+                    suburb_data = load(f)
             except:
                continue
 
@@ -33,38 +38,132 @@ def get_suburb_data() -> None:
             SUBURBS_GEOJSON[district_suburb_name][dir_name] = suburb_data
 
 
+def get_district_suburb_data(district_suburb: str, data_dir: str = OSM_DATA_DIR) -> None:
+    '''
+    Only the OSM layers of one suburb (out-of-core mode: one suburb after another)
+    '''
+    SUBURBS_GEOJSON.clear()
+    for dir_name in ["green_spaces_leisure", "green_spaces_agriculture", "highway"]:
+        try:
+            with open(f"{data_dir}/{dir_name}/{district_suburb}.json") as f:
+                suburb_data = load(f)
+        except:
+            continue
+
+        if SUBURBS_GEOJSON.get(district_suburb) is None:
+            SUBURBS_GEOJSON[district_suburb] = {}
+        SUBURBS_GEOJSON[district_suburb][dir_name] = suburb_data
+
+
+def get_district_suburb_slug(district: str, suburb: str) -> str:
+    ''' file name of the OSM layers of a suburb (without .json) '''
+    return f"{slugify(district, replace_latin=True)}_{slugify(suburb, replace_latin=True)}"
+
+
+def _get_tree_location_type(district_suburb: str, tree_lat: float, tree_lng: float) -> Optional[Dict[str, Any]]:
+    tree_location_type: Optional[Dict[str, Any]] = None
+    tree_point = Point(tree_lng, tree_lat)
+    
+    for location_category in SUBURBS_GEOJSON[district_suburb]:
+        area_intersection = _check_suburb_polygons(SUBURBS_GEOJSON[district_suburb][location_category], tree_point, location_category)
+        
+        if area_intersection is not None:
+            if tree_location_type is None:
+                tree_location_type = {}
+            tree_location_type[location_category] = area_intersection
+    
+    return tree_location_type
+
+
+def _set_tree_location_type(tree_data: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    '''
+    Adds tree_location_type to tree_data or returns None if there is no OSM data of the tree suburb.
+    '''
+    tree_district_suburb = get_district_suburb_slug(tree_data["geo_info"]["district"], tree_data["geo_info"]["suburb"])
+
+    # define new attribute
+    tree_data["tree_location_type"]: Optional[Dict[str, Any]] = None
+
+    if SUBURBS_GEOJSON.get(tree_district_suburb) is None:
+        return None
+
+    tree_data["tree_location_type"] = _get_tree_location_type(tree_district_suburb, tree_data["geo_info"]["lat"], tree_data["geo_info"]["lng"])
+    return tree_data
+
+
 def get_tree_location_types(tree_data_list: List[Dict[str, Any]]) ->  List[Dict[str, Any]]:
     new_tree_data_list: List[Dict[str, Any]] = []
     
     for tree_data in tree_data_list:
-        tree_district_slug = slugify(tree_data["geo_info"]["district"], replace_latin=True)
-        tree_suburb_slug = slugify(tree_data["geo_info"]["suburb"], replace_latin=True)
-        tree_district_suburb = f"{tree_district_slug}_{tree_suburb_slug}"
+        if _set_tree_location_type(tree_data) is None:
+            continue
+        new_tree_data_list.append(tree_data)
 
-        tree_lat = tree_data["geo_info"]["lat"]
-        tree_lng = tree_data["geo_info"]["lng"]
+    return new_tree_data_list
 
-        # define new attribute
-        tree_data["tree_location_type"]: Optional[Dict[str, Any]] = None
 
-        if SUBURBS_GEOJSON.get(tree_district_suburb) is None:
-            continue
+def get_partition_location_types(tree_data_list: List[Dict[str, Any]]) -> List[Optional[Dict[str, Any]]]:
+    '''
+    For _partition.run_partitioned: same as get_tree_location_types, but None for trees without OSM data
+    '''
+    return [_set_tree_location_type(tree_data) for tree_data in tree_data_list]
 
-        tree_point = Point(tree_lng, tree_lat)
-        
-        for location_category in SUBURBS_GEOJSON[tree_district_suburb]:
-            area_intersection = _check_suburb_polygons(SUBURBS_GEOJSON[tree_district_suburb][location_category], tree_point, location_category)
-            
-            if area_intersection is not None:
-                if tree_data["tree_location_type"] is None:
-                    tree_data["tree_location_type"] = {}
-                if tree_data["tree_location_type"].get(location_category) is None:
-                    tree_data["tree_location_type"][location_category] = {}
-                tree_data["tree_location_type"][location_category] = area_intersection
-            
-        new_tree_data_list.append(tree_data)
 
-    return new_tree_data_list
+def get_array_location_types(tree_rows: List[int]) -> List[Optional[Tuple[int, Optional[Dict[str, Any]]]]]:
+    '''
+    For run_location_types: (row, tree_location_type) of each tree, None for trees without OSM data
+    '''
+    context = get_worker_context()
+    arrays = context["arrays"]
+
+    results: List[Optional[Tuple[int, Optional[Dict[str, Any]]]]] = []
+    for row in tree_rows:
+        district_suburb = context["district_suburb_by_code"][int(arrays["suburb"][row])]
+        if SUBURBS_GEOJSON.get(district_suburb) is None:
+            results.append(None)
+            continue
+        results.append((row, _get_tree_location_type(district_suburb, float(arrays["lat"][row]), float(arrays["lng"][row]))))
+
+    return results
+
+
+def run_location_types(
+    tree_data_list: List[Dict[str, Any]],
+    location_function: Callable[[List[int]], List[Any]],
+    context_init: Callable[[], None],
+    workers: Optional[int] = None
+) -> List[Dict[str, Any]]:
+    '''
+    Same as run_partitioned(get_partition_location_types, ...), but the workers only get the rows of the tree arrays
+    (_shared_arrays.get_tree_arrays, memory-mapped) instead of pickled trees and return only the location types.
+    location_function: get_array_location_types or _location_raster.get_array_raster_location_types (context_init
+    loads their OSM layers resp. rasters)
+    '''
+    arrays = get_tree_arrays(tree_data_list)
+
+    # ***
+    # slug of each suburb code (-1: no suburb)
+    district_suburb_by_code: Dict[int, str] = {}
+    for tree_data, code in zip(tree_data_list, arrays["suburb"].tolist()):
+        if code not in district_suburb_by_code:
+            district_suburb_by_code[code] = get_district_suburb_slug(tree_data["geo_info"]["district"], tree_data["geo_info"]["suburb"])
+
+    tree_locations = run_partitioned(
+        location_function,
+        list(range(len(tree_data_list))),
+        get_partition_key=lambda row: tree_data_list[row]["geo_info"]["suburb_id"],
+        context={"district_suburb_by_code": district_suburb_by_code},
+        context_init=context_init,
+        workers=workers,
+        arrays=arrays
+    )
+
+    located_trees: List[Dict[str, Any]] = []
+    for row, tree_location_type in tree_locations:
+        tree_data_list[row]["tree_location_type"] = tree_location_type
+        located_trees.append(tree_data_list[row])
+
+    return located_trees
 
 
 # **************************
@@ -86,7 +185,7 @@ def _check_suburb_polygons(suburb_data: Dict[str, Any], tree_point: Point, locat
     for osm_element in suburb_data["features"]:
         area_bbox_polygon = _get_area_bounding_box(osm_element["properties"]["bounding_box"])
         area_geometry_type = osm_element["geometry"]["type"]
-        area_geometry = Polygon(osm_element["geometry"]["coordinates"][0])
+        area_geometry = Polygon(osm_element["geometry"]["coordinates"][0], osm_element["geometry"]["coordinates"][1:])  # holes: dissolved
         area_properties = osm_element["properties"]
 
         # skip if not in broad bounding box of feature
@@ -94,15 +193,19 @@ def _check_suburb_polygons(suburb_data: Dict[str, Any], tree_point: Point, locat
             continue
 
         if tree_point.within(area_geometry) is True:  # stop at first fiunding
-            return {
-                "category": location_category,
-                "type": area_properties["type"],
-                "name": area_properties["name"],
-                "osm_id": area_properties["osm_id"],
-                "wikidata_id": area_properties["wikidata_id"],
-            }
+            return get_location_type(area_properties, location_category)
 
     return None
+
+
+def get_location_type(area_properties: Dict[str, Any], location_category: str) -> Dict[str, Any]:
+    return {
+        "category": location_category,
+        "type": area_properties["type"],
+        "name": area_properties["name"],
+        "osm_id": area_properties["osm_id"],
+        "wikidata_id": area_properties["wikidata_id"],
+    }
         
 
 
@@ -0,0 +1,249 @@
+'''
+Parameter sweep of the predictions: evaluate a grid of
+- MIN_TREE_DISTANCE (clean up of close pairs, min. distance of neighbours), RADIUS (neighbours)
+- MIN_SAMPLES, DBSCAN_EPS (predictions/_clustered_neighbour_trees.py)
+- PREDICTION_CUTOFF (min. probability of a prediction in the reduced export, _export.py)
+without rerunning the process chain for each setting.
+
+The neighbour graph (stored by the neighbours stage up to 100 m) is sliced for each MIN_TREE_DISTANCE / RADIUS,
+the clean up is done on the close pairs only. Held-out trees (random sample of the trees with genus and age group)
+are predicted like trees without features, their known genus and age group are compared with the predictions:
+- coverage: share of the held-out trees with a prediction of at least the cutoff probability
+- accuracy: share of the covered trees with the right genus resp. age group
+- seconds: predicting the held-out trees with this setting (the neighbourhoods are shared by the settings
+  with the same MIN_TREE_DISTANCE / RADIUS, evaluated in parallel by neighbourhood)
+
+Held-out trees skipped by the clean up count as not covered. The report is saved to /data/tmp/parameter_sweep.json.
+
+Usage (after the neighbours stage):
+$ python _parameter_sweep.py --holdout 2000 --workers 4
+$ python _parameter_sweep.py --min-samples 3 5 --eps 0.3 --cutoff 0.5 --min-tree-distance 3 --radius 25 50
+'''
+import argparse
+from datetime import datetime
+import json
+import os
+from typing import Any, Dict, List, Optional, Set
+
+import numpy as np
+
+from _export import PREDICTION_CUTOFF
+from _neighbour_graph import NEIGHBOUR_GRAPH_FILE, NEIGHBOUR_RADII, build_neighbour_graph, get_close_pairs, load_neighbour_graph, save_neighbour_graph
+from _partition import get_worker_context, run_partitioned
+from _predict_genus_age import _get_reduced_data
+from _tmp_data import TMP_DATA_DIR, load_list_tmp_data
+from _tree_neighbours import MIN_TREE_DISTANCE, RADIUS, get_skipped_tree_ids
+from predictions._clustered_neighbour_trees import DBSCAN_EPS, MIN_SAMPLES, _predict_tree, encode_tree_features
+
+
+SWEEP_FILE = "parameter_sweep.json"
+HOLDOUT_SIZE = 2000
+HOLDOUT_SEED = 42
+
+# ***
+# default grid (the current values included)
+MIN_SAMPLES_GRID = [3, MIN_SAMPLES, 8]
+EPS_GRID = [0.1, DBSCAN_EPS, 0.5]
+CUTOFF_GRID = [0.3, PREDICTION_CUTOFF, 0.7]
+MIN_TREE_DISTANCE_GRID = [1, 2, MIN_TREE_DISTANCE]
+RADIUS_GRID = [25, RADIUS]
+
+
+# *******
+# held-out trees and their neighbourhood
+# *******
+def _get_holdout_tree_ids(tree_features_by_id: Dict[str, Any], graph_tree_ids: List[str], holdout_size: int, seed: int) -> List[str]:
+    ''' random sample of the trees with features which are part of the graph (trees with suburb) '''
+    candidates = sorted(set(tree_features_by_id.keys()) & set(graph_tree_ids))
+    rng = np.random.default_rng(seed)
+    return [candidates[i] for i in sorted(rng.choice(len(candidates), min(holdout_size, len(candidates)), replace=False))]
+
+
+def _get_holdout_pairs(holdout_rows: List[int], min_tree_distance: float, radius: float) -> Dict[str, Dict[str, float]]:
+    ''' neighbours (id: distance) of each held-out tree, like _predict_genus_age._load_neighbour_pairs '''
+    arrays = get_worker_context()["arrays"]
+    tree_ids, indptr, indices, distances = arrays["tree_ids"], arrays["indptr"], arrays["indices"], arrays["distances"]
+
+    tree_pairs_by_id: Dict[str, Dict[str, float]] = {}
+    for row in holdout_rows:
+        row_distances = distances[indptr[row]:indptr[row+1]]
+        is_neighbour = (row_distances >= min_tree_distance) & (row_distances <= radius)
+        if not is_neighbour.any():
+            continue
+        tree_pairs_by_id[str(tree_ids[row])] = {
+            str(tree_ids[column]): float(distance)
+            for column, distance in zip(indices[indptr[row]:indptr[row+1]][is_neighbour], row_distances[is_neighbour])
+        }
+
+    return tree_pairs_by_id
+
+
+# *******
+# evaluation (in worker: all settings of one neighbourhood)
+# *******
+def _evaluate_setting(
+    setting: Dict[str, Any],
+    tree_features_by_id: Dict[str, Any],
+    tree_pairs_by_id: Dict[str, Dict[str, float]],
+    skipped_tree_ids: Set[str]
+) -> List[Dict[str, Any]]:
+    ''' one result per cutoff '''
+    context = get_worker_context()
+    holdout_truth: Dict[str, Dict[str, Any]] = context["holdout_truth"]
+
+    start = datetime.now()
+    predictions: Dict[str, Optional[Dict[str, Any]]] = {}
+    for tree_id in holdout_truth.keys():
+        if tree_id in skipped_tree_ids or tree_pairs_by_id.get(tree_id) is None:
+            continue
+        predictions[tree_id] = _predict_tree(
+            tree_id, tree_features_by_id, tree_pairs_by_id, context["label_encoder"], setting["min_samples"], setting["eps"]
+        )
+    seconds = (datetime.now() - start).total_seconds()
+
+    results: List[Dict[str, Any]] = []
+    for cutoff in context["cutoffs"]:
+        result: Dict[str, Any] = {**setting, "cutoff": cutoff, "seconds": round(seconds, 2)}
+        for key in ["genus", "age_group"]:
+            covered = [
+                tree_id for tree_id, prediction in predictions.items()
+                if prediction is not None and prediction.get(key) is not None and prediction[key]["probability"] >= cutoff
+            ]
+            correct = [x for x in covered if predictions[x][key]["prediction"] == holdout_truth[x][key]]
+            result[f"{key}_coverage"] = round(len(covered) / len(holdout_truth), 4) if len(holdout_truth) > 0 else 0.0
+            result[f"{key}_accuracy"] = round(len(correct) / len(covered), 4) if len(covered) > 0 else None
+        results.append(result)
+
+    return results
+
+
+def _evaluate_partition(settings: List[Dict[str, Any]]) -> List[List[Dict[str, Any]]]:
+    '''
+    For _partition.run_partitioned: settings with the same min_tree_distance and radius (one neighbourhood)
+    '''
+    context = get_worker_context()
+    min_tree_distance, radius = settings[0]["min_tree_distance"], settings[0]["radius"]
+
+    # ***
+    # clean up of close pairs (same order as get_close_pairs(graph, min_tree_distance)), held-out trees unlabelled
+    close_pairs = [x for x in context["close_pairs"] if x[2] < min_tree_distance]
+    skipped_tree_ids = set(get_skipped_tree_ids(context["close_tree_dict"], close_pairs))
+
+    tree_features_by_id = {
+        tree_id: features for tree_id, features in context["tree_features_by_id"].items()
+        if tree_id not in skipped_tree_ids and tree_id not in context["holdout_truth"]
+    }
+    tree_pairs_by_id = _get_holdout_pairs(context["holdout_rows"], min_tree_distance, radius)
+
+    return [_evaluate_setting(setting, tree_features_by_id, tree_pairs_by_id, skipped_tree_ids) for setting in settings]
+
+
+# *******
+#
+# *******
+def run_parameter_sweep(
+    min_samples_grid: List[int] = MIN_SAMPLES_GRID,
+    eps_grid: List[float] = EPS_GRID,
+    cutoff_grid: List[float] = CUTOFF_GRID,
+    min_tree_distance_grid: List[float] = MIN_TREE_DISTANCE_GRID,
+    radius_grid: List[float] = RADIUS_GRID,
+    holdout_size: int = HOLDOUT_SIZE,
+    seed: int = HOLDOUT_SEED,
+    workers: Optional[int] = None
+) -> List[Dict[str, Any]]:
+    if max(radius_grid) > max(NEIGHBOUR_RADII):
+        raise ValueError(f"radius {max(radius_grid)}: the neighbour graph reaches {max(NEIGHBOUR_RADII)} m")
+
+    merged_data = load_list_tmp_data("data_merged.jsonln")
+
+    if os.path.exists(f"{TMP_DATA_DIR}/{NEIGHBOUR_GRAPH_FILE}"):
+        graph = load_neighbour_graph()
+    else:
+        graph = build_neighbour_graph(merged_data)
+        save_neighbour_graph(graph)
+
+    # ***
+    # features of all trees (held-out trees are removed per neighbourhood), truth of the held-out trees
+    tree_features_by_id, label_encoder, _, _ = encode_tree_features(_get_reduced_data(merged_data))
+    graph_tree_ids = [str(x) for x in graph["tree_ids"]]
+    holdout_tree_ids = _get_holdout_tree_ids(tree_features_by_id, graph_tree_ids, holdout_size, seed)
+    holdout_truth = {
+        tree_id: {
+            "genus": label_encoder.inverse_transform([int(tree_features_by_id[tree_id]["encoded_genus"])])[0],
+            "age_group": int(tree_features_by_id[tree_id]["age_group_2020"]),
+        } for tree_id in holdout_tree_ids
+    }
+    row_by_tree_id = {tree_id: i for i, tree_id in enumerate(graph_tree_ids)}
+
+    # ***
+    # close pairs up to the largest min_tree_distance: only their trees are needed for the clean up
+    close_pairs = get_close_pairs(graph, max(min_tree_distance_grid))
+    close_tree_ids = set(x[0] for x in close_pairs) | set(x[1] for x in close_pairs)
+    close_tree_dict = {x["tree_id"]: x for x in merged_data if x["tree_id"] in close_tree_ids}
+    del merged_data
+
+    settings = [
+        {"min_tree_distance": min_tree_distance, "radius": radius, "min_samples": min_samples, "eps": eps}
+        for min_tree_distance in min_tree_distance_grid
+        for radius in radius_grid
+        for min_samples in min_samples_grid
+        for eps in eps_grid
+    ]
+    print(f"{len(settings)} settings x {len(cutoff_grid)} cutoffs, {len(holdout_tree_ids)} held-out trees")
+
+    start = datetime.now()
+    setting_results = run_partitioned(
+        _evaluate_partition,
+        settings,
+        get_partition_key=lambda x: (x["min_tree_distance"], x["radius"]),
+        context={
+            "tree_features_by_id": tree_features_by_id,
+            "label_encoder": label_encoder,
+            "holdout_truth": holdout_truth,
+            "holdout_rows": [row_by_tree_id[x] for x in holdout_tree_ids],
+            "close_pairs": close_pairs,
+            "close_tree_dict": close_tree_dict,
+            "cutoffs": cutoff_grid,
+        },
+        workers=workers,
+        arrays={key: graph[key] for key in ["tree_ids", "indptr", "indices", "distances"]}
+    )
+    print(f"sweep: {datetime.now() - start}")
+
+    return [result for results in setting_results for result in results]
+
+
+def print_sweep_report(results: List[Dict[str, Any]]) -> None:
+    ''' sorted by genus accuracy x coverage (share of held-out trees with the right genus) '''
+    def _score(result: Dict[str, Any]) -> float:
+        return (result["genus_accuracy"] or 0) * result["genus_coverage"]
+
+    print(f"  {'min dist':>8} {'radius':>6} {'samples':>7} {'eps':>5} {'cutoff':>6} | {'genus acc':>9} {'cov':>6} | {'age acc':>7} {'cov':>6} | {'seconds':>7}")
+    for result in sorted(results, key=_score, reverse=True):
+        print(
+            f"  {result['min_tree_distance']:>8} {result['radius']:>6} {result['min_samples']:>7} {result['eps']:>5} {result['cutoff']:>6} | "
+            f"{result['genus_accuracy'] if result['genus_accuracy'] is not None else '-':>9} {result['genus_coverage']:>6} | "
+            f"{result['age_group_accuracy'] if result['age_group_accuracy'] is not None else '-':>7} {result['age_group_coverage']:>6} | "
+            f"{result['seconds']:>7}"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Evaluate a grid of prediction parameters against held-out trees.")
+    parser.add_argument("--min-samples", type=int, nargs="+", default=MIN_SAMPLES_GRID)
+    parser.add_argument("--eps", type=float, nargs="+", default=EPS_GRID)
+    parser.add_argument("--cutoff", type=float, nargs="+", default=CUTOFF_GRID)
+    parser.add_argument("--min-tree-distance", type=float, nargs="+", default=MIN_TREE_DISTANCE_GRID)
+    parser.add_argument("--radius", type=float, nargs="+", default=RADIUS_GRID)
+    parser.add_argument("--holdout", type=int, default=HOLDOUT_SIZE, help="number of held-out trees")
+    parser.add_argument("--seed", type=int, default=HOLDOUT_SEED)
+    parser.add_argument("--workers", type=int, default=None, help="max. number of processes (default: number of CPUs)")
+    args = parser.parse_args()
+
+    results = run_parameter_sweep(
+        args.min_samples, args.eps, args.cutoff, args.min_tree_distance, args.radius, args.holdout, args.seed, args.workers
+    )
+    print_sweep_report(results)
+
+    with open(f"{TMP_DATA_DIR}/{SWEEP_FILE}", "w") as f:
+        json.dump(results, f, indent=2)
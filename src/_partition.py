@@ -0,0 +1,99 @@
+'''
+Run a stage function over partitions of the tree list (by default: by geo_info.suburb_id) in a process pool.
+
+stage_function(partition) gets a list of trees (resp. items) of one partition and returns a list of
+results of the same length (None: drop this item). The results are reassembled in the order of the input.
+
+Read-only context (i.e. OSM layers, encoders, models) is shipped to each worker once when it starts:
+- context: dict with data, accessible in the stage function with get_worker_context()
+- context_init: function which is called once in each worker (i.e. to load OSM data from files)
+- arrays: dict of numpy arrays (i.e. _shared_arrays.get_tree_arrays), memory-mapped read-only in each worker
+  instead of being pickled: get_worker_context()["arrays"]. Items can then be integer ids (rows of the arrays).
+'''
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
+import os
+from typing import Any, Callable, Dict, List, Optional
+
+import numpy as np
+
+from _shared_arrays import load_shared_arrays, shared_arrays
+
+
+WORKER_CONTEXT: Dict[str, Any] = {}
+
+
+def _get_suburb_id(tree_data: Dict[str, Any]) -> Optional[str]:
+    return tree_data["geo_info"]["suburb_id"]
+
+
+def _init_worker(context: Dict[str, Any], context_init: Optional[Callable[[], None]], arrays_path: Optional[str] = None) -> None:
+    global WORKER_CONTEXT
+
+    WORKER_CONTEXT = context
+    if arrays_path is not None:
+        WORKER_CONTEXT["arrays"] = load_shared_arrays(arrays_path)
+    if context_init is not None:
+        context_init()
+
+
+def get_worker_context() -> Dict[str, Any]:
+    return WORKER_CONTEXT
+
+
+def split_into_partitions(items: List[Any], get_partition_key: Callable[[Any], Any] = _get_suburb_id) -> List[List[int]]:
+    '''
+    Indices of items per partition (partitions in order of first occurrence, indices in input order)
+    '''
+    partitions: Dict[Any, List[int]] = {}
+    for i, item in enumerate(items):
+        partition_key = get_partition_key(item)
+        if partitions.get(partition_key) is None:
+            partitions[partition_key] = []
+        partitions[partition_key].append(i)
+
+    return list(partitions.values())
+
+
+def run_partitioned(
+    stage_function: Callable[[List[Any]], List[Any]],
+    items: List[Any],
+    get_partition_key: Callable[[Any], Any] = _get_suburb_id,
+    context: Optional[Dict[str, Any]] = None,
+    context_init: Optional[Callable[[], None]] = None,
+    workers: Optional[int] = None,
+    arrays: Optional[Dict[str, np.ndarray]] = None
+) -> List[Any]:
+    context = dict(context) if context is not None else {}
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    partitions = split_into_partitions(items, get_partition_key)
+    results: List[Any] = [None] * len(items)
+
+    if workers <= 1 or len(partitions) <= 1:
+        if arrays is not None:
+            context["arrays"] = arrays
+        _init_worker(context, context_init)
+        partition_results = [stage_function([items[i] for i in partition]) for partition in partitions]
+    else:
+        # ***
+        # largest partitions first: keeps all workers busy until the end
+        partition_order = sorted(range(len(partitions)), key=lambda x: len(partitions[x]), reverse=True)
+
+        with (shared_arrays(arrays) if arrays is not None else nullcontext()) as arrays_path:
+            with ProcessPoolExecutor(
+                max_workers=workers, initializer=_init_worker, initargs=(context, context_init, arrays_path)
+            ) as executor:
+                futures = {
+                    x: executor.submit(stage_function, [items[i] for i in partitions[x]]) for x in partition_order
+                }
+                partition_results = [futures[x].result() for x in range(len(partitions))]
+
+    for partition, partition_result in zip(partitions, partition_results):
+        if len(partition) != len(partition_result):
+            raise ValueError(f"{stage_function.__name__}: expected {len(partition)} results, got {len(partition_result)}")
+        for i, result in zip(partition, partition_result):
+            results[i] = result
+
+    return [result for result in results if result is not None]
@@ -0,0 +1,248 @@
+'''
+Stage graph of the process chain and a scheduler running independent stages concurrently.
+
+Each stage declares the files (in /data/tmp resp. /data/exports) it reads and writes, the dependencies
+are derived from these. Stages whose inputs are complete run in parallel worker processes, i.e.
+- ingest_2017 and ingest_2020
+- predict and locate (location types only need the cleaned up merged data)
+- export_full, export_reduced (and export_flatgeobuf after the reduced data is created)
+
+The stages of the main chain (process_group "main": ingest_2020 -> merge -> neighbours -> predict -> combine) run
+one after another in the same dedicated worker process, hence they take their inputs out of the tmp data cache
+instead of rereading and parsing them (see _tmp_data.py), the other stages run in the pool of the remaining workers.
+
+After the run, a summary with the duration of each stage and the critical path is printed.
+'''
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from contextlib import ExitStack
+from datetime import datetime
+import os
+from typing import Any, Dict, List, Optional, Tuple
+
+import _stages
+from _tmp_data import flush_tmp_data
+
+
+PIPELINE_STAGES: List[Dict[str, Any]] = [  # in topological order
+    {
+        "name": "ingest_2017",
+        "run": _stages.ingest_2017,
+        "inputs": [],
+        "outputs": ["data_2017.jsonln"]
+    },
+    {
+        "name": "ingest_2020",
+        "run": _stages.ingest_2020,
+        "process_group": "main",
+        "inputs": [],
+        "outputs": ["data_2020.jsonln"]
+    },
+    {
+        "name": "merge",
+        "run": _stages.merge,
+        "process_group": "main",
+        "inputs": ["data_2017.jsonln", "data_2020.jsonln"],
+        "outputs": ["data_merged.jsonln"]
+    },
+    {
+        "name": "neighbours",
+        "run": _stages.neighbours,
+        "process_group": "main",
+        "inputs": ["data_merged.jsonln"],
+        "outputs": [
+            "neighbours_graph.npz", "neighbours_close_pairs.jsonln", "neighbours_all_pairs.jsonln",
+            "data_merged_cleanup.jsonln"
+        ]
+    },
+    {
+        "name": "predict",
+        "run": _stages.predict,
+        "process_group": "main",
+        "inputs": ["data_merged_cleanup.jsonln", "neighbours_all_pairs.jsonln"],
+        "outputs": ["data_merged_with_predictions.jsonln"]
+    },
+    {
+        "name": "locate",
+        "run": _stages.locate,
+        "inputs": ["data_merged_cleanup.jsonln"],
+        "outputs": ["tree_locations.jsonln"]
+    },
+    {
+        "name": "combine",
+        "run": _stages.combine,
+        "process_group": "main",
+        "inputs": ["data_merged_with_predictions.jsonln", "tree_locations.jsonln"],
+        "outputs": ["data_final.jsonln"]
+    },
+    {
+        "name": "export_full",
+        "run": _stages.export_full,
+        "inputs": ["data_final.jsonln"],
+        "outputs": ["trees_cologne.jsonln.tar.gz"]
+    },
+    {
+        "name": "export_reduced",
+        "run": _stages.export_reduced,
+        "inputs": ["data_final.jsonln"],
+        "outputs": ["data_final_reduced.jsonln", "trees_cologne_reduced.jsonln.tar.gz"]
+    },
+    {
+        "name": "export_flatgeobuf",
+        "run": _stages.export_flatgeobuf,
+        "inputs": ["data_final.jsonln", "data_final_reduced.jsonln"],
+        "outputs": ["trees_cologne.fgb", "trees_cologne_reduced.fgb"]
+    },
+    {
+        "name": "export_parquet",
+        "run": _stages.export_parquet,
+        "inputs": ["data_final.jsonln"],
+        "outputs": ["trees_cologne.parquet"]
+    },
+    {
+        "name": "export_sqlite",
+        "run": _stages.export_sqlite,
+        "inputs": ["data_final.jsonln"],
+        "outputs": ["trees_cologne.sqlite"]
+    },
+    {
+        "name": "aggregate",
+        "run": _stages.aggregate,
+        "inputs": ["data_final.jsonln"],
+        "outputs": ["trees_cologne_aggregates.json"]
+    },
+]
+
+
+def _get_stage(stage_name: str) -> Dict[str, Any]:
+    for stage in PIPELINE_STAGES:
+        if stage["name"] == stage_name:
+            return stage
+    raise KeyError(f"unknown stage: {stage_name}")
+
+
+def get_stage_dependencies(stage_names: List[str]) -> Dict[str, List[str]]:
+    '''
+    Dependencies of each stage within the given stages (stages outside are assumed to be done already).
+    '''
+    producers: Dict[str, str] = {}
+    for stage in PIPELINE_STAGES:
+        for output in stage["outputs"]:
+            producers[output] = stage["name"]
+
+    dependencies: Dict[str, List[str]] = {}
+    for stage_name in stage_names:
+        dependencies[stage_name] = []
+        for input_name in _get_stage(stage_name)["inputs"]:
+            producer = producers.get(input_name)
+            if producer is not None and producer in stage_names and producer not in dependencies[stage_name]:
+                dependencies[stage_name].append(producer)
+
+    return dependencies
+
+
+def _run_stage(stage_name: str, flush: bool = True) -> Tuple[float, float]:
+    '''
+    runs in worker process: returns start and end timestamp
+    flush: wait until the outputs are written (the next stages in other processes read them)
+    '''
+    start = datetime.now().timestamp()
+    _get_stage(stage_name)["run"]()
+    if flush is True:
+        flush_tmp_data()
+    return start, datetime.now().timestamp()
+
+
+def get_critical_path(dependencies: Dict[str, List[str]], durations: Dict[str, float]) -> Tuple[List[str], float]:
+    longest: Dict[str, Tuple[float, Optional[str]]] = {}  # stage name: (path duration, preceding stage)
+    for stage in PIPELINE_STAGES:  # topological order
+        stage_name = stage["name"]
+        if stage_name not in dependencies:
+            continue
+
+        preceding_duration, preceding_stage = 0.0, None
+        for dependency in dependencies[stage_name]:
+            if longest[dependency][0] > preceding_duration:
+                preceding_duration, preceding_stage = longest[dependency][0], dependency
+        longest[stage_name] = (preceding_duration + durations[stage_name], preceding_stage)
+
+    if len(longest) == 0:
+        return [], 0.0
+
+    current: Optional[str] = max(longest.keys(), key=lambda x: longest[x][0])
+    critical_duration = longest[current][0]
+    critical_path: List[str] = []
+    while current is not None:
+        critical_path.insert(0, current)
+        current = longest[current][1]
+
+    return critical_path, critical_duration
+
+
+def _print_summary(timings: Dict[str, Tuple[float, float]], dependencies: Dict[str, List[str]], wall_time: float) -> None:
+    durations = {stage_name: end - start for stage_name, (start, end) in timings.items()}
+    critical_path, critical_duration = get_critical_path(dependencies, durations)
+
+    print("----- summary -----")
+    for stage_name, (start, end) in sorted(timings.items(), key=lambda x: x[1][0]):
+        print(f"  {stage_name:<16} {durations[stage_name]:>9.1f} s")
+    print(f"  sum of stages     {sum(durations.values()):>9.1f} s")
+    print(f"  wall time         {wall_time:>9.1f} s")
+    print(f"  critical path     {critical_duration:>9.1f} s: {' -> '.join(critical_path)}")
+
+
+def run_pipeline(stage_names: Optional[List[str]] = None, workers: Optional[int] = None) -> None:
+    '''
+    Run the given stages (default: all) respecting their dependencies.
+    With 1 worker, the stages run one after another in this process.
+    '''
+    if stage_names is None:
+        stage_names = [stage["name"] for stage in PIPELINE_STAGES]
+    stage_names = [stage["name"] for stage in PIPELINE_STAGES if stage["name"] in stage_names]  # topological order
+
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    dependencies = get_stage_dependencies(stage_names)
+    timings: Dict[str, Tuple[float, float]] = {}
+    start_time = datetime.now()
+    print(f"Start: {start_time}")
+
+    if workers <= 1:
+        for stage_name in stage_names:  # the next stage goes on with the outputs in memory while they are written
+            timings[stage_name] = _run_stage(stage_name, flush=False)
+            print(f"{stage_name} done: {datetime.now()-start_time}")
+        flush_tmp_data()
+    else:
+        process_groups = sorted(set(_get_stage(x)["process_group"] for x in stage_names if "process_group" in _get_stage(x)))
+
+        with ExitStack() as stack:
+            executor = stack.enter_context(ProcessPoolExecutor(max_workers=max(workers - len(process_groups), 1)))
+            group_executors = {x: stack.enter_context(ProcessPoolExecutor(max_workers=1)) for x in process_groups}
+            running: Dict[Any, str] = {}
+            pending = list(stage_names)
+
+            while len(pending) > 0 or len(running) > 0:
+                # ***
+                # submit all stages whose dependencies are done
+                for stage_name in list(pending):
+                    if all(x in timings for x in dependencies[stage_name]):
+                        stage_executor = group_executors.get(_get_stage(stage_name).get("process_group"), executor)
+                        running[stage_executor.submit(_run_stage, stage_name)] = stage_name
+                        pending.remove(stage_name)
+                        print(f"{stage_name} started: {datetime.now()-start_time}")
+
+                done, _ = wait(list(running.keys()), return_when=FIRST_COMPLETED)
+                for future in done:
+                    stage_name = running.pop(future)
+                    try:
+                        timings[stage_name] = future.result()
+                    except Exception:
+                        print(f"{stage_name} failed: {datetime.now()-start_time}")
+                        for other_future in running.keys():
+                            other_future.cancel()
+                        raise
+                    print(f"{stage_name} done: {datetime.now()-start_time}")
+
+    # Finished
+    print(f"All done. {datetime.now()-start_time}")
+    _print_summary(timings, dependencies, (datetime.now()-start_time).total_seconds())
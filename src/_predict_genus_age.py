@@ -1,6 +1,7 @@
-from typing import Any, Dict, List, Tuple
+from typing import Any, Dict, List, Optional, Tuple
 
 from predictions._clustered_neighbour_trees import train_neighbouring_tree_cluster
+from predictions._neighbour_vote import get_agreement_report, predict_by_neighbour_vote, print_agreement_report
 
 import pandas as pd
 
@@ -57,16 +58,29 @@ def _enrich_tree_data(tree_data: List[Any], predictions: Dict[str, Any]) -> List
     return tree_data
 
 
-def predict_genus_age(tree_data: List[Any], tree_pairs_list: List[Any]) -> None:
+def predict_genus_age(tree_data: List[Any], tree_pairs_list: List[Any], workers: Optional[int] = None, engine: str = "dbscan", compare: bool = False) -> None:
+    '''
+    engine: "dbscan" (clusters of neighbouring trees), "vote" or "weighted_vote" (sparse (distance weighted) vote)
+    compare: additionally run the other engine and print the agreement of both
+    '''
     print("process data...")
     df = _get_reduced_data(tree_data)
-    tree_pairs_by_id = _load_neighbour_pairs(tree_pairs_list)
 
     print("start prediction script...")
-    predictions = train_neighbouring_tree_cluster(df, tree_pairs_by_id)
+    dbscan_predictions: Optional[Dict[str, Any]] = None
+    vote_predictions: Optional[Dict[str, Any]] = None
+
+    if engine == "dbscan" or compare is True:
+        tree_pairs_by_id = _load_neighbour_pairs(tree_pairs_list)
+        suburb_by_id = {tree["tree_id"]: tree["geo_info"]["suburb_id"] for tree in tree_data}
+        dbscan_predictions = train_neighbouring_tree_cluster(df.copy(), tree_pairs_by_id, suburb_by_id, workers)
+    if engine != "dbscan" or compare is True:
+        vote_predictions = predict_by_neighbour_vote(df, tree_pairs_list, distance_weighted=engine == "weighted_vote")
+
+    if compare is True:
+        print_agreement_report(get_agreement_report(vote_predictions, dbscan_predictions))
 
     print("merge predictions with tree data...")
-    tree_data = _enrich_tree_data(tree_data, predictions)
+    tree_data = _enrich_tree_data(tree_data, dbscan_predictions if engine == "dbscan" else vote_predictions)
 
     return tree_data
-    
\ No newline at end of file
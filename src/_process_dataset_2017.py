@@ -2,9 +2,9 @@ import csv
 import datetime
 import json
 from typing import Any, Dict, List
-import uuid
 
 from _geo import check_point_in_suburb_polygons
+from _tree_id import get_tree_id
 from predictions._age_regression import predict_year_sprout
 
 import utm  
@@ -33,6 +33,7 @@ def process_dataset_2017() -> List[Dict[str, Any]]:
 
 
     lines = []
+    tree_id_key_counts: Dict[str, int] = {}
     i = 0
     for row in rows:
         i += 1
@@ -131,7 +132,7 @@ def process_dataset_2017() -> List[Dict[str, Any]]:
                 pass
             
 
-            tree_id = str(uuid.uuid4()) 
+            tree_id = get_tree_id("2017", x, y, row["Baum-Nr."] if len(row["Baum-Nr."]) > 0 else None, tree_id_key_counts)
             
             tmp = {
                 "tree_id": tree_id,
@@ -2,9 +2,9 @@ import csv
 import datetime
 import json
 from typing import Any, Dict, List
-import uuid
 
 from _geo import check_point_in_suburb_polygons
+from _tree_id import get_tree_id
 from predictions._age_regression import predict_year_sprout
 
 import utm  
@@ -29,6 +29,7 @@ def process_dataset_2020() -> List[Dict[str, Any]]:
 
 
     lines = []
+    tree_id_key_counts: Dict[str, int] = {}
     i = 0
     for row in rows:
         i += 1
@@ -127,7 +128,7 @@ def process_dataset_2020() -> List[Dict[str, Any]]:
             except:
                 pass
 
-            tree_id = str(uuid.uuid4()) 
+            tree_id = get_tree_id("2020", x, y, row["baumnr"] if len(row["baumnr"]) > 0 else None, tree_id_key_counts)
             
             
             tmp = {
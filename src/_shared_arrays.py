@@ -0,0 +1,127 @@
+'''
+Shared data plane for worker processes: numpy arrays written once as .npy files and memory-mapped read-only
+in each worker, hence the workers share the pages of the OS cache instead of unpickling their own copy.
+(multiprocessing.shared_memory would need Python 3.8)
+
+Lifecycle:
+- create_shared_arrays writes the arrays to /data/tmp/shared/<pid>_<random>/ and registers the removal at exit
+  (also when the process ends with an exception)
+- remove_shared_arrays removes them (done by shared_arrays() resp. run_partitioned when finished)
+- directories of processes which don't exist anymore (i.e. killed) are removed with the next create_shared_arrays
+
+    with shared_arrays(get_tree_arrays(tree_data_list)) as path:
+        ...  # in worker: arrays = load_shared_arrays(path); arrays["utm_x"][i]
+'''
+import atexit
+from contextlib import contextmanager
+import os
+import shutil
+from typing import Any, Dict, Iterator, List, Tuple
+import uuid
+
+import numpy as np
+
+
+SHARED_DATA_DIR = "../data/tmp/shared"
+
+
+def _is_process_running(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:  # exists, but owned by another user
+        return True
+    return True
+
+
+def _remove_stale_shared_arrays() -> None:
+    if not os.path.exists(SHARED_DATA_DIR):
+        return
+
+    for dir_name in os.listdir(SHARED_DATA_DIR):
+        try:
+            pid = int(dir_name.split("_")[0])
+        except ValueError:
+            continue
+        if pid != os.getpid() and not _is_process_running(pid):
+            shutil.rmtree(f"{SHARED_DATA_DIR}/{dir_name}", ignore_errors=True)
+
+
+def remove_shared_arrays(path: str) -> None:
+    shutil.rmtree(path, ignore_errors=True)
+
+
+def create_shared_arrays(arrays: Dict[str, np.ndarray]) -> str:
+    '''
+    Returns the path to pass to the workers (i.e. in the worker context).
+    Arrays of strings are stored as fixed width unicode, object arrays are not supported (no memory mapping).
+    '''
+    _remove_stale_shared_arrays()
+
+    path = f"{SHARED_DATA_DIR}/{os.getpid()}_{uuid.uuid4().hex[:8]}"
+    os.makedirs(path)
+    atexit.register(remove_shared_arrays, path)
+
+    for name, array in arrays.items():
+        array = np.asarray(array)
+        if array.dtype == object:
+            array = array.astype(str)
+        np.save(f"{path}/{name}.npy", array, allow_pickle=False)
+
+    return path
+
+
+def load_shared_arrays(path: str) -> Dict[str, np.ndarray]:
+    ''' read-only memory maps (writing raises ValueError) '''
+    return {
+        file_name[:-len(".npy")]: np.load(f"{path}/{file_name}", mmap_mode="r", allow_pickle=False)
+        for file_name in os.listdir(path) if file_name.endswith(".npy")
+    }
+
+
+@contextmanager
+def shared_arrays(arrays: Dict[str, np.ndarray]) -> Iterator[str]:
+    path = create_shared_arrays(arrays)
+    try:
+        yield path
+    finally:
+        remove_shared_arrays(path)
+
+
+# ***
+# tree data as arrays (row i: i-th tree of the list, the integer id of a tree)
+def _encode(values: List[Any]) -> Tuple[np.ndarray, np.ndarray]:
+    ''' codes (-1: None) of the sorted unique values '''
+    categories = sorted(set(x for x in values if x is not None))
+    codes = {value: i for i, value in enumerate(categories)}
+    return np.array([codes[x] if x is not None else -1 for x in values], dtype=np.int32), np.array(categories, dtype=str)
+
+
+def get_tree_arrays(tree_data_list: List[Dict[str, Any]]) -> Dict[str, np.ndarray]:
+    '''
+    Coordinates, encoded genus / suburb (codes of genus_categories / suburb_categories), age values (-1: None)
+    and tree_ids (to map the integer ids back)
+    '''
+    genus_codes, genus_categories = _encode([x["tree_taxonomy"]["genus"] for x in tree_data_list])
+    suburb_codes, suburb_categories = _encode([x["geo_info"]["suburb_id"] for x in tree_data_list])
+
+    def _int_or_minus_one(values: List[Any]) -> np.ndarray:
+        return np.array([x if x is not None else -1 for x in values], dtype=np.int32)
+
+    def _float_or_nan(values: List[Any]) -> np.ndarray:
+        return np.array([x if x is not None else np.nan for x in values], dtype=np.float64)
+
+    return {
+        "tree_ids": np.array([x["tree_id"] for x in tree_data_list], dtype=str),
+        "utm_x": _float_or_nan([x["geo_info"]["utm_x"] for x in tree_data_list]),
+        "utm_y": _float_or_nan([x["geo_info"]["utm_y"] for x in tree_data_list]),
+        "lat": _float_or_nan([x["geo_info"]["lat"] for x in tree_data_list]),
+        "lng": _float_or_nan([x["geo_info"]["lng"] for x in tree_data_list]),
+        "suburb": suburb_codes,
+        "suburb_categories": suburb_categories,
+        "genus": genus_codes,
+        "genus_categories": genus_categories,
+        "year_sprout": _int_or_minus_one([x["tree_age"]["year_sprout"] for x in tree_data_list]),
+        "age_group": _int_or_minus_one([x["tree_age"]["age_group_2020"] for x in tree_data_list]),
+    }
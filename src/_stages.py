@@ -0,0 +1,204 @@
+'''
+The stages of the process chain. Each stage reads its input from /data/tmp and writes its result there,
+hence every stage can be run on its own (given the preceding stages were run before).
+See _pipeline.py for the inputs / outputs of each stage.
+
+Dependencies (pandas, sklearn, shapely, utm, ...) are imported within the stages which need them:
+importing this module doesn't cost anything.
+'''
+from typing import Any, Dict
+
+from _tmp_data import flush_tmp_data, load_list_tmp_data, load_tmp_data, save_tmp_data
+
+
+# *******
+# 1 - create base datasets from original "Baumkataster" csv data
+# *******
+def ingest_2017() -> None:
+    ''' create base dataset 2017 from original "Baumkataster" csv data '''
+    from _geo import create_suburb_polygons
+    from _ingest_columnar import process_dataset
+
+    create_suburb_polygons()  # only takes milliseconds
+    save_tmp_data("data_2017.jsonln", process_dataset("2017"), background=True, compress=True)
+
+
+def ingest_2020() -> None:
+    ''' create base dataset 2020 from original "Baumkataster" csv data '''
+    from _geo import create_suburb_polygons
+    from _ingest_columnar import process_dataset
+
+    create_suburb_polygons()
+    save_tmp_data("data_2020.jsonln", process_dataset("2020"), background=True, compress=True)
+
+
+# *******
+# 2 - merge datasets 2017 / 2020
+# *******
+def merge() -> None:
+    ''' merge datasets 2017 / 2020 '''
+    from _merge_datasets import merge_datasets
+
+    datasets = load_tmp_data()  # from the cache if ingested in this process (pipeline: ingest_2020)
+    save_tmp_data("data_merged.jsonln", merge_datasets(datasets), background=True, compress=True)
+
+
+# *******
+# 3 - process neighbour trees in radius, then clean up pairs of close trees (< 3m)
+# *******
+def neighbours() -> None:
+    '''
+    process neighbour graph up to the largest radius of NEIGHBOUR_RADII (stored for tuning of the predictions),
+    slice out the pairs in RADIUS, then clean up pairs of close trees
+    '''
+    from _neighbour_graph import build_neighbour_graph, get_close_pairs, get_neighbour_pairs, save_neighbour_graph
+    from _tree_neighbours import RADIUS, cleanup_close_pairs
+
+    merged_data = load_list_tmp_data("data_merged.jsonln")
+
+    graph = build_neighbour_graph(merged_data)
+    save_neighbour_graph(graph)
+
+    close_pairs = get_close_pairs(graph)
+    save_tmp_data("neighbours_close_pairs.jsonln", close_pairs, background=True)
+    save_tmp_data("neighbours_all_pairs.jsonln", get_neighbour_pairs(graph, radius=RADIUS), background=True)
+
+    merged_data = cleanup_close_pairs(merged_data, close_pairs)
+    save_tmp_data("data_merged_cleanup.jsonln", merged_data, background=True, compress=True)
+
+
+# *******
+# 4 - predict genus and/or age resp. age_group by clusters of neighbouring trees
+# *******
+def predict(engine: str = "dbscan", compare: bool = False) -> None:
+    ''' predict genus and/or age resp. age_group by neighbouring trees (engine: dbscan, vote, weighted_vote) '''
+    from _predict_genus_age import predict_genus_age
+
+    merged_data = load_list_tmp_data("data_merged_cleanup.jsonln")
+    neighbours_pairs = load_list_tmp_data("neighbours_all_pairs.jsonln")
+
+    merged_data_with_predictions = predict_genus_age(merged_data, neighbours_pairs, engine=engine, compare=compare)
+    save_tmp_data("data_merged_with_predictions.jsonln", merged_data_with_predictions, background=True, compress=True)
+
+
+# *******
+# 5 - get location types and nearest road (street) of each tree (independent of predictions)
+# *******
+def locate(simplified: bool = False, raster: bool = False) -> None:
+    '''
+    get location types and nearest road (street) of each tree
+    (simplified: dissolved / simplified OSM layers, raster: lookup in the compiled rasters, exact check near boundaries)
+    '''
+    from functools import partial
+    import os
+
+    from _location_raster import get_array_raster_location_types, get_raster_path, load_location_rasters
+    from _osm_type import OSM_DATA_DIR, OSM_SIMPLIFIED_DATA_DIR, get_array_location_types, get_suburb_data, run_location_types
+    from _nearest_road import get_highway_data, get_tree_nearest_roads
+
+    data_dir = OSM_SIMPLIFIED_DATA_DIR if simplified is True else OSM_DATA_DIR
+    if simplified is True and not os.path.exists(OSM_SIMPLIFIED_DATA_DIR):
+        raise FileNotFoundError(f"{OSM_SIMPLIFIED_DATA_DIR} not found: run osm/simplify_buffer.py first")
+    if raster is True and not os.path.exists(get_raster_path(data_dir)):
+        raise FileNotFoundError(f"{get_raster_path(data_dir)} not found: run _location_raster.py first")
+
+    merged_data = load_list_tmp_data("data_merged_cleanup.jsonln")
+
+    if raster is True:
+        merged_data = run_location_types(merged_data, get_array_raster_location_types, partial(load_location_rasters, data_dir))
+    else:
+        merged_data = run_location_types(merged_data, get_array_location_types, partial(get_suburb_data, data_dir))  # by suburb
+
+    get_highway_data()
+    merged_data = get_tree_nearest_roads(merged_data)
+    save_tmp_data("tree_locations.jsonln", [
+        {
+            "tree_id": tree_data["tree_id"],
+            "tree_location_type": tree_data["tree_location_type"],
+            "nearest_road": tree_data["nearest_road"]
+        } for tree_data in merged_data
+    ], background=True)
+
+
+def combine() -> None:
+    ''' combine predictions and locations of each tree '''
+    merged_data_with_predictions = load_list_tmp_data("data_merged_with_predictions.jsonln")
+    tree_locations: Dict[str, Any] = {x["tree_id"]: x for x in load_list_tmp_data("tree_locations.jsonln")}
+
+    final_data = []
+    for tree_data in merged_data_with_predictions:
+        if tree_locations.get(tree_data["tree_id"]) is None:  # no location data available for this suburb
+            continue
+        tree_data["tree_location_type"] = tree_locations[tree_data["tree_id"]]["tree_location_type"]
+        tree_data["nearest_road"] = tree_locations[tree_data["tree_id"]]["nearest_road"]
+        final_data.append(tree_data)
+
+    save_tmp_data("data_final.jsonln", final_data, background=True)
+
+
+# *******
+# 6 - write compressed exports to /data/exports
+# *******
+def export_full() -> None:
+    ''' write compressed full export to /data/exports '''
+    from _export import save_compressed_data
+
+    flush_tmp_data()  # data_final.jsonln might still be written (stages running one after another)
+    save_compressed_data("trees_cologne.jsonln", "../data/tmp/data_final.jsonln")
+
+
+def export_delta() -> None:
+    '''
+    write delta (added, changed, removed trees) against the previous full export, then the new full export
+    (not part of the stage graph, as it reads the full export before it is overwritten: create_data.py export --delta)
+    '''
+    from _export import create_delta, load_compressed_data, save_compressed_data
+
+    delta = create_delta(load_compressed_data("trees_cologne.jsonln"), load_list_tmp_data("data_final.jsonln"))
+    print(f"delta: {len(delta)} changed trees")
+    save_tmp_data("data_final_delta.jsonln", delta)
+    save_compressed_data("trees_cologne_delta.jsonln", "../data/tmp/data_final_delta.jsonln")
+    export_full()
+
+
+def export_reduced() -> None:
+    ''' write compressed reduced export to /data/exports '''
+    from _export import create_reduced_data, save_compressed_data
+    from _partition import run_partitioned
+
+    final_data = load_list_tmp_data("data_final.jsonln")
+    reduced_tree_data = run_partitioned(create_reduced_data, final_data)
+    save_tmp_data("data_final_reduced.jsonln", reduced_tree_data)
+    save_compressed_data("trees_cologne_reduced.jsonln", "../data/tmp/data_final_reduced.jsonln")
+
+
+def export_flatgeobuf() -> None:
+    ''' write FlatGeobuf exports (full and reduced, with spatial index) to /data/exports '''
+    from _export import FLAT_FULL_PROPERTIES, FLAT_REDUCED_PROPERTIES, save_flatgeobuf_data
+
+    save_flatgeobuf_data("trees_cologne", load_list_tmp_data("data_final.jsonln"), FLAT_FULL_PROPERTIES)
+    save_flatgeobuf_data("trees_cologne_reduced", load_list_tmp_data("data_final_reduced.jsonln"), FLAT_REDUCED_PROPERTIES)
+
+
+def export_parquet() -> None:
+    ''' write Parquet export (partitioned by district, Hilbert sorted) to /data/exports '''
+    from _export import save_parquet_data
+
+    save_parquet_data("trees_cologne", load_list_tmp_data("data_final.jsonln"))
+
+
+def export_sqlite() -> None:
+    ''' write SQLite export (normalized tables, R*Tree on coordinates) to /data/exports '''
+    from _export import save_sqlite_data
+
+    save_sqlite_data("trees_cologne", load_list_tmp_data("data_final.jsonln"))
+
+
+# *******
+# 7 - aggregate cube for dashboards
+# *******
+def aggregate() -> None:
+    ''' write aggregate cube (rollups by suburb, district, genus, age group, ...) to /data/exports '''
+    from _aggregate import create_aggregate_cube, save_aggregate_cube
+
+    save_aggregate_cube("trees_cologne_aggregates", create_aggregate_cube(load_list_tmp_data("data_final.jsonln")))
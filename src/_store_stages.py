@@ -0,0 +1,230 @@
+'''
+The stages of the process chain in out-of-core mode: same results as _stages.py, but the stages read and write
+the tables of the on-disk store (_tree_store.py) in chunks, hence the memory stays bounded (see MEMORY_LIMIT_MB)
+for inventories which don't fit into memory as a whole:
+
+    python create_data.py all --store --memory-limit 2048
+
+The stages run one after another (concurrent stages would each need their share of the memory):
+- ingest: csv rows in chunks -> data_2017, data_2020
+- merge: records grouped by utm key in SQL -> data_merged
+- neighbours: coordinates as arrays, graph edges written per query chunk -> neighbour_graph,
+  only the records of close pairs are loaded for the clean up -> data_merged_cleanup
+- predict: reduced columns and neighbour pairs as arrays, sparse vote (DBSCAN needs all pairs as dicts) -> predictions
+- locate: one suburb at a time (only its OSM layers loaded) -> tree_locations
+- combine: join in SQL, streamed to data_final.jsonln (input of the exports, see _stages.py)
+
+Dependencies are imported within the stages (like _stages.py).
+'''
+from typing import Any, Dict, List
+
+from _tree_store import check_memory, get_chunk_size
+
+
+# *******
+# 1 - create base datasets from original "Baumkataster" csv data
+# *******
+def ingest() -> None:
+    from _geo import create_suburb_polygons
+    from _ingest_columnar import iter_dataset_chunks
+    from _tree_store import write_records
+
+    create_suburb_polygons()
+    for year in ["2017", "2020"]:
+        record_count = write_records(f"data_{year}", iter_dataset_chunks(year, get_chunk_size()))
+        print(f"ingest {year}: {record_count} trees")
+    check_memory("ingest")
+
+
+# *******
+# 2 - merge datasets 2017 / 2020
+# *******
+def merge() -> None:
+    from _merge_datasets import merge_trees
+    from _tree_store import create_record_table, index_record_table, insert_records, iter_utm_groups
+
+    create_record_table("data_merged")
+
+    chunk: List[Dict[str, Any]] = []
+    for trees_2017, trees_2020 in iter_utm_groups():
+        merged_tree = merge_trees(trees_2017, trees_2020)
+        if merged_tree is not None:
+            chunk.append(merged_tree)
+        if len(chunk) >= get_chunk_size():
+            insert_records("data_merged", chunk)
+            chunk = []
+    insert_records("data_merged", chunk)
+
+    index_record_table("data_merged")
+    check_memory("merge")
+
+
+# *******
+# 3 - process neighbour graph, then clean up pairs of close trees (< 3m)
+# *******
+def neighbours() -> None:
+    import numpy as np
+
+    from _neighbour_graph import NEIGHBOUR_RADII, iter_neighbour_edges
+    from _tree_neighbours import MIN_TREE_DISTANCE, get_skipped_tree_ids
+    from _tree_store import (copy_records, get_neighbour_graph_pairs, get_record_columns, get_records,
+                             write_neighbour_graph)
+
+    # ***
+    # trees with suburb and coordinates (same rows as _neighbour_graph.build_neighbour_graph)
+    columns = get_record_columns("data_merged", {
+        "tree_id": "$.tree_id",
+        "utm_x": "$.geo_info.utm_x",
+        "utm_y": "$.geo_info.utm_y",
+        "lat": "$.geo_info.lat",
+        "lng": "$.geo_info.lng",
+    }, where="WHERE suburb_id IS NOT NULL AND json_extract(record, '$.geo_info.lat') IS NOT NULL")
+
+    tree_ids = np.array(columns.pop("tree_id"), dtype=object)
+    coordinates = {name: np.array(values, dtype=float) for name, values in columns.items()}
+    del columns
+
+    edge_count = write_neighbour_graph(tree_ids, iter_neighbour_edges(
+        coordinates["utm_x"], coordinates["utm_y"], coordinates["lat"], coordinates["lng"], max(NEIGHBOUR_RADII)
+    ))
+    print(f"neighbour graph: {len(tree_ids)} trees, {edge_count} edges")
+    del coordinates
+
+    # ***
+    # clean up close pairs: only their records are needed
+    rows, neighbour_rows, distances = get_neighbour_graph_pairs(MIN_TREE_DISTANCE, below_min_distance=True)
+    close_pairs = [
+        [tree_ids[row], tree_ids[neighbour_row], float(distance)]
+        for row, neighbour_row, distance in zip(rows, neighbour_rows, distances)
+    ]
+    tree_dict = get_records("data_merged", sorted(set(tree_ids[rows]) | set(tree_ids[neighbour_rows])))
+    skipped_tree_ids = get_skipped_tree_ids(tree_dict, close_pairs)
+
+    record_count = copy_records("data_merged", "data_merged_cleanup", [x for x in skipped_tree_ids if x is not None])
+    print(f"clean up: {len(close_pairs)} close pairs, {record_count} trees left")
+    check_memory("neighbours")
+
+
+# *******
+# 4 - predict genus and/or age resp. age_group by neighbouring trees
+# *******
+def predict(engine: str = "vote") -> None:
+    ''' engine: vote or weighted_vote '''
+    import pandas as pd
+
+    from _tree_neighbours import MIN_TREE_DISTANCE, RADIUS
+    from _tree_store import create_value_table, get_neighbour_graph_pairs, get_neighbour_graph_tree_ids, get_record_columns, insert_values
+    from predictions._neighbour_vote import predict_by_neighbour_vote
+
+    if engine not in ["vote", "weighted_vote"]:
+        raise ValueError(f"engine {engine}: the out-of-core mode predicts by vote or weighted_vote")
+
+    df = pd.DataFrame(get_record_columns("data_merged_cleanup", {
+        "id": "$.tree_id",
+        "year_sprout": "$.tree_age.year_sprout",
+        "age_group_2020": "$.tree_age.age_group_2020",
+        "genus": "$.tree_taxonomy.genus",
+    }))
+
+    # ***
+    # pairs as codes of the graph tree ids (instead of [tree_id_1, tree_id_2, distance] lists)
+    graph_tree_ids = get_neighbour_graph_tree_ids()
+    rows, neighbour_rows, distances = get_neighbour_graph_pairs(MIN_TREE_DISTANCE, RADIUS)
+    tree_pairs = pd.DataFrame({
+        "id_1": pd.Categorical.from_codes(rows, categories=graph_tree_ids),
+        "id_2": pd.Categorical.from_codes(neighbour_rows, categories=graph_tree_ids),
+        "distance": distances,
+    })
+
+    predictions = predict_by_neighbour_vote(df, tree_pairs, distance_weighted=engine == "weighted_vote")
+    create_value_table("predictions")
+    insert_values("predictions", ((tree_id, prediction) for tree_id, prediction in predictions.items() if prediction is not None))
+    print(f"predict: {len(predictions)} trees")
+    check_memory("predict")
+
+
+# *******
+# 5 - get location types and nearest road (street) of each tree, one suburb at a time
+# *******
+def locate(simplified: bool = False, raster: bool = False) -> None:
+    import os
+
+    from _location_raster import LOCATION_RASTERS, get_raster_path, get_raster_location_types, open_location_rasters
+    from _nearest_road import get_highway_data, get_tree_nearest_roads
+    from _osm_type import (OSM_DATA_DIR, OSM_SIMPLIFIED_DATA_DIR, get_district_suburb_data, get_district_suburb_slug,
+                           get_partition_location_types)
+    from _tree_store import create_value_table, insert_values, iter_suburb_partitions
+
+    data_dir = OSM_SIMPLIFIED_DATA_DIR if simplified is True else OSM_DATA_DIR
+    if simplified is True and not os.path.exists(OSM_SIMPLIFIED_DATA_DIR):
+        raise FileNotFoundError(f"{OSM_SIMPLIFIED_DATA_DIR} not found: run osm/simplify_buffer.py first")
+    if raster is True and not os.path.exists(get_raster_path(data_dir)):
+        raise FileNotFoundError(f"{get_raster_path(data_dir)} not found: run _location_raster.py first")
+
+    get_highway_data()
+    if raster is True:
+        open_location_rasters(data_dir)
+    create_value_table("tree_locations")
+
+    for partition in iter_suburb_partitions("data_merged_cleanup"):
+        geo_info = partition[0]["geo_info"]
+        get_district_suburb_data(get_district_suburb_slug(geo_info["district"], geo_info["suburb"]), data_dir)
+
+        if raster is True:
+            located_trees = get_raster_location_types(partition)
+            LOCATION_RASTERS.clear()  # rasters of this suburb
+        else:
+            located_trees = get_partition_location_types(partition)
+
+        located_trees = get_tree_nearest_roads([x for x in located_trees if x is not None])
+        insert_values("tree_locations", (
+            (
+                tree_data["tree_id"],
+                {"tree_location_type": tree_data["tree_location_type"], "nearest_road": tree_data["nearest_road"]}
+            ) for tree_data in located_trees
+        ))
+
+    check_memory("locate")
+
+
+def combine() -> None:
+    ''' streamed to data_final.jsonln (same records as _stages.combine) '''
+    from _tmp_data import save_tmp_data_chunks
+    from _tree_store import iter_joined_records
+
+    def _iter_final_chunks():
+        for chunk in iter_joined_records("data_merged_cleanup", ["predictions", "tree_locations"], required_tables=["tree_locations"]):
+            final_chunk: List[Dict[str, Any]] = []
+            for tree_data, (prediction, tree_location) in chunk:
+                tree_data["predictions"] = {"by_radius_prediction": prediction} if prediction is not None else None
+                tree_data["tree_location_type"] = tree_location["tree_location_type"]
+                tree_data["nearest_road"] = tree_location["nearest_road"]
+                final_chunk.append(tree_data)
+            yield final_chunk
+
+    save_tmp_data_chunks("data_final.jsonln", _iter_final_chunks())
+    check_memory("combine")
+
+
+def run_store_pipeline(simplified: bool = False, raster: bool = False, engine: str = "vote") -> None:
+    ''' all stages up to data_final.jsonln, then the full export (streamed as well) '''
+    from datetime import datetime
+
+    from _stages import export_full
+    from _tree_store import remove_store
+
+    remove_store()
+    stages = [
+        ("ingest", ingest),
+        ("merge", merge),
+        ("neighbours", neighbours),
+        ("predict", lambda: predict(engine=engine)),
+        ("locate", lambda: locate(simplified=simplified, raster=raster)),
+        ("combine", combine),
+        ("export_full", export_full),
+    ]
+    for stage_name, run_stage in stages:
+        start = datetime.now()
+        print(f"*** {stage_name} ***")
+        run_stage()
+        print(f"{stage_name}: {datetime.now() - start}")
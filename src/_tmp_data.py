@@ -0,0 +1,158 @@
+'''
+Temporary results of each step of the process chain, stored as JSON line in /data/tmp
+
+save_tmp_data(..., background=True) hands the data to a writer thread (bounded queue) which serializes and writes
+(optionally gzip compressed) while the stage goes on working with the data in memory:
+- the data is snapshot when saved (list and each record copied), hence the stage may add / replace attributes
+  of the records afterwards, but must not change nested objects (i.e. record["geo_info"]) until flushed
+- flush_tmp_data() waits until all files are written and raises the first error of the writer
+  (called after each stage by the pipeline and at exit)
+
+The last saved / loaded files are kept in memory: loading them again in the same process (i.e. the next stage
+when running one after another, or the stages of the main chain in _pipeline.py) doesn't reread the file.
+
+The records of the stages up to the predictions are saved gzip compressed (level 1, read back transparently),
+data_final.jsonln stays plain (packed as is by the exports).
+'''
+import atexit
+from collections import OrderedDict
+import gzip
+import queue
+import threading
+from typing import Any, Dict, Iterable, List, Optional
+
+from _json_codec import dumps_record, loads
+
+
+TMP_DATA_DIR = "../data/tmp"
+WRITE_QUEUE_SIZE = 2  # files waiting to be written: saving blocks if the writer falls behind
+TMP_DATA_CACHE_SIZE = 3  # files kept in memory
+
+WRITE_QUEUE: "queue.Queue[Any]" = queue.Queue(maxsize=WRITE_QUEUE_SIZE)
+WRITER_THREAD: Optional[threading.Thread] = None
+WRITE_ERRORS: List[Exception] = []
+TMP_DATA_CACHE: "OrderedDict[str, List[Any]]" = OrderedDict()
+
+
+def _snapshot(data: List[Any]) -> List[Any]:
+    return [dict(x) if isinstance(x, dict) else x for x in data]
+
+
+def _cache_tmp_data(file_name: str, data: List[Any]) -> None:
+    TMP_DATA_CACHE[file_name] = data
+    TMP_DATA_CACHE.move_to_end(file_name)
+    while len(TMP_DATA_CACHE) > TMP_DATA_CACHE_SIZE:
+        TMP_DATA_CACHE.popitem(last=False)
+
+
+def _write_tmp_data(file_name: str, data_to_save: List[Any], compress: bool = False) -> None:
+    file_path = f"{TMP_DATA_DIR}/{file_name}"
+    with (gzip.open(file_path, "wt", compresslevel=1) if compress else open(file_path, "w")) as f:
+        for line in data_to_save:
+            f.write(f"{dumps_record(line)}\n")
+
+
+def _run_writer() -> None:
+    while True:
+        file_name, data_to_save, compress = WRITE_QUEUE.get()
+        try:
+            _write_tmp_data(file_name, data_to_save, compress)
+        except Exception as e:
+            WRITE_ERRORS.append(e)
+        finally:
+            WRITE_QUEUE.task_done()
+
+
+def _raise_write_errors() -> None:
+    if len(WRITE_ERRORS) > 0:
+        error = WRITE_ERRORS[0]
+        WRITE_ERRORS.clear()
+        raise RuntimeError(f"writing tmp data failed: {error}") from error
+
+
+def flush_tmp_data() -> None:
+    ''' wait until all files are written '''
+    if WRITER_THREAD is not None:
+        WRITE_QUEUE.join()
+    _raise_write_errors()
+
+
+def save_tmp_data(file_name: str, data_to_save: List[Any], background: bool = False, compress: bool = False) -> None:
+    global WRITER_THREAD
+
+    _raise_write_errors()
+
+    data_to_save = _snapshot(data_to_save)
+    _cache_tmp_data(file_name, data_to_save)
+
+    if background is False:
+        flush_tmp_data()  # same file might be in the queue
+        _write_tmp_data(file_name, data_to_save, compress)
+        return
+
+    if WRITER_THREAD is None:
+        WRITER_THREAD = threading.Thread(target=_run_writer, name="tmp_data_writer", daemon=True)
+        WRITER_THREAD.start()
+        atexit.register(flush_tmp_data)
+    WRITE_QUEUE.put((file_name, data_to_save, compress))
+
+
+def save_tmp_data_chunks(file_name: str, chunks: Iterable[List[Any]]) -> None:
+    ''' write the chunks one after another, without keeping them in memory (out-of-core mode) '''
+    flush_tmp_data()
+    TMP_DATA_CACHE.pop(file_name, None)
+
+    with open(f"{TMP_DATA_DIR}/{file_name}", "w") as f:
+        for chunk in chunks:
+            for line in chunk:
+                f.write(f"{dumps_record(line)}\n")
+
+
+def _read_tmp_file(file_name: str) -> str:
+    ''' plain or gzip compressed '''
+    file_path = f"{TMP_DATA_DIR}/{file_name}"
+    with open(file_path, "rb") as f:
+        is_compressed = f.read(2) == b"\x1f\x8b"
+    with (gzip.open(file_path, "rt") if is_compressed else open(file_path)) as f:
+        return f.read()
+
+
+def _parse_tmp_file(file_name: str) -> List[Any]:
+    out: List[Any] = []
+    for line in _read_tmp_file(file_name).split("\n"):
+        try:
+            out.append(loads(line))
+        except:
+            pass
+
+    return out
+
+
+def load_tmp_data() -> Dict[str, List[Dict[str, Any]]]:
+    '''
+    Records of the datasets 2017 and 2020: taken out of the cache if ingested in this process
+    (the merge changes nested objects of the records), otherwise read from the files
+    '''
+    flush_tmp_data()
+
+    datasets: Dict[str, List[Dict[str, Any]]] = {}
+    for year in ["2017", "2020"]:
+        file_name = f"data_{year}.jsonln"
+        if TMP_DATA_CACHE.get(file_name) is not None:
+            datasets[year] = TMP_DATA_CACHE.pop(file_name)
+        else:
+            datasets[year] = _parse_tmp_file(file_name)
+
+    return datasets
+
+
+def load_list_tmp_data(file_name: str) -> List[Dict[str, Any]]:
+    if TMP_DATA_CACHE.get(file_name) is not None:
+        TMP_DATA_CACHE.move_to_end(file_name)
+        return _snapshot(TMP_DATA_CACHE[file_name])
+
+    flush_tmp_data()
+
+    out = _parse_tmp_file(file_name)
+    _cache_tmp_data(file_name, out)
+    return _snapshot(out)
@@ -0,0 +1,28 @@
+'''
+Deterministic tree ids derived from the source record: the same csv data results in the same ids on every run
+(instead of a random uuid4), hence exports can be compared (and shipped as delta) between runs.
+
+tree_id = uuid5(TREE_ID_NAMESPACE, "<source year>_<utm_x>_<utm_y>_<tree_nr>")
+
+Records with the same source key (same position and tree number) are counted in order of the source rows:
+the n-th duplicate (n > 0) gets the key "<source year>_<utm_x>_<utm_y>_<tree_nr>#<n>".
+'''
+from typing import Dict, Optional
+import uuid
+
+
+TREE_ID_NAMESPACE = uuid.UUID("bd02aee1-0627-47d0-b170-85f1df4bf673")  # never change: changes all ids
+
+
+def get_tree_id(year: str, utm_x: int, utm_y: int, tree_nr: Optional[str], key_counts: Dict[str, int]) -> str:
+    '''
+    key_counts: occurrences of each source key so far (one dict per ingest run of a dataset)
+    '''
+    source_key = f"{year}_{utm_x}_{utm_y}_{tree_nr if tree_nr is not None else ''}"
+
+    duplicate_count = key_counts.get(source_key, 0)
+    key_counts[source_key] = duplicate_count + 1
+    if duplicate_count > 0:
+        source_key = f"{source_key}#{duplicate_count}"
+
+    return str(uuid.uuid5(TREE_ID_NAMESPACE, source_key))
@@ -8,7 +8,9 @@ from _geo import get_bounding_box_around_lat_lng_center, get_neighbouring_suburb
 
 RADIUS = 50  # circle radius / bounding box half size in meter
 MIN_TREE_DISTANCE = 3  # in meter
-EARTH_RADIUS, EARTH_PRADIUS = get_earth_radius(50.935173)  # latitude Cologne, Germany
+COLOGNE_LATITUDE = 50.935173
+EARTH_RADIUS: Optional[int] = None  # computed once with Cologne latitude when processing tree neighbours
+EARTH_PRADIUS: Optional[int] = None
 
 
 # ********************
@@ -46,16 +48,10 @@ def _check_duplicate_tree(tree_1: Dict[str, Any], tree_2: Dict[str, Any]) -> str
     return skipped_tree_id
 
 
-def cleanup_close_pairs(merged_data: List[Dict[str, Any]], close_pair_list: List[Any]) -> List[Dict[str, Any]]:
-    def _arrange_tree_list_to_dict(merged_data: List[Any]) -> Dict[str, Any]:
-        tree_dict: Dict[str, Any] = {}
-        for tree in merged_data:
-            tree_dict[tree["tree_id"]] = tree
-        return tree_dict
-
-    tree_dict = _arrange_tree_list_to_dict(merged_data)
-
-    new_merged_data: List[Dict[str, Any]] = []
+def get_skipped_tree_ids(tree_dict: Dict[str, Any], close_pair_list: List[Any]) -> List[str]:
+    '''
+    Ids of the trees to skip of each pair of close trees (tree_dict: at least the trees of the pairs by tree_id)
+    '''
     skipped_tree_ids: List[str] = []
     
     for tree_pair in close_pair_list:
@@ -91,6 +87,21 @@ def cleanup_close_pairs(merged_data: List[Dict[str, Any]], close_pair_list: List
             else:
                 skipped_tree_ids.append(tree_2_id)
 
+    return skipped_tree_ids
+
+
+def cleanup_close_pairs(merged_data: List[Dict[str, Any]], close_pair_list: List[Any]) -> List[Dict[str, Any]]:
+    def _arrange_tree_list_to_dict(merged_data: List[Any]) -> Dict[str, Any]:
+        tree_dict: Dict[str, Any] = {}
+        for tree in merged_data:
+            tree_dict[tree["tree_id"]] = tree
+        return tree_dict
+
+    tree_dict = _arrange_tree_list_to_dict(merged_data)
+
+    new_merged_data: List[Dict[str, Any]] = []
+    skipped_tree_ids = get_skipped_tree_ids(tree_dict, close_pair_list)
+
     # **********
     # use trees NOT in skip list
     # **********
@@ -185,6 +196,12 @@ def _calculate_distance(suburb_trees: Dict[str, Any], current_suburb: str):
 
 
 def process_tree_neighbours(merged_data: List[Any]) -> None:
+    global EARTH_RADIUS
+    global EARTH_PRADIUS
+
+    if EARTH_RADIUS is None:
+        EARTH_RADIUS, EARTH_PRADIUS = get_earth_radius(COLOGNE_LATITUDE)
+
     neighbouring_suburbs = get_neighbouring_suburbs()
     
     trees_by_suburb: Dict[str, Dict[str, List[Dict[str, Any]]]] = {}
@@ -226,7 +243,7 @@ def process_tree_neighbours(merged_data: List[Any]) -> None:
 
             # ***
             # add to compare list
-            trees_to_compare += trees_by_suburb[neighbouring_suburb]
+            trees_to_compare += trees_by_suburb.get(neighbouring_suburb, [])  # no trees in suburb (i.e. subset of data)
 
             # ***
             #
@@ -0,0 +1,371 @@
+'''
+On-disk store of the out-of-core mode (python create_data.py all --store --memory-limit 2048): the tree tables
+and the neighbour graph live in one SQLite database (/data/tmp/tree_store.sqlite) instead of JSON line files
+loaded as a whole, the stages (_store_stages.py) read and write them in chunks.
+Apart from the chunks, only a few numpy arrays per tree are held in memory (coordinates for the neighbour graph,
+the reduced columns and neighbour pairs for the predictions).
+
+Memory ceiling (set_memory_limit, in MB):
+- chunk size: number of records per chunk, so the decoded records of a chunk take up CHUNK_MEMORY_SHARE of it
+- SQLite page cache: SQLITE_MEMORY_SHARE of it, sorting and temp tables spill to disk (temp_store FILE)
+- check_memory prints the peak resident memory after each stage (warning if above the ceiling)
+
+Tables (position: order of the records, the same as in the JSON line files of the in-memory stages):
+- record tables (data_2017, data_2020, data_merged, data_merged_cleanup):
+  position, tree_id, suburb_id, utm_key ("<utm_x>_<utm_y>", the key of the merge), record (JSON)
+- value tables (predictions, tree_locations): tree_id, value (JSON)
+- neighbour_graph_trees (row, tree_id), neighbour_graph (row, neighbour, distance): edges in both directions
+
+The database only holds intermediate results (rebuilt by each run), hence journal and sync are switched off.
+'''
+import os
+import resource
+import sqlite3
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+from _json_codec import dumps_record, loads
+from _tmp_data import TMP_DATA_DIR
+
+
+STORE_FILE = f"{TMP_DATA_DIR}/tree_store.sqlite"
+MEMORY_LIMIT_MB = 2048
+CHUNK_MEMORY_SHARE = 0.1
+SQLITE_MEMORY_SHARE = 0.125
+RECORD_MEMORY_BYTES = 4096  # decoded tree record (nested dicts) incl. its JSON line, measured about 3.5 kB
+MIN_CHUNK_SIZE = 1000
+SQL_VARIABLE_LIMIT = 900  # ids per IN (...) query (SQLite default limit: 999)
+
+MEMORY_LIMIT: int = MEMORY_LIMIT_MB
+STORE_CONNECTION: Optional[sqlite3.Connection] = None
+
+
+# *******
+# memory ceiling
+# *******
+def set_memory_limit(memory_limit_mb: int) -> None:
+    global MEMORY_LIMIT
+
+    MEMORY_LIMIT = memory_limit_mb
+    if STORE_CONNECTION is not None:
+        STORE_CONNECTION.execute(f"PRAGMA cache_size = -{_get_cache_size_kib()}")
+
+
+def get_chunk_size() -> int:
+    ''' records per chunk '''
+    return max(MIN_CHUNK_SIZE, int(MEMORY_LIMIT * 1024 * 1024 * CHUNK_MEMORY_SHARE / RECORD_MEMORY_BYTES))
+
+
+def _get_cache_size_kib() -> int:
+    return int(MEMORY_LIMIT * 1024 * SQLITE_MEMORY_SHARE)
+
+
+def get_peak_memory_mb() -> float:
+    ''' peak resident memory of this process (ru_maxrss: kB on Linux) '''
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def check_memory(stage_name: str) -> None:
+    peak_memory = get_peak_memory_mb()
+    print(f"{stage_name}: peak memory {peak_memory:.0f} MB (ceiling {MEMORY_LIMIT} MB)")
+    if peak_memory > MEMORY_LIMIT:
+        print(f"WARNING {stage_name}: memory ceiling exceeded (chunks and cache are within it, i.e. the OSM highway index isn't)")
+
+
+# *******
+# connection / tables
+# *******
+def get_store(file_path: str = STORE_FILE) -> sqlite3.Connection:
+    global STORE_CONNECTION
+
+    if STORE_CONNECTION is None:
+        STORE_CONNECTION = sqlite3.connect(file_path)
+        STORE_CONNECTION.execute("PRAGMA journal_mode = OFF")
+        STORE_CONNECTION.execute("PRAGMA synchronous = OFF")
+        STORE_CONNECTION.execute("PRAGMA temp_store = FILE")
+        STORE_CONNECTION.execute(f"PRAGMA cache_size = -{_get_cache_size_kib()}")
+    return STORE_CONNECTION
+
+
+def close_store() -> None:
+    global STORE_CONNECTION
+
+    if STORE_CONNECTION is not None:
+        STORE_CONNECTION.close()
+        STORE_CONNECTION = None
+
+
+def remove_store(file_path: str = STORE_FILE) -> None:
+    close_store()
+    if os.path.exists(file_path):
+        os.remove(file_path)
+
+
+def count_rows(table: str) -> int:
+    return get_store().execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+
+
+def _fetch_chunks(cursor: sqlite3.Cursor, chunk_size: int) -> Iterator[List[Tuple[Any, ...]]]:
+    while True:
+        rows = cursor.fetchmany(chunk_size)
+        if len(rows) == 0:
+            break
+        yield rows
+
+
+# *******
+# record tables
+# *******
+def create_record_table(table: str) -> None:
+    store = get_store()
+    store.execute(f"DROP TABLE IF EXISTS {table}")
+    store.execute(f"""
+        CREATE TABLE {table} (
+            position INTEGER PRIMARY KEY,
+            tree_id TEXT,
+            suburb_id TEXT,
+            utm_key TEXT,
+            record TEXT
+        )
+    """)
+    store.commit()
+
+
+def insert_records(table: str, records: List[Dict[str, Any]]) -> None:
+    ''' appends one chunk of records (in one transaction) '''
+    store = get_store()
+    store.executemany(
+        f"INSERT INTO {table} (tree_id, suburb_id, utm_key, record) VALUES (?, ?, ?, ?)",
+        (
+            (
+                record["tree_id"],
+                record["geo_info"]["suburb_id"],
+                f'{record["geo_info"]["utm_x"]}_{record["geo_info"]["utm_y"]}',
+                dumps_record(record)
+            ) for record in records
+        )
+    )
+    store.commit()
+
+
+def index_record_table(table: str) -> None:
+    ''' after the bulk insert (faster than updating the indexes with each insert) '''
+    store = get_store()
+    store.execute(f"CREATE INDEX {table}_tree_id ON {table} (tree_id)")
+    store.execute(f"CREATE INDEX {table}_suburb_id ON {table} (suburb_id, position)")
+    store.commit()
+
+
+def write_records(table: str, chunks: Iterable[List[Dict[str, Any]]]) -> int:
+    ''' (re)creates the table with the records of all chunks, returns the number of records '''
+    create_record_table(table)
+    record_count = 0
+    for chunk in chunks:
+        insert_records(table, chunk)
+        record_count += len(chunk)
+    index_record_table(table)
+    return record_count
+
+
+def iter_records(table: str, chunk_size: Optional[int] = None) -> Iterator[List[Dict[str, Any]]]:
+    ''' chunks of records in the order of the table '''
+    cursor = get_store().execute(f"SELECT record FROM {table} ORDER BY position")
+    for rows in _fetch_chunks(cursor, chunk_size or get_chunk_size()):
+        yield [loads(row[0]) for row in rows]
+
+
+def iter_suburb_partitions(table: str) -> Iterator[List[Dict[str, Any]]]:
+    ''' records of one suburb at a time (records without suburb first), in the order of the table within the suburb '''
+    cursor = get_store().execute(f"SELECT suburb_id, record FROM {table} ORDER BY suburb_id, position")
+
+    partition: List[Dict[str, Any]] = []
+    partition_suburb_id: Optional[str] = None
+    for rows in _fetch_chunks(cursor, get_chunk_size()):
+        for suburb_id, record in rows:
+            if len(partition) > 0 and suburb_id != partition_suburb_id:
+                yield partition
+                partition = []
+            partition_suburb_id = suburb_id
+            partition.append(loads(record))
+
+    if len(partition) > 0:
+        yield partition
+
+
+def get_records(table: str, tree_ids: List[str]) -> Dict[str, Dict[str, Any]]:
+    ''' records by tree_id '''
+    store = get_store()
+    records: Dict[str, Dict[str, Any]] = {}
+    for start in range(0, len(tree_ids), SQL_VARIABLE_LIMIT):
+        tree_id_chunk = tree_ids[start:start+SQL_VARIABLE_LIMIT]
+        for tree_id, record in store.execute(
+            f"SELECT tree_id, record FROM {table} WHERE tree_id IN ({', '.join('?' * len(tree_id_chunk))})", tree_id_chunk
+        ):
+            records[tree_id] = loads(record)
+    return records
+
+
+def get_record_columns(table: str, json_paths: Dict[str, str], where: str = "") -> Dict[str, List[Any]]:
+    '''
+    Values of some attributes of all records (without decoding the records), in the order of the table:
+    get_record_columns("data_merged", {"tree_id": "$.tree_id", "lat": "$.geo_info.lat"})
+    '''
+    names = list(json_paths.keys())
+    columns: Dict[str, List[Any]] = {name: [] for name in names}
+
+    cursor = get_store().execute(
+        f"SELECT {', '.join(f'json_extract(record, ?)' for _ in names)} FROM {table} {where} ORDER BY position",
+        [json_paths[name] for name in names]
+    )
+    for rows in _fetch_chunks(cursor, get_chunk_size()):
+        for name, values in zip(names, zip(*rows)):
+            columns[name].extend(values)
+    return columns
+
+
+def copy_records(table_in: str, table_out: str, skipped_tree_ids: Iterable[str]) -> int:
+    ''' copies the records except the skipped ones (same order), returns the number of copied records '''
+    store = get_store()
+    store.execute("DROP TABLE IF EXISTS temp.skipped_tree_ids")
+    store.execute("CREATE TEMP TABLE skipped_tree_ids (tree_id TEXT PRIMARY KEY)")
+    store.executemany("INSERT OR IGNORE INTO temp.skipped_tree_ids VALUES (?)", ((x,) for x in skipped_tree_ids))
+
+    create_record_table(table_out)
+    store.execute(f"""
+        INSERT INTO {table_out} (tree_id, suburb_id, utm_key, record)
+        SELECT tree_id, suburb_id, utm_key, record FROM {table_in}
+        WHERE tree_id NOT IN (SELECT tree_id FROM temp.skipped_tree_ids)
+        ORDER BY position
+    """)
+    store.commit()
+    index_record_table(table_out)
+    return count_rows(table_out)
+
+
+# ***
+# merge
+def iter_utm_groups(table_2017: str = "data_2017", table_2020: str = "data_2020") -> Iterator[Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]]:
+    '''
+    Records 2017 and 2020 of each utm key, in order of the first occurrence of the key
+    (in table_2017, then in table_2020), like the in-memory merge
+    '''
+    store = get_store()
+    store.execute("DROP TABLE IF EXISTS temp.merge_keys")
+    store.execute(f"""
+        CREATE TEMP TABLE merge_keys AS
+        SELECT utm_key, MIN(key_order) AS key_order FROM (
+            SELECT utm_key, position AS key_order FROM {table_2017}
+            UNION ALL
+            SELECT utm_key, position + (SELECT COALESCE(MAX(position), 0) FROM {table_2017}) AS key_order FROM {table_2020}
+        ) GROUP BY utm_key
+    """)
+    cursor = store.execute(f"""
+        SELECT keys.key_order, trees.year, trees.record FROM (
+            SELECT utm_key, position, 2017 AS year, record FROM {table_2017}
+            UNION ALL
+            SELECT utm_key, position, 2020 AS year, record FROM {table_2020}
+        ) AS trees JOIN temp.merge_keys AS keys USING (utm_key)
+        ORDER BY keys.key_order, trees.year, trees.position
+    """)
+
+    current_key: Optional[int] = None
+    trees: Dict[int, List[Dict[str, Any]]] = {2017: [], 2020: []}
+    for rows in _fetch_chunks(cursor, get_chunk_size()):
+        for key_order, year, record in rows:
+            if current_key is not None and key_order != current_key:
+                yield trees[2017], trees[2020]
+                trees = {2017: [], 2020: []}
+            current_key = key_order
+            trees[year].append(loads(record))
+
+    if current_key is not None:
+        yield trees[2017], trees[2020]
+
+
+# *******
+# value tables: tree_id -> JSON value
+# *******
+def create_value_table(table: str) -> None:
+    store = get_store()
+    store.execute(f"DROP TABLE IF EXISTS {table}")
+    store.execute(f"CREATE TABLE {table} (tree_id TEXT PRIMARY KEY, value TEXT)")
+    store.commit()
+
+
+def insert_values(table: str, values: Iterable[Tuple[str, Any]]) -> None:
+    store = get_store()
+    store.executemany(f"INSERT OR REPLACE INTO {table} VALUES (?, ?)", ((x, dumps_record(y)) for x, y in values))
+    store.commit()
+
+
+def iter_joined_records(table: str, value_tables: List[str], required_tables: List[str]) -> Iterator[List[Tuple[Dict[str, Any], List[Any]]]]:
+    '''
+    Chunks of (record, [value of each value table, None if missing]) in the order of the table,
+    records without value in one of the required_tables are skipped
+    '''
+    joins = " ".join(
+        f"{'JOIN' if x in required_tables else 'LEFT JOIN'} {x} AS v{i} ON v{i}.tree_id = t.tree_id"
+        for i, x in enumerate(value_tables)
+    )
+    cursor = get_store().execute(
+        f"SELECT t.record, {', '.join(f'v{i}.value' for i in range(len(value_tables)))} FROM {table} AS t {joins} ORDER BY t.position"
+    )
+    for rows in _fetch_chunks(cursor, get_chunk_size()):
+        yield [(loads(row[0]), [loads(x) if x is not None else None for x in row[1:]]) for row in rows]
+
+
+# *******
+# neighbour graph
+# *******
+def write_neighbour_graph(tree_ids: np.ndarray, edge_chunks: Iterable[Tuple[np.ndarray, np.ndarray, np.ndarray]]) -> int:
+    ''' tree_ids: id of each row, edge_chunks: i.e. _neighbour_graph.iter_neighbour_edges; returns the number of edges '''
+    store = get_store()
+    store.execute("DROP TABLE IF EXISTS neighbour_graph_trees")
+    store.execute("DROP TABLE IF EXISTS neighbour_graph")
+    store.execute("CREATE TABLE neighbour_graph_trees (row INTEGER PRIMARY KEY, tree_id TEXT)")
+    store.execute("CREATE TABLE neighbour_graph (row INTEGER, neighbour INTEGER, distance REAL)")
+    store.executemany("INSERT INTO neighbour_graph_trees VALUES (?, ?)", enumerate(tree_ids.tolist()))
+    store.commit()
+
+    edge_count = 0
+    for rows, neighbours, distances in edge_chunks:
+        store.executemany("INSERT INTO neighbour_graph VALUES (?, ?, ?)", zip(rows.tolist(), neighbours.tolist(), distances.tolist()))
+        store.commit()
+        edge_count += len(rows)
+
+    return edge_count
+
+
+def get_neighbour_graph_tree_ids() -> np.ndarray:
+    return np.array([x[0] for x in get_store().execute("SELECT tree_id FROM neighbour_graph_trees ORDER BY row")], dtype=object)
+
+
+def get_neighbour_graph_pairs(min_distance: float = 0, max_distance: Optional[float] = None, below_min_distance: bool = False) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    '''
+    Each pair once (row < neighbour, ordered by row and neighbour like _neighbour_graph.get_neighbour_pairs):
+    min_distance <= distance <= max_distance, resp. distance < min_distance (below_min_distance)
+    '''
+    if below_min_distance is True:
+        condition, parameters = "distance < ?", [min_distance]
+    elif max_distance is None:
+        condition, parameters = "distance >= ?", [min_distance]
+    else:
+        condition, parameters = "distance >= ? AND distance <= ?", [min_distance, max_distance]
+
+    cursor = get_store().execute(
+        f"SELECT row, neighbour, distance FROM neighbour_graph WHERE row < neighbour AND {condition} ORDER BY row, neighbour", parameters
+    )
+
+    rows: List[np.ndarray] = []
+    neighbours: List[np.ndarray] = []
+    distances: List[np.ndarray] = []
+    for chunk in _fetch_chunks(cursor, get_chunk_size() * 10):  # three numbers per pair
+        chunk_rows, chunk_neighbours, chunk_distances = zip(*chunk)
+        rows.append(np.array(chunk_rows, dtype=np.int32))
+        neighbours.append(np.array(chunk_neighbours, dtype=np.int32))
+        distances.append(np.array(chunk_distances, dtype=float))
+
+    if len(rows) == 0:
+        return np.array([], dtype=np.int32), np.array([], dtype=np.int32), np.array([], dtype=float)
+    return np.concatenate(rows), np.concatenate(neighbours), np.concatenate(distances)
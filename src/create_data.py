@@ -1,126 +1,93 @@
 '''
-The whole process takes a while (especially the processes under 4. and 6.), 0:52:18.818303 to be precise. 
-Temporary results of each step are stored in /tmp and can be deleted after finishing the whole process chain.
-You might want to take a longer coffee break when processing all at once or apply the script step by step.
+The whole process takes a while (especially the stages neighbours and locate), 0:52:18.818303 to be precise
+when running one stage after another.
+Temporary results of each stage are stored in /tmp and can be deleted after finishing the whole process chain.
+You might want to take a longer coffee break when processing all at once or apply the script stage by stage.
+
+Usage:
+$ python create_data.py  # all stages (same as: python create_data.py all)
+$ python create_data.py all --workers 4  # run independent stages concurrently in up to 4 processes
+$ python create_data.py all --store --memory-limit 2048  # out-of-core mode: on-disk store, chunks within 2 GB (see _store_stages.py)
+$ python create_data.py all --store --raster --engine weighted_vote  # out-of-core mode with the options of locate / predict
+$ python create_data.py <stage>  # i.e. python create_data.py export --reduced-only
+$ python create_data.py export --delta  # additionally write the changes against the previous export
+$ python create_data.py predict --engine vote --compare  # sparse vote instead of DBSCAN, with agreement report
+$ python create_data.py locate --simplified  # dissolved / simplified OSM layers (created with osm/simplify_buffer.py)
+$ python create_data.py locate --raster  # raster lookup of the location types (compiled with _location_raster.py)
+
+Stages (in this order):
+- ingest: create base datasets from original "Baumkataster" csv data
+- merge: merge datasets 2017 / 2020
+- neighbours: process neighbour trees in radius, then clean up pairs of close trees (< 3m)
+- predict: predict genus and/or age resp. age_group by clusters of neighbouring trees
+- locate: get location types and nearest road (street) of each tree
+- combine: combine predictions and locations of each tree
+- export: write compressed, FlatGeobuf, Parquet and SQLite exports to /data/exports
+- aggregate: write aggregate cube for dashboards to /data/exports
+
+See _pipeline.py for the stage graph.
 '''
-
-from datetime import datetime
-import json
-import os
-from typing import Any, Dict, List
-
-from _geo import create_suburb_polygons, find_neighbouring_suburbs
-from _process_dataset_2017 import process_dataset_2017
-from _process_dataset_2020 import process_dataset_2020
-from _merge_datasets import merge_datasets
-from _tree_neighbours import cleanup_close_pairs, process_tree_neighbours
-from _predict_genus_age import predict_genus_age
-from _osm_type import get_suburb_data, get_tree_location_types
-from _export import create_reduced_data, save_compressed_data
-
-
-def _save_tmp_data(file_name: str, data_to_save: List[Any]) -> None:
-    with open(f"../data/tmp/{file_name}", "w") as f:
-        for line in data_to_save:
-            f.write(f"{json.dumps(line, ensure_ascii=False)}\n")
-
-
-def _load_tmp_data() -> Dict[str, List[Dict[str, Any]]]:
-    datasets: Dict[str, List[Dict[str, Any]]] = {"2017": [], "2020": []}
-    for file_name in ["data_2017.jsonln", "data_2020.jsonln"]:
-        with open(f"../data/tmp/{file_name}") as f:
-            file_data = f.read().split("\n")
-        if file_name.find("2017") != -1:
-            datasets["2017"] = file_data
-        else:
-            datasets["2020"] = file_data
-    
-    return datasets
-
-
-def _load_list_tmp_data(file_name: str) -> List[Dict[str, Any]]:
-    with open(f"../data/tmp/{file_name}") as f: 
-        incoming = f.read().split("\n")
-    out: List[Dict[str, Any]] = []
-    for line in incoming:
-        try:
-            out.append(json.loads(line))
-        except:
-            pass
-    return out
-
-
-start_time = datetime.now()  # set timer
-print(f"Start: {start_time}")
-
-# *******
-# 1 - compute some geo data (both calls only take milliseconds)
-# *******
-create_suburb_polygons()
-find_neighbouring_suburbs()  # needed for more efficient tree neighbour processing; keep uncommented until 4. is done
-
-print(f"1. done: {datetime.now()-start_time}")
-
-# *******
-# 2 - create base datasets from original "Baumkataster" csv data
-# *******
-_save_tmp_data("data_2017.jsonln", process_dataset_2017())
-_save_tmp_data("data_2020.jsonln", process_dataset_2020())
-
-print(f"2. done: {datetime.now()-start_time}")
-
-# *******
-# 3 - merge datasets 2017 / 2020
-# *******
-datasets = _load_tmp_data()
-_save_tmp_data("data_merged.jsonln", merge_datasets(datasets))
-
-merged_data = _load_list_tmp_data("data_merged.jsonln")
-
-print(f"3. done: {datetime.now()-start_time}")
-
-# *******
-# 4 - process neighbour trees in radius, then clean up pairs of close trees (< 2m)
-# *******
-close_pairs, all_pairs = process_tree_neighbours(merged_data)  # takes approx. 20 minutes
-_save_tmp_data("neighbours_close_pairs.jsonln", close_pairs)
-_save_tmp_data("neighbours_all_pairs.jsonln", all_pairs)
-
-close_pair_list = _load_list_tmp_data("neighbours_close_pairs.jsonln")  # takes approx. 10-20 secs.
-merged_data = cleanup_close_pairs(merged_data, close_pair_list)
-_save_tmp_data("data_merged_cleanup.jsonln", merged_data)
-
-print(f"4. done: {datetime.now()-start_time}")
-
-# *******
-# 5 - predict genus and/or age resp. age_group by clusters of neighbouring trees
-# *******
-merged_data = _load_list_tmp_data("data_merged_cleanup.jsonln")
-neighbours_pairs = _load_list_tmp_data("neighbours_all_pairs.jsonln")
-
-merged_data_with_predictions = predict_genus_age(merged_data, neighbours_pairs)
-_save_tmp_data("data_merged_with_predictions.jsonln", merged_data_with_predictions)
-
-print(f"5. done: {datetime.now()-start_time}")
-
-# *******
-# 6 - get location types
-# *******
-get_suburb_data()
-merged_data_with_predictions = _load_list_tmp_data("data_merged_with_predictions.jsonln")
-
-merged_data_with_predictions = get_tree_location_types(merged_data_with_predictions)
-_save_tmp_data("data_merged_with_predictions.jsonln", merged_data_with_predictions)
-
-# *******
-# 7 - write compressed exports to /data/exports
-# *******
-save_compressed_data("trees_cologne.jsonln", "../data/tmp/data_merged_with_predictions.jsonln")
-
-merged_data_with_predictions = _load_list_tmp_data("data_merged_with_predictions.jsonln")
-reduced_tree_data = create_reduced_data(merged_data_with_predictions)
-_save_tmp_data("data_merged_with_predictions_reduced.jsonln", reduced_tree_data)
-save_compressed_data("trees_cologne_reduced.jsonln", "../data/tmp/data_merged_with_predictions_reduced.jsonln")
-
-# Finished
-print(f"All done. {datetime.now()-start_time}")
\ No newline at end of file
+import argparse
+
+from _pipeline import run_pipeline
+import _stages
+
+
+COMMANDS = {  # command: (stages, help)
+    "ingest": (["ingest_2017", "ingest_2020"], "create base datasets from original \"Baumkataster\" csv data"),
+    "merge": (["merge"], "merge datasets 2017 / 2020"),
+    "neighbours": (["neighbours"], "process neighbour trees in radius, then clean up pairs of close trees"),
+    "predict": (["predict"], "predict genus and/or age resp. age_group by neighbouring trees"),
+    "locate": (["locate"], "get location types and nearest road (street) of each tree"),
+    "combine": (["combine"], "combine predictions and locations of each tree"),
+    "export": (["export_full", "export_reduced", "export_flatgeobuf", "export_parquet", "export_sqlite"], "write compressed, FlatGeobuf, Parquet and SQLite exports to /data/exports"),
+    "aggregate": (["aggregate"], "write aggregate cube for dashboards to /data/exports"),
+}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Create dataset of trees in Cologne, Germany.")
+    subparsers = parser.add_subparsers(dest="command")
+    all_parser = subparsers.add_parser("all", help="run all stages")
+    all_parser.add_argument("--workers", type=int, default=None, help="max. number of concurrent stages (default: number of CPUs, 1: one after another)")
+    all_parser.add_argument("--store", action="store_true", help="out-of-core mode: tree tables and neighbour graph in an on-disk store, processed in chunks")
+    all_parser.add_argument("--memory-limit", type=int, default=None, help="memory ceiling in MB of the out-of-core mode (default: 2048)")
+    all_parser.add_argument("--engine", choices=["vote", "weighted_vote"], default=None, help="out-of-core mode: (distance weighted) vote (default: vote)")
+    all_parser.add_argument("--simplified", action="store_true", help="out-of-core mode: use the dissolved / simplified OSM layers (see osm/simplify_buffer.py)")
+    all_parser.add_argument("--raster", action="store_true", help="out-of-core mode: look up the location types in the compiled rasters (see _location_raster.py)")
+    for command, (_, command_help) in COMMANDS.items():
+        command_parser = subparsers.add_parser(command, help=command_help)
+        if command == "export":
+            command_parser.add_argument("--reduced-only", action="store_true", help="only create the reduced export")
+            command_parser.add_argument("--delta", action="store_true", help="additionally write the changes against the previous full export")
+        if command == "predict":
+            command_parser.add_argument("--engine", choices=["dbscan", "vote", "weighted_vote"], default="dbscan", help="clusters of neighbouring trees (default) or sparse (distance weighted) vote")
+            command_parser.add_argument("--compare", action="store_true", help="print agreement of vote and DBSCAN predictions")
+        if command == "locate":
+            command_parser.add_argument("--simplified", action="store_true", help="use the dissolved / simplified OSM layers (see osm/simplify_buffer.py)")
+            command_parser.add_argument("--raster", action="store_true", help="look up the location types in the compiled rasters (see _location_raster.py)")
+    args = parser.parse_args()
+
+    if args.command is None:
+        run_pipeline()
+    elif args.command == "all" and args.store is True:
+        from _store_stages import run_store_pipeline
+        from _tree_store import MEMORY_LIMIT_MB, set_memory_limit
+
+        set_memory_limit(args.memory_limit or MEMORY_LIMIT_MB)
+        run_store_pipeline(simplified=args.simplified, raster=args.raster, engine=args.engine or "vote")
+    elif args.command == "all" and (args.engine is not None or args.simplified is True or args.raster is True):
+        parser.error("all: --engine, --simplified and --raster need --store (otherwise run the stages predict / locate with these options)")
+    elif args.command == "all":
+        run_pipeline(workers=args.workers)
+    elif args.command == "export" and args.reduced_only is True:
+        run_pipeline(["export_reduced"], workers=1)
+    elif args.command == "export" and args.delta is True:
+        _stages.export_delta()
+        run_pipeline([x for x in COMMANDS["export"][0] if x != "export_full"])
+    elif args.command == "predict" and (args.engine != "dbscan" or args.compare is True):
+        _stages.predict(engine=args.engine, compare=args.compare)
+    elif args.command == "locate" and (args.simplified is True or args.raster is True):
+        _stages.locate(simplified=args.simplified, raster=args.raster)
+    else:
+        run_pipeline(COMMANDS[args.command][0])
@@ -0,0 +1,223 @@
+'''
+Offline alternative to prepare_osm_data.py: the OSM layers of all suburbs are extracted from a local
+OpenStreetMap PBF file (i.e. the extract of "Regierungsbezirk Köln" from download.geofabrik.de) instead of
+one Overpass request per suburb and category. Same directory layout in /data/geo_data/osm and same features:
+
+1. Relations (only the relations are read): relations with the landuse / leisure tags of the queries in
+   prepare_osm_data.py, their way members are noted
+2. Ways (one pass with node locations): ways with these tags (highway: any value, ways only) and the noted
+   member ways, as elements of the Overpass response ("out geom": bounds, geometry as lat / lon).
+   Only ways within the bounding box of all suburbs are kept (the extract might cover a much larger area),
+   of member ways outside only their bounds (bounds of the relation)
+3. Each element is assigned to the suburbs whose bounding box intersects its bounds (spatial index of the
+   suburb polygons), like the bounding box of the Overpass query. Then the elements of each suburb are clipped
+   by create_geojson_polygon (same as for the Overpass response)
+
+Ways with nodes missing in the PBF file and relation members missing in it are skipped (use an extract with
+complete ways, like the ones of geofabrik).
+
+$ python extract_osm_data.py ../../data/geo_data/koeln-regbez-latest.osm.pbf [--overwrite]
+'''
+import argparse
+import os
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+import osmium
+import shapely
+from shapely import STRtree
+from shapely.geometry import Polygon, box
+
+from prepare_osm_data import (OSM_DATA_OUT_DIR, _load_polygon_data, check_file_exists, create_geojson_polygon,
+                              get_suburb_file_name, save_geojson)
+
+
+# tags of the Overpass queries in prepare_osm_data.py (None: any value)
+OSM_CATEGORY_TAGS: Dict[str, Dict[str, Optional[List[str]]]] = {
+    "green_spaces_agriculture": {"landuse": ["allotments", "farmland", "forest", "meadow", "orchard"]},
+    "green_spaces_leisure": {"leisure": ["park", "playground"], "landuse": ["grass", "recreation_ground", "cemetery"]},
+    "highway": {"highway": None},
+}
+RELATION_CATEGORIES = ["green_spaces_agriculture", "green_spaces_leisure"]  # highway: ways only
+
+
+def _get_categories(tags: Dict[str, str], osm_type: str) -> List[str]:
+    categories: List[str] = []
+    for category, category_tags in OSM_CATEGORY_TAGS.items():
+        if osm_type == "relation" and category not in RELATION_CATEGORIES:
+            continue
+        for key, values in category_tags.items():
+            if key in tags and (values is None or tags[key] in values):
+                categories.append(category)
+                break
+    return categories
+
+
+def _merge_bounds(bounds_list: List[Dict[str, float]]) -> Dict[str, float]:
+    return {
+        "minlat": min(x["minlat"] for x in bounds_list),
+        "minlon": min(x["minlon"] for x in bounds_list),
+        "maxlat": max(x["maxlat"] for x in bounds_list),
+        "maxlon": max(x["maxlon"] for x in bounds_list),
+    }
+
+
+def _intersects_area(bounds: Dict[str, float], area_bounds: Tuple[float, float, float, float]) -> bool:
+    ''' area_bounds: min lng, min lat, max lng, max lat (of all suburbs) '''
+    min_lng, min_lat, max_lng, max_lat = area_bounds
+    return not (
+        bounds["maxlon"] < min_lng or bounds["minlon"] > max_lng or bounds["maxlat"] < min_lat or bounds["minlat"] > max_lat
+    )
+
+
+# **************************
+# read PBF
+# **************************
+class RelationHandler(osmium.SimpleHandler):
+    ''' only relations are read (no callbacks for nodes and ways) '''
+    def __init__(self) -> None:
+        super().__init__()
+        self.relations: List[Dict[str, Any]] = []
+        self.member_way_ids: Set[int] = set()
+
+    def relation(self, r: Any) -> None:
+        tags = {tag.k: tag.v for tag in r.tags}
+        categories = _get_categories(tags, "relation")
+        if len(categories) == 0:
+            return
+
+        members = [{"type": "way", "ref": m.ref, "role": m.role} for m in r.members if m.type == "w"]
+        self.member_way_ids.update(m["ref"] for m in members)
+        self.relations.append({"type": "relation", "id": r.id, "tags": tags, "members": members, "categories": categories})
+
+
+class WayHandler(osmium.SimpleHandler):
+    def __init__(self, member_way_ids: Set[int], area_bounds: Tuple[float, float, float, float]) -> None:
+        super().__init__()
+        self.member_way_ids = member_way_ids
+        self.area_bounds = area_bounds
+        self.ways: List[Dict[str, Any]] = []
+        self.member_way_geometries: Dict[int, List[Dict[str, float]]] = {}  # within area_bounds
+        self.member_way_bounds: Dict[int, Dict[str, float]] = {}
+        self.skipped_way_count = 0
+        self.outside_way_count = 0
+
+    def way(self, w: Any) -> None:
+        tags = {tag.k: tag.v for tag in w.tags}
+        categories = _get_categories(tags, "way")
+        if len(categories) == 0 and w.id not in self.member_way_ids:
+            return
+
+        if len(w.nodes) == 0 or not all(n.location.valid() for n in w.nodes):
+            self.skipped_way_count += 1
+            return
+        lats = [n.lat for n in w.nodes]
+        lngs = [n.lon for n in w.nodes]
+        bounds = {"minlat": min(lats), "minlon": min(lngs), "maxlat": max(lats), "maxlon": max(lngs)}
+
+        if w.id in self.member_way_ids:
+            self.member_way_bounds[w.id] = bounds
+        if _intersects_area(bounds, self.area_bounds) is False:  # can't intersect any suburb
+            self.outside_way_count += 1
+            return
+
+        geometry = [{"lat": lat, "lon": lng} for lat, lng in zip(lats, lngs)]  # key order of Overpass (see get_current_feature)
+        if w.id in self.member_way_ids:
+            self.member_way_geometries[w.id] = geometry
+        if len(categories) > 0:
+            self.ways.append({
+                "type": "way",
+                "id": w.id,
+                "bounds": bounds,
+                "geometry": geometry,
+                "tags": tags,
+                "categories": categories
+            })
+
+
+def read_osm_elements(pbf_file: str, area_bounds: Tuple[float, float, float, float]) -> List[Dict[str, Any]]:
+    '''
+    Elements like in the Overpass response (ways sorted by id, then relations) with their categories,
+    only ways resp. relation members within area_bounds (min lng, min lat, max lng, max lat)
+    '''
+    relation_handler = RelationHandler()
+    relation_handler.apply_file(pbf_file)
+    print(f"relations: {len(relation_handler.relations)} ({len(relation_handler.member_way_ids)} member ways)")
+
+    way_handler = WayHandler(relation_handler.member_way_ids, area_bounds)
+    way_handler.apply_file(pbf_file, locations=True)
+    print(
+        f"ways: {len(way_handler.ways)} (skipped with missing nodes: {way_handler.skipped_way_count}, "
+        f"outside of the suburbs: {way_handler.outside_way_count})"
+    )
+
+    relations: List[Dict[str, Any]] = []
+    for relation in relation_handler.relations:
+        members = [
+            dict(member, geometry=way_handler.member_way_geometries[member["ref"]])
+            for member in relation["members"] if member["ref"] in way_handler.member_way_geometries
+        ]
+        if len(members) == 0:
+            continue
+        relation["bounds"] = _merge_bounds([  # also of the members outside area_bounds (like Overpass)
+            way_handler.member_way_bounds[member["ref"]]
+            for member in relation["members"] if member["ref"] in way_handler.member_way_bounds
+        ])
+        relation["members"] = members
+        relations.append(relation)
+
+    return sorted(way_handler.ways, key=lambda x: x["id"]) + sorted(relations, key=lambda x: x["id"])
+
+
+# **************************
+# assign to suburbs
+# **************************
+def get_suburb_elements(elements: List[Dict[str, Any]], suburb_polygons: List[Polygon]) -> List[Dict[str, List[Dict[str, Any]]]]:
+    '''
+    Elements of each suburb by category (in order of the elements)
+    '''
+    tree = STRtree([box(*polygon.bounds) for polygon in suburb_polygons])
+    suburb_elements: List[Dict[str, List[Dict[str, Any]]]] = [
+        {category: [] for category in OSM_CATEGORY_TAGS} for _ in suburb_polygons
+    ]
+
+    for element in elements:
+        bounds = element["bounds"]
+        element_box = box(bounds["minlon"], bounds["minlat"], bounds["maxlon"], bounds["maxlat"])
+        for i in sorted(tree.query(element_box, predicate="intersects")):
+            for category in element["categories"]:
+                suburb_elements[i][category].append(element)
+
+    return suburb_elements
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Extract the OSM layers of all suburbs from a local PBF file.")
+    parser.add_argument("pbf_file", help="OpenStreetMap PBF extract covering Cologne")
+    parser.add_argument("--overwrite", action="store_true", help="replace existing files (default: skip them)")
+    args = parser.parse_args()
+
+    polygon_geojson_data = _load_polygon_data()
+    print(f"Number of suburbs: {len(polygon_geojson_data)}")
+
+    suburb_polygons = [Polygon(suburb_data["geometry"]["coordinates"][0]) for suburb_data in polygon_geojson_data]
+    elements = read_osm_elements(args.pbf_file, tuple(shapely.total_bounds(suburb_polygons)))
+    suburb_elements = get_suburb_elements(elements, suburb_polygons)
+    del elements
+
+    for dir_name in OSM_CATEGORY_TAGS:
+        os.makedirs(f"{OSM_DATA_OUT_DIR}/{dir_name}", exist_ok=True)
+
+    for i, suburb_data in enumerate(polygon_geojson_data):
+        file_name = get_suburb_file_name(suburb_data)
+        print(i, file_name)
+
+        current_city_area_polygon = suburb_data["geometry"]["coordinates"][0]
+        for dir_name, category_elements in suburb_elements[i].items():
+            if args.overwrite is False and check_file_exists(file_name, dir_name) is True:
+                print(f"   skip {dir_name}")
+                continue
+            try:
+                geojson = create_geojson_polygon({"elements": category_elements}, current_city_area_polygon)
+                save_geojson(file_name, dir_name, geojson)
+            except Exception as e:
+                print(f"   ERROR {dir_name}: {e}")
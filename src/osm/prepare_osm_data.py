@@ -2,8 +2,10 @@ import json
 import os
 from typing import Any, Dict, List, Tuple
 
+import numpy as np
 import requests
-from shapely.geometry import LineString, Polygon
+import shapely
+from shapely.geometry import Polygon
 from slugify import slugify
 
 
@@ -12,6 +14,8 @@ OSM_DATA_OUT_DIR = "../../data/geo_data/osm"
 
 POLYGON_GEOJSON = "../../data/geo_data/cologne_districts_reduced_polygons.geojson"
 
+MIN_POLYGON_INTERSECTION = 0.05  # share of the area of a feature (Polygon) within the suburb polygon
+
 
 # **************************
 #
@@ -124,6 +128,52 @@ def request_osm_highway(min_lng: float, min_lat: float, max_lng: float, max_lat:
 # **************************
 #
 # **************************
+def _get_shapely_geometries(coordinates: List[List[List[float]]], is_polygon: bool) -> np.ndarray:
+    '''
+    LineStrings / Polygons (exterior only) of all coordinate lists in one call
+    '''
+    if len(coordinates) == 0:
+        return np.array([], dtype=object)
+
+    indices = np.repeat(np.arange(len(coordinates)), [len(x) for x in coordinates])
+    flat_coordinates = np.array([pair for x in coordinates for pair in x], dtype=float)
+    if is_polygon is False:
+        return shapely.linestrings(flat_coordinates, indices=indices)
+    return shapely.polygons(shapely.linearrings(flat_coordinates, indices=indices))
+
+
+def get_intersects_area(geometries: List[Dict[str, Any]], current_city_area_polygon: List[List[float]]) -> np.ndarray:
+    '''
+    Clipping stage of create_geojson_polygon: does each (geojson) geometry intersect the suburb polygon?
+    - LineString (i.e. highway): intersects
+    - Polygon: more than MIN_POLYGON_INTERSECTION of its area within the suburb polygon
+    The suburb polygon is prepared once, the geometries of each type are tested in one vectorized call
+    (intersection areas only for the polygons intersecting the suburb polygon).
+    '''
+    area_polygon = Polygon(current_city_area_polygon)
+    shapely.prepare(area_polygon)
+
+    intersects_area = np.zeros(len(geometries), dtype=bool)
+    for geometry_type in ["LineString", "Polygon"]:
+        positions = np.array([i for i, x in enumerate(geometries) if x["type"] == geometry_type], dtype=int)
+        if len(positions) == 0:
+            continue
+
+        if geometry_type == "LineString":
+            lines = _get_shapely_geometries([geometries[i]["coordinates"] for i in positions], is_polygon=False)
+            intersects_area[positions] = shapely.intersects(lines, area_polygon)
+            continue
+
+        polygons = _get_shapely_geometries([geometries[i]["coordinates"][0] for i in positions], is_polygon=True)
+        is_intersecting = shapely.intersects(polygons, area_polygon)
+        polygons = polygons[is_intersecting]
+        with np.errstate(divide="ignore", invalid="ignore"):  # degenerated polygons (area 0) don't intersect
+            perc_intersection = shapely.area(shapely.intersection(polygons, area_polygon)) / shapely.area(polygons)
+        intersects_area[positions[is_intersecting]] = perc_intersection > MIN_POLYGON_INTERSECTION
+
+    return intersects_area
+
+
 def create_geojson_polygon(elements: Dict[str, Any], current_city_area_polygon: List[List[float]]) -> Dict[str, Any]:
     current_geojson = {
         "type": "FeatureCollection",
@@ -196,43 +246,16 @@ def create_geojson_polygon(elements: Dict[str, Any], current_city_area_polygon:
         return iou
     
 
-    def get_precentage_poly_intersection(geometry_1: List[List[float]], geometry_2: List[List[float]]) -> float:
-        poly_1: Polygon = Polygon(geometry_1)
-        poly_2: Polygon = Polygon(geometry_2)
-
-        return poly_1.intersection(poly_2).area/poly_1.area
-
-
-    def get_line_poly_intersection(line_coordinates: List[List[float]], poly_coordinates: List[List[float]]) -> bool:
-        '''
-        https://gis.stackexchange.com/a/82719
-        '''
-        polygon = Polygon(poly_coordinates)
-        line = LineString(line_coordinates)
-
-        return line.intersects(polygon)
-
-
+    # ***
+    # features of the ways and outer way members of relations (in order), then clipped in one stage
+    features: List[Tuple[Dict[str, Any], Dict[str, Any]]] = []
     for element in elements["elements"]:
         osm_type = element["type"]
         if osm_type == "way":
             tmp_properties, tmp_geometry = get_current_feature(element)
+            if tmp_geometry is not None:
+                features.append((tmp_properties, tmp_geometry))
 
-            intersects_area = False
-            if tmp_geometry["type"] == "LineString":
-                intersects_area = get_line_poly_intersection(tmp_geometry["coordinates"], current_city_area_polygon)
-            else:
-                perc_intersection = get_precentage_poly_intersection(tmp_geometry["coordinates"][0], current_city_area_polygon)
-                if perc_intersection > 0.05:
-                    intersects_area = True
-                
-            if intersects_area is True:
-                current_geojson["features"].append({
-                    "type": "Feature",
-                    "properties": tmp_properties,
-                    "geometry": tmp_geometry
-                })
-        
         # **
         # TODO How to handle?
         if osm_type == "relation":
@@ -245,27 +268,27 @@ def create_geojson_polygon(elements: Dict[str, Any], current_city_area_polygon:
                     member["tags"] = element["tags"]
                     member["bounds"] = element["bounds"]
                     member["id"] = member["ref"]
-                    
-                    tmp_properties, tmp_geometry = get_current_feature(member)
 
-                    intersects_area = False
-                    if tmp_geometry["type"] == "LineString":
-                        intersects_area = get_line_poly_intersection(tmp_geometry["coordinates"], current_city_area_polygon)
-                    else:
-                        perc_intersection = get_precentage_poly_intersection(tmp_geometry["coordinates"][0], current_city_area_polygon)
-                        if perc_intersection > 0.05:
-                            intersects_area = True
-                        
-                    if intersects_area is True:
-                        current_geojson["features"].append({
-                            "type": "Feature",
-                            "properties": tmp_properties,
-                            "geometry": tmp_geometry
-                        })
+                    tmp_properties, tmp_geometry = get_current_feature(member)
+                    if tmp_geometry is not None:
+                        features.append((tmp_properties, tmp_geometry))
+
+    intersects_area = get_intersects_area([x[1] for x in features], current_city_area_polygon)
+    for (tmp_properties, tmp_geometry), is_intersecting in zip(features, intersects_area):
+        if is_intersecting:
+            current_geojson["features"].append({
+                "type": "Feature",
+                "properties": tmp_properties,
+                "geometry": tmp_geometry
+            })
 
     return current_geojson
 
 
+def get_suburb_file_name(suburb_data: Dict[str, Any]) -> str:
+    return f'{slugify(suburb_data["properties"]["STADTBEZIRK"], replace_latin=True)}_{slugify(suburb_data["properties"]["NAME"], replace_latin=True)}'
+
+
 def save_geojson(file_name: str, dir_name: str, geojson: Dict[str, Any]) -> None:
     with open(f"{OSM_DATA_OUT_DIR}/{dir_name}/{file_name}.json", "w") as f:
         f.write(json.dumps(geojson, indent=2, ensure_ascii=False))
@@ -281,7 +304,7 @@ if __name__ == "__main__":
     print(f"Number of suburbs: {len(polygon_geojson_data)}")
 
     for i, suburb_data in enumerate(polygon_geojson_data):
-        file_name = f'{slugify(suburb_data["properties"]["STADTBEZIRK"], replace_latin=True)}_{slugify(suburb_data["properties"]["NAME"], replace_latin=True)}'
+        file_name = get_suburb_file_name(suburb_data)
         print(i, file_name)
 
         current_city_area_polygon = suburb_data["geometry"]["coordinates"][0]
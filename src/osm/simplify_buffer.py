@@ -0,0 +1,142 @@
+'''
+Simplified OSM buffer layers in /data/geo_data/osm_buffer_simplified (same structure as /data/geo_data/osm_buffer),
+used for the location types with: python create_data.py locate --simplified
+
+1. Dissolve: overlapping features of the same category (directory), type, name and wikidata_id are merged into
+   one feature (i.e. the ways of one street), stored at the position of the first one (osm_id of the first,
+   all in "osm_ids"). The features are matched in file order (first match wins), hence a feature is only merged
+   if no feature with other properties between the first one and itself overlaps it.
+   Trees within a dissolved feature get the osm_id of its first way: use --no-dissolve to keep the osm_id of each way.
+2. Simplify: Douglas-Peucker (topology preserving) with a tolerance in degrees derived from MAX_ERROR_METER.
+   The simplified rings stay within the tolerance of the original rings, hence the location type of a tree
+   farther than MAX_ERROR_METER from any boundary doesn't change.
+
+Dissolved features might have holes (i.e. within a ring road): geometry coordinates are [exterior, *interiors].
+
+$ python simplify_buffer.py --max-error 1.0 [--no-dissolve]
+'''
+import argparse
+import json
+import os
+from typing import Any, Dict, List, Optional, Tuple
+
+from shapely import STRtree, union_all
+from shapely.geometry import Polygon
+
+
+OSM_DATA_DIR_IN = "../../data/geo_data/osm_buffer"
+OSM_DATA_DIR_OUT = "../../data/geo_data/osm_buffer_simplified"
+
+MAX_ERROR_METER = 1.0
+# upper bound of meter per degree on both axes: 1 degree latitude (111 694 m at the poles),
+# 1 degree longitude is 111 320 m * cos(lat) -> tolerance in degrees never exceeds MAX_ERROR_METER
+MAX_METER_PER_DEGREE = 111694.0
+DISSOLVE_PROPERTIES = ["type", "name", "wikidata_id"]
+
+
+def _get_polygon(osm_feature: Dict[str, Any]) -> Polygon:
+    coordinates = osm_feature["geometry"]["coordinates"]
+    return Polygon(coordinates[0], coordinates[1:])
+
+
+def _get_dissolve_key(osm_feature: Dict[str, Any]) -> Tuple[Any, ...]:
+    return tuple(osm_feature["properties"][x] for x in DISSOLVE_PROPERTIES)
+
+
+def _get_dissolve_groups(polygons: List[Polygon], keys: List[Tuple[Any, ...]]) -> List[List[int]]:
+    '''
+    Indices of the features of each group (groups in order of their first feature)
+    '''
+    tree = STRtree(polygons)
+    groups: List[List[int]] = []
+    group_by_feature: List[int] = []
+
+    for i, polygon in enumerate(polygons):
+        overlapping = sorted(j for j in tree.query(polygon, predicate="intersects") if j < i)
+
+        group_index: Optional[int] = None
+        for j in overlapping:
+            if keys[j] != keys[i]:
+                continue
+            first = groups[group_by_feature[j]][0]
+            if any(keys[h] != keys[i] and h > first for h in overlapping):  # would change the first match
+                continue
+            group_index = group_by_feature[j]
+            break
+
+        if group_index is None:
+            group_index = len(groups)
+            groups.append([])
+        groups[group_index].append(i)
+        group_by_feature.append(group_index)
+
+    return groups
+
+
+def _get_feature(osm_feature: Dict[str, Any], polygon: Polygon, osm_ids: List[int]) -> Dict[str, Any]:
+    min_lng, min_lat, max_lng, max_lat = polygon.bounds
+    return {
+        "type": "Feature",
+        "properties": {
+            **osm_feature["properties"],
+            "osm_ids": osm_ids,
+            "bounding_box": [min_lat, min_lng, max_lat, max_lng],  # lat, lng convention of osm_buffer
+        },
+        "geometry": {
+            "type": "Polygon",
+            "coordinates": [
+                [list(pair) for pair in ring.coords] for ring in [polygon.exterior, *polygon.interiors]
+            ],
+        },
+    }
+
+
+def simplify_features(osm_features: List[Dict[str, Any]], max_error: float = MAX_ERROR_METER, dissolve: bool = True) -> List[Dict[str, Any]]:
+    tolerance = max_error / MAX_METER_PER_DEGREE
+
+    polygons = [_get_polygon(x) for x in osm_features]
+    if dissolve is True:
+        groups = _get_dissolve_groups(polygons, [_get_dissolve_key(x) for x in osm_features])
+    else:
+        groups = [[i] for i in range(len(osm_features))]
+
+    simplified_features: List[Dict[str, Any]] = []
+    for group in groups:
+        first_feature = osm_features[group[0]]
+        osm_ids = [osm_features[i]["properties"]["osm_id"] for i in group]
+
+        dissolved = union_all([polygons[i] for i in group]) if len(group) > 1 else polygons[group[0]]
+        parts = list(dissolved.geoms) if dissolved.geom_type == "MultiPolygon" else [dissolved]  # only touching
+
+        for part in parts:
+            simplified = part.simplify(tolerance, preserve_topology=True)
+            if simplified.geom_type != "Polygon" or simplified.is_empty:
+                simplified = part
+            simplified_features.append(_get_feature(first_feature, simplified, osm_ids))
+
+    return simplified_features
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Dissolve and simplify the OSM buffer layers.")
+    parser.add_argument("--max-error", type=float, default=MAX_ERROR_METER, help="max. deviation of the simplified boundaries in meter")
+    parser.add_argument("--no-dissolve", action="store_true", help="only simplify (keep the osm_id of each way)")
+    args = parser.parse_args()
+
+    for dir_name in ["green_spaces_agriculture", "green_spaces_leisure", "highway"]:
+        os.makedirs(f"{OSM_DATA_DIR_OUT}/{dir_name}", exist_ok=True)
+
+        file_names = os.listdir(f"{OSM_DATA_DIR_IN}/{dir_name}")
+        for file_name in file_names:
+            try:
+                with open(f"{OSM_DATA_DIR_IN}/{dir_name}/{file_name}") as f:
+                    osm_in = json.load(f)
+            except:
+                continue
+
+            feature_count = len(osm_in["features"])
+            osm_in["features"] = simplify_features(osm_in["features"], args.max_error, dissolve=args.no_dissolve is False)
+            print(f"{dir_name}/{file_name}: {feature_count} -> {len(osm_in['features'])} features")
+
+            with open(f"{OSM_DATA_DIR_OUT}/{dir_name}/{file_name}", "w") as f:
+                f.write(json.dumps(osm_in, ensure_ascii=False))
@@ -2,27 +2,39 @@
 Create regression model for year_sprout / prediction based on
 X: genus, bole_radius
 y: year_sprout
+
+Run from /src (same paths as the ingest which imports it):
+$ python predictions/_age_regression.py            # compile the lookup table from the existing model pickles
+$ python predictions/_age_regression.py --train    # retrain the model first
 '''
 
+import argparse
 import json
 import pickle
 from statistics import median, mean
-from typing import Any, Dict, List
+import time
+import tracemalloc
+from typing import Any, Dict, List, Optional, Tuple
 
-import numpy as np
-import pandas as pd
-from sklearn.preprocessing import LabelEncoder, StandardScaler, MinMaxScaler
-from sklearn.ensemble import GradientBoostingRegressor
+# pandas and sklearn are only imported when training / compiling or when falling back to the model,
+# predictions within the range of the lookup table don't need them (nor the pickles)
 
 
+TRAIN_DATA_FILE = "../data/predictions_data/genus_bole_radius_year_planted.json"
 MODEL_DATA_DIR = "../data/predictions_models"
+LOOKUP_TABLE_FILE = "age_regression_lookup.json"
+BOLE_RADIUS_MIN = 1
+BOLE_RADIUS_MAX = 150  # training data is capped at this value
+
 MODEL = None
 LABEL_ENCODER = None
 SCALER = None
+LOOKUP_TABLE: Optional[Dict[str, List[int]]] = None
+MODEL_PREDICTIONS: Dict[Tuple[str, int], Optional[int]] = {}  # outside of the lookup table, None: unknown genus
 
 
 def _load_train_data() -> List[Dict[str, Any]]:
-    with open("../../data/predictions_data/genus_bole_radius_year_planted.json") as f:
+    with open(TRAIN_DATA_FILE) as f:
         train_data_raw = json.load(f)
 
     train_data_list = []
@@ -72,28 +84,124 @@ def _load_train_data() -> List[Dict[str, Any]]:
     return train_data_list
 
 
-def train_model() -> None:
-    df = pd.DataFrame(_load_train_data())
-    
+def _load_weighted_train_data() -> Any:
+    '''
+    Same data as _load_train_data, but 1 row per unique (genus, bole_radius, year_sprout) with the number
+    of trees as "sample_weight" (instead of 1 row per tree).
+    '''
+    import pandas as pd
+
+    with open(TRAIN_DATA_FILE) as f:
+        train_data_raw = json.load(f)
+
+    df = pd.DataFrame(
+        [
+            [genus, bole_radius, year_planted, num]
+            for genus, genus_vals in train_data_raw.items()
+            for bole_radius, year_planted_vals in genus_vals.items()
+            for year_planted, num in year_planted_vals.items()
+        ],
+        columns=["genus", "bole_radius", "year_planted", "sample_weight"]
+    )
+    df["bole_radius"] = df["bole_radius"].astype(int)
+    df["year_planted"] = df["year_planted"].astype(int)
+
+    df = df[(df["year_planted"] >= 1800) & (df["year_planted"] <= 2020) & (df["bole_radius"] <= 150) & (df["sample_weight"] > 0)]
+    df = df.assign(year_sprout=df["year_planted"] - 10)
+
+    return df[["genus", "bole_radius", "year_sprout", "sample_weight"]].reset_index(drop=True)
+
+
+def _fit_model(df: Any, histogram: bool = False) -> Tuple[Any, Any, Any]:
+    '''
+    df: genus, bole_radius, year_sprout (and optional sample_weight)
+    histogram: use HistGradientBoostingRegressor (genus as categorical feature) instead of GradientBoostingRegressor
+    '''
+    from sklearn.preprocessing import LabelEncoder, StandardScaler, MinMaxScaler
+    from sklearn.ensemble import GradientBoostingRegressor, HistGradientBoostingRegressor
+
     label_encoder = LabelEncoder()
     scaler = MinMaxScaler()  #StandardScaler()
-    
-    model = GradientBoostingRegressor(learning_rate=0.01, max_depth=3, min_samples_split=5, n_estimators=500)  
 
     df["encoded_genus"] = label_encoder.fit_transform(df["genus"].astype(str))
     df["bole_radius_scaled"] = scaler.fit_transform(df[["bole_radius"]])
     
     X_train = df[["bole_radius_scaled", "encoded_genus"]].to_numpy()
     y_train = df[["year_sprout"]].to_numpy().ravel()
+    sample_weight = df["sample_weight"].to_numpy() if "sample_weight" in df.columns else None
 
-    model.fit(X_train, y_train)
+    if histogram is True:
+        model = HistGradientBoostingRegressor(
+            learning_rate=0.01, max_depth=3, max_iter=500,
+            categorical_features=[False, len(label_encoder.classes_) <= 255]  # max. number of bins
+        )
+    else:
+        model = GradientBoostingRegressor(learning_rate=0.01, max_depth=3, min_samples_split=5, n_estimators=500)  
+
+    model.fit(X_train, y_train, sample_weight=sample_weight)
+
+    return model, label_encoder, scaler
+
+
+def train_model(weighted: bool = True, histogram: bool = False) -> None:
+    '''
+    weighted: train on 1 row per unique (genus, bole_radius, year_sprout) with sample_weight (instead of 1 row per tree)
+    '''
+    import pandas as pd
+
+    if weighted is True:
+        df = _load_weighted_train_data()
+    else:
+        df = pd.DataFrame(_load_train_data())
+
+    model, label_encoder, scaler = _fit_model(df, histogram)
 
     pickle.dump(label_encoder, open(f"{MODEL_DATA_DIR}/age_regression_label_encoder.pkl", 'wb'))
     pickle.dump(scaler, open(f"{MODEL_DATA_DIR}/age_regression_scaler.pkl", 'wb'))
     pickle.dump(model, open(f"{MODEL_DATA_DIR}/age_regression_model.pkl", 'wb'))
 
 
-def predict_year_sprout(genus: str, bole_radius: int) -> int:
+def compare_training(test_size: float = 0.2, random_state: int = 42) -> None:
+    '''
+    Print training time, peak memory and (tree weighted) mean absolute error on held-out data of
+    - expanded rows (1 row per tree)
+    - weighted rows
+    - weighted rows with histogram-based boosting
+    '''
+    import numpy as np
+
+    df = _load_weighted_train_data()
+    df_test = df.sample(frac=test_size, random_state=random_state)
+    df_train = df.drop(df_test.index)
+    df_train_expanded = df_train.loc[df_train.index.repeat(df_train["sample_weight"])].drop(columns=["sample_weight"])
+
+    print(f"train: {len(df_train_expanded)} trees, {len(df_train)} unique rows / test: {int(df_test['sample_weight'].sum())} trees")
+    print(f"{'':<20} {'time (s)':>10} {'memory (MB)':>12} {'MAE (years)':>12}")
+
+    for name, df_fit, histogram in [
+        ("expanded", df_train_expanded, False),
+        ("weighted", df_train, False),
+        ("weighted histogram", df_train, True),
+    ]:
+        tracemalloc.start()
+        start = time.perf_counter()
+        model, label_encoder, scaler = _fit_model(df_fit.copy(), histogram)
+        duration = time.perf_counter() - start
+        _, peak_memory = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        df_pred = df_test[df_test["genus"].astype(str).isin(label_encoder.classes_)].copy()
+        X_test = np.column_stack([
+            scaler.transform(df_pred[["bole_radius"]]).ravel(),
+            label_encoder.transform(df_pred["genus"].astype(str))
+        ])
+        errors = np.abs(model.predict(X_test) - df_pred["year_sprout"].to_numpy())
+        mae = np.average(errors, weights=df_pred["sample_weight"].to_numpy())
+
+        print(f"{name:<20} {duration:>10.2f} {peak_memory/1024/1024:>12.1f} {mae:>12.2f}")
+
+
+def _load_model() -> None:
     global MODEL
     global LABEL_ENCODER
     global SCALER
@@ -105,21 +213,103 @@ def predict_year_sprout(genus: str, bole_radius: int) -> int:
     if SCALER is None:
         SCALER = pickle.load(open(f"{MODEL_DATA_DIR}/age_regression_scaler.pkl", "rb"))
 
+
+def _predict_with_model(genus_list: List[str], bole_radius_list: List[int]) -> List[int]:
+    import pandas as pd
+
+    _load_model()
     
-    df = pd.DataFrame(data={"genus": [genus], "bole_radius": [bole_radius]})
+    df = pd.DataFrame(data={"genus": genus_list, "bole_radius": bole_radius_list})
     df["encoded_genus"] = LABEL_ENCODER.transform(df["genus"].astype(str))
     df["bole_radius_scaled"] = SCALER.transform(df[["bole_radius"]])
 
     X_pred = df[["bole_radius_scaled", "encoded_genus"]].to_numpy()
     predictions = MODEL.predict(X_pred)
 
-    for i, p in enumerate(predictions):
-        return round(p)
+    return [int(round(p)) for p in predictions]
+
+
+def compile_lookup_table() -> None:
+    '''
+    The prediction space is finite (every known genus x bole_radius in training range): evaluate the model
+    once for all combinations and store the (rounded) results:
+    {"bole_radius_min": 1, "bole_radius_max": 150, "year_sprout": {"Acer": [1999, 1998, ...], ...}}
+    '''
+    _load_model()
+
+    genus_list = [str(genus) for genus in LABEL_ENCODER.classes_]
+    bole_radius_range = list(range(BOLE_RADIUS_MIN, BOLE_RADIUS_MAX+1))
+
+    predictions = _predict_with_model(
+        [genus for genus in genus_list for _ in bole_radius_range],
+        [bole_radius for _ in genus_list for bole_radius in bole_radius_range]
+    )
+
+    lookup_table = {
+        "bole_radius_min": BOLE_RADIUS_MIN,
+        "bole_radius_max": BOLE_RADIUS_MAX,
+        "year_sprout": {
+            genus: predictions[i*len(bole_radius_range):(i+1)*len(bole_radius_range)] for i, genus in enumerate(genus_list)
+        }
+    }
+
+    with open(f"{MODEL_DATA_DIR}/{LOOKUP_TABLE_FILE}", "w") as f:
+        f.write(json.dumps(lookup_table, ensure_ascii=False))
+
+
+def _load_lookup_table() -> None:
+    global LOOKUP_TABLE
+
+    try:
+        with open(f"{MODEL_DATA_DIR}/{LOOKUP_TABLE_FILE}") as f:
+            lookup_table = json.load(f)
+        if lookup_table["bole_radius_min"] != BOLE_RADIUS_MIN or lookup_table["bole_radius_max"] != BOLE_RADIUS_MAX:
+            raise ValueError("lookup table range doesn't match")
+        LOOKUP_TABLE = lookup_table["year_sprout"]
+    except Exception as e:
+        print(f"age regression lookup table not available, use model: {e}")
+        LOOKUP_TABLE = {}
+
+
+def predict_year_sprout(genus: str, bole_radius: int) -> int:
+    if LOOKUP_TABLE is None:
+        _load_lookup_table()
+
+    if BOLE_RADIUS_MIN <= bole_radius <= BOLE_RADIUS_MAX:
+        year_sprout_by_bole_radius = LOOKUP_TABLE.get(genus)
+        if year_sprout_by_bole_radius is not None:
+            return year_sprout_by_bole_radius[bole_radius - BOLE_RADIUS_MIN]
+
+    # ***
+    # outside of table range (or unknown genus): use model, once per combination
+    key = (genus, bole_radius)
+    if key not in MODEL_PREDICTIONS:
+        try:
+            MODEL_PREDICTIONS[key] = _predict_with_model([genus], [bole_radius])[0]
+        except ValueError:  # genus not known by the label encoder
+            MODEL_PREDICTIONS[key] = None
+
+    if MODEL_PREDICTIONS[key] is None:
+        raise ValueError(f"unknown genus: {genus}")
+    return MODEL_PREDICTIONS[key]
 
     
 
 if __name__ == "__main__":
-    train_model()
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--compare", action="store_true", help="only print comparison of training variants")
+    parser.add_argument("--train", action="store_true", help="retrain the model before compiling the lookup table")
+    parser.add_argument("--expanded", action="store_true", help="(--train) train on 1 row per tree instead of weighted rows")
+    parser.add_argument("--histogram", action="store_true", help="(--train) use histogram-based gradient boosting")
+    args = parser.parse_args()
+
+    if args.compare is True:
+        compare_training()
+        exit()
+
+    if args.train is True:
+        train_model(weighted=not args.expanded, histogram=args.histogram)
+    compile_lookup_table()
 
     # tests
     genus = "Robinia" # "Taxus"  # "Robinia" # "Platanus"
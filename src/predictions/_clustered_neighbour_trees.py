@@ -3,15 +3,17 @@ import json
 from typing import Any, Dict, List, Optional,Tuple
 
 import numpy as np
-import matplotlib.pyplot as plt
 import pandas as pd
 
 from sklearn.preprocessing import LabelEncoder, StandardScaler
 from sklearn import metrics
 from sklearn.cluster import DBSCAN
 
+from _partition import get_worker_context, run_partitioned
+
 
 MIN_SAMPLES = 5
+DBSCAN_EPS = 0.3  # on the standardized feature (see _parameter_sweep.py for tuning)
 
 
 def _split_dataframe(df: pd.DataFrame) -> Tuple[pd.DataFrame, pd.DataFrame, pd.DataFrame]:
@@ -99,73 +101,171 @@ def _get_max_cluster_label(cluster_labels: Dict[str, Any]) -> Tuple[Any, int]:
     return max_key, max_count
 
 
-def _make_tree_predictions(df: pd.DataFrame, tree_features_by_id: Dict[str, Any], tree_pairs_by_id: Dict[str, Any], predictions: Dict[str, Optional[Any]], label_encoder: LabelEncoder) -> Dict[str, Optional[Any]]:
-    for row_index, row in df.iterrows():
-        # if row_index == 2:
-        #     break
-
-        current_tree_id = row["id"]
+def _predict_cluster(
+    cluster_data_collection: Dict[str, np.array],
+    neighbour_count: int,
+    label_encoder: LabelEncoder,
+    min_samples: int = MIN_SAMPLES,
+    eps: float = DBSCAN_EPS
+) -> Optional[Dict[str, Any]]:
+    prediction: Optional[Dict[str, Any]] = None
 
-        # ***
-        # no neighbours: nothing to cluster
-        if tree_pairs_by_id.get(current_tree_id) is None:
+    for cluster_data_key, cluster_data in cluster_data_collection.items():
+        if len(cluster_data) < min_samples:
             continue
+        
+        X = StandardScaler().fit_transform(cluster_data)
+        clusters = DBSCAN(eps=eps, min_samples=min_samples).fit(X)
 
-        cluster_data_genus, cluster_data_age_group, cluster_data_year_sprout = _get_cluster(tree_pairs_by_id[current_tree_id], tree_features_by_id)
+        core_samples_mask = np.zeros_like(clusters.labels_, dtype=bool)
+        core_samples_mask[clusters.core_sample_indices_] = True
 
-        cluster_data_collection = {
-            "genus": cluster_data_genus,
-            "age_group": cluster_data_age_group,
-            "year_sprout": cluster_data_year_sprout
+        clusters_labels = clusters.labels_
+
+        # ***
+        # collect and count each cluster label
+        cluster_labels = _count_collect_cluster_labels(clusters_labels, cluster_data, cluster_data_key, label_encoder)
+        
+        # ***
+        # get max label from counted cluster labels
+        max_key, max_count = _get_max_cluster_label(cluster_labels)
+
+        if prediction is None:
+            prediction = {}
+        
+        prediction[cluster_data_key] = {
+            "prediction": cluster_labels[max_key][cluster_data_key],
+            "probability": round(max_count/neighbour_count, 2)
         }
 
-        predictions[current_tree_id]: Optional[Dict[str, Any]] = None
+    return prediction
 
-        for cluster_data_key, cluster_data in cluster_data_collection.items():
-            if len(cluster_data) < MIN_SAMPLES:
-                continue
-            
-            X = StandardScaler().fit_transform(cluster_data)
-            clusters = DBSCAN(eps=0.3, min_samples=MIN_SAMPLES).fit(X)
 
-            core_samples_mask = np.zeros_like(clusters.labels_, dtype=bool)
-            core_samples_mask[clusters.core_sample_indices_] = True
+def _predict_tree(
+    current_tree_id: str,
+    tree_features_by_id: Dict[str, Any],
+    tree_pairs_by_id: Dict[str, Any],
+    label_encoder: LabelEncoder,
+    min_samples: int = MIN_SAMPLES,
+    eps: float = DBSCAN_EPS
+) -> Optional[Dict[str, Any]]:
+    cluster_data_genus, cluster_data_age_group, cluster_data_year_sprout = _get_cluster(tree_pairs_by_id[current_tree_id], tree_features_by_id)
 
-            clusters_labels = clusters.labels_
+    cluster_data_collection = {
+        "genus": cluster_data_genus,
+        "age_group": cluster_data_age_group,
+        "year_sprout": cluster_data_year_sprout
+    }
 
-            # ***
-            # collect and count each cluster label
-            cluster_labels = _count_collect_cluster_labels(clusters_labels, cluster_data, cluster_data_key, label_encoder)
-            
-            # ***
-            # get max label from counted cluster labels
-            max_key, max_count = _get_max_cluster_label(cluster_labels)
+    return _predict_cluster(cluster_data_collection, len(tree_pairs_by_id[current_tree_id].keys()), label_encoder, min_samples, eps)
 
-            if predictions[current_tree_id] is None:
-                predictions[current_tree_id] = {}
-            
-            predictions[current_tree_id][cluster_data_key] = {
-                "prediction": cluster_labels[max_key][cluster_data_key],
-                "probability": round(max_count/len(tree_pairs_by_id[current_tree_id].keys()), 2)
-            }
 
-        # except:
-        #     continue
+def _make_tree_predictions(df: pd.DataFrame, tree_features_by_id: Dict[str, Any], tree_pairs_by_id: Dict[str, Any], predictions: Dict[str, Optional[Any]], label_encoder: LabelEncoder) -> Dict[str, Optional[Any]]:
+    for row_index, row in df.iterrows():
+        current_tree_id = row["id"]
+
+        # ***
+        # no neighbours: nothing to cluster
+        if tree_pairs_by_id.get(current_tree_id) is None:
+            continue
+
+        predictions[current_tree_id] = _predict_tree(current_tree_id, tree_features_by_id, tree_pairs_by_id, label_encoder)
+
     return predictions
 
 
-def train_neighbouring_tree_cluster(df: pd.DataFrame, tree_pairs_by_id: Dict[str, Any]) -> None:
+def get_neighbour_arrays(tree_features_by_id: Dict[str, Any], tree_pairs_by_id: Dict[str, Any]) -> Dict[str, np.ndarray]:
+    '''
+    Neighbours and features as arrays for _partition.run_partitioned(arrays=...), row i: i-th tree of tree_pairs_by_id,
+    its neighbours (rows) indices[indptr[i]:indptr[i+1]] in the order of tree_pairs_by_id (same clusters as _get_cluster),
+    has_features: tree in tree_features_by_id
+    '''
+    tree_ids = list(tree_pairs_by_id.keys())
+    row_by_id = {tree_id: i for i, tree_id in enumerate(tree_ids)}
+
+    indptr = np.zeros(len(tree_ids) + 1, dtype=np.int64)
+    indptr[1:] = np.cumsum([len(current_tree_pairs) for current_tree_pairs in tree_pairs_by_id.values()])
+    indices = np.fromiter(
+        (row_by_id[idx] for current_tree_pairs in tree_pairs_by_id.values() for idx in current_tree_pairs), dtype=np.int64, count=int(indptr[-1])
+    )
+
+    features = [tree_features_by_id.get(tree_id) for tree_id in tree_ids]
+
+    def _feature_values(key: str) -> np.ndarray:
+        return np.array([x[key] if x is not None else np.nan for x in features], dtype=np.float64)
+
+    return {
+        "tree_ids": np.array(tree_ids, dtype=str),
+        "indptr": indptr,
+        "indices": indices,
+        "has_features": np.array([x is not None for x in features], dtype=bool),
+        "encoded_genus": _feature_values("encoded_genus"),
+        "age_group_2020": _feature_values("age_group_2020"),
+        "year_sprout": _feature_values("year_sprout"),
+    }
+
+
+def _predict_partition(tree_rows: List[int]) -> List[Tuple[str, Optional[Dict[str, Any]]]]:
+    '''
+    For _partition.run_partitioned with the arrays of get_neighbour_arrays: (tree id, prediction) of each tree (row)
+    '''
+    context = get_worker_context()
+    arrays = context["arrays"]
+
+    results: List[Tuple[str, Optional[Dict[str, Any]]]] = []
+    for row in tree_rows:
+        neighbours = arrays["indices"][arrays["indptr"][row]:arrays["indptr"][row+1]]
+        neighbours_with_features = neighbours[arrays["has_features"][neighbours]]
+
+        cluster_data_collection = {
+            "genus": arrays["encoded_genus"][neighbours_with_features].reshape(-1, 1),
+            "age_group": arrays["age_group_2020"][neighbours_with_features].reshape(-1, 1),
+            "year_sprout": arrays["year_sprout"][neighbours_with_features].reshape(-1, 1)
+        }
+        results.append((str(arrays["tree_ids"][row]), _predict_cluster(cluster_data_collection, len(neighbours), context["label_encoder"])))
+    
+    return results
+
+
+def encode_tree_features(df: pd.DataFrame) -> Tuple[Dict[str, Any], LabelEncoder, pd.DataFrame, pd.DataFrame]:
+    '''
+    Features of the trees with genus and age (by id), the genus encoder and the trees to predict (no age resp. no features)
+    '''
     label_encoder = LabelEncoder()
     df["encoded_genus"] = label_encoder.fit_transform(df["genus"].astype(str))
     
     df_has_all, df_has_no_age, df_has_none = _split_dataframe(df)
     
-    tree_features_by_id = _get_tree_features_by_id(df_has_all)
+    return _get_tree_features_by_id(df_has_all), label_encoder, df_has_no_age, df_has_none
+
+
+def train_neighbouring_tree_cluster(df: pd.DataFrame, tree_pairs_by_id: Dict[str, Any], suburb_by_id: Optional[Dict[str, str]] = None, workers: Optional[int] = 1) -> None:
+    '''
+    With suburb_by_id (tree id: suburb id), the trees are predicted by suburb in up to <workers> processes.
+    '''
+    tree_features_by_id, label_encoder, df_has_no_age, df_has_none = encode_tree_features(df)
     
     predictions: Dict[str, Optional[Any]] = {}
 
-    predictions = _make_tree_predictions(df_has_none, tree_features_by_id, tree_pairs_by_id, predictions, label_encoder)
-    predictions = _make_tree_predictions(df_has_no_age, tree_features_by_id, tree_pairs_by_id, predictions, label_encoder)
+    if suburb_by_id is None:
+        predictions = _make_tree_predictions(df_has_none, tree_features_by_id, tree_pairs_by_id, predictions, label_encoder)
+        predictions = _make_tree_predictions(df_has_no_age, tree_features_by_id, tree_pairs_by_id, predictions, label_encoder)
+    else:
+        # ***
+        # trees with neighbours (others: nothing to cluster), the workers get the neighbours and features as shared arrays
+        arrays = get_neighbour_arrays(tree_features_by_id, tree_pairs_by_id)
+        graph_tree_ids = list(tree_pairs_by_id.keys())  # rows of the arrays
+        row_by_id = {tree_id: i for i, tree_id in enumerate(graph_tree_ids)}
+        tree_ids = df_has_none["id"].tolist() + df_has_no_age["id"].tolist()
+
+        results = run_partitioned(
+            _predict_partition,
+            [row_by_id[tree_id] for tree_id in tree_ids if tree_id in row_by_id],
+            get_partition_key=lambda row: suburb_by_id.get(graph_tree_ids[row]),
+            context={"label_encoder": label_encoder},
+            workers=workers,
+            arrays=arrays
+        )
+        predictions = dict(results)
     
     return predictions 
-
@@ -0,0 +1,153 @@
+'''
+Alternative prediction engine: (distance weighted) vote of the neighbouring trees as sparse linear algebra.
+
+DBSCAN on one-dimensional categorical data (i.e. the encoded genus) and taking the largest cluster is
+effectively a mode vote over the neighbours. Here the vote is done for all trees at once:
+
+    votes = adjacency (trees x trees) @ one-hot (trees x classes)
+
+for genus, age_group and year_sprout. The prediction is the argmax of each row, the probability the share
+of the votes of all neighbours (like the DBSCAN path: neighbours without features count as well).
+The result has the same structure as train_neighbouring_tree_cluster (by_radius_prediction).
+'''
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+from predictions._clustered_neighbour_trees import MIN_SAMPLES
+
+
+VOTE_KEYS = {  # prediction key: column of the reduced data
+    "genus": "genus",
+    "age_group": "age_group_2020",
+    "year_sprout": "year_sprout",
+}
+
+
+def _get_adjacency(tree_ids: pd.Index, tree_pairs: List[Any], distance_weighted: bool) -> Tuple[sparse.csr_matrix, sparse.csr_matrix]:
+    '''
+    Symmetric adjacency: binary and weighted (1 / distance, if distance_weighted) resp. both binary
+    '''
+    pairs = pd.DataFrame(tree_pairs, columns=["id_1", "id_2", "distance"])
+    rows = tree_ids.get_indexer(pairs["id_1"])
+    columns = tree_ids.get_indexer(pairs["id_2"])
+    distances = pairs["distance"].to_numpy(dtype=float)
+
+    is_known = (rows != -1) & (columns != -1)
+    rows, columns, distances = rows[is_known], columns[is_known], distances[is_known]
+
+    # ***
+    # each pair once (in both directions)
+    first, second = np.minimum(rows, columns), np.maximum(rows, columns)
+    _, unique_indices = np.unique(first.astype(np.int64) * len(tree_ids) + second, return_index=True)
+    rows, columns, distances = first[unique_indices], second[unique_indices], distances[unique_indices]
+
+    all_rows = np.concatenate([rows, columns])
+    all_columns = np.concatenate([columns, rows])
+    shape = (len(tree_ids), len(tree_ids))
+
+    binary = sparse.csr_matrix((np.ones(len(all_rows)), (all_rows, all_columns)), shape=shape)
+    if not distance_weighted:
+        return binary, binary
+
+    weights = 1 / np.maximum(np.concatenate([distances, distances]), 1)  # trees closer than 1m: same weight
+    return binary, sparse.csr_matrix((weights, (all_rows, all_columns)), shape=shape)
+
+
+def _vote(adjacency: sparse.csr_matrix, values: pd.Series, is_labelled: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    ''' winning class and its votes for each tree '''
+    codes, classes = pd.factorize(values[is_labelled])
+    if len(classes) == 0:  # no labelled tree: no votes (each tree predicted as None)
+        return np.full(len(values), None, dtype=object), np.zeros(len(values))
+
+    one_hot = sparse.csr_matrix(
+        (np.ones(len(codes)), (np.flatnonzero(is_labelled), codes)), shape=(len(values), len(classes))
+    )
+
+    votes = (adjacency @ one_hot).tocsr()
+    winners = np.asarray(votes.argmax(axis=1)).ravel()
+    winner_votes = np.asarray(votes.max(axis=1).todense()).ravel()
+
+    return np.asarray(classes, dtype=object)[winners], winner_votes
+
+
+def predict_by_neighbour_vote(df: pd.DataFrame, tree_pairs: List[Any], distance_weighted: bool = False) -> Dict[str, Optional[Any]]:
+    '''
+    df: reduced tree data (id, year_sprout, age_group_2020, genus), tree_pairs: [[tree_id_1, tree_id_2, distance], ...]
+
+    Predicts (like the DBSCAN path) each tree without age_group which has neighbours,
+    None if less than MIN_SAMPLES neighbours have all features.
+    '''
+    df = df.reset_index(drop=True)
+    tree_ids = pd.Index(df["id"])
+    binary, weighted = _get_adjacency(tree_ids, tree_pairs, distance_weighted)
+
+    is_labelled = df[list(VOTE_KEYS.values())].notna().all(axis=1).to_numpy()
+    neighbour_counts = np.asarray(binary.sum(axis=1)).ravel()
+    labelled_counts = binary @ is_labelled.astype(float)
+    vote_totals = np.asarray(weighted.sum(axis=1)).ravel()
+
+    votes: Dict[str, Tuple[np.ndarray, np.ndarray]] = {
+        key: _vote(weighted, df[column], is_labelled) for key, column in VOTE_KEYS.items()
+    }
+
+    predictions: Dict[str, Optional[Any]] = {}
+    for i in np.flatnonzero(df["age_group_2020"].isna().to_numpy() & (neighbour_counts > 0)):
+        if labelled_counts[i] < MIN_SAMPLES:
+            predictions[tree_ids[i]] = None
+            continue
+
+        prediction: Dict[str, Any] = {}
+        for key, (winners, winner_votes) in votes.items():
+            value = winners[i]
+            prediction[key] = {
+                "prediction": str(value) if key == "genus" else int(value),
+                "probability": round(float(winner_votes[i] / vote_totals[i]), 2)
+            }
+        predictions[tree_ids[i]] = prediction
+
+    return predictions
+
+
+def get_agreement_report(vote_predictions: Dict[str, Optional[Any]], dbscan_predictions: Dict[str, Optional[Any]]) -> Dict[str, Any]:
+    '''
+    Per prediction key: share of equal predictions and mean absolute difference of the probabilities
+    of the trees predicted by both engines.
+    '''
+    both = [
+        tree_id for tree_id, prediction in vote_predictions.items()
+        if prediction is not None and dbscan_predictions.get(tree_id) is not None
+    ]
+
+    report: Dict[str, Any] = {
+        "trees_vote": len([x for x in vote_predictions.values() if x is not None]),
+        "trees_dbscan": len([x for x in dbscan_predictions.values() if x is not None]),
+        "trees_both": len(both),
+    }
+
+    for key in VOTE_KEYS.keys():
+        pairs = [
+            (vote_predictions[tree_id][key], dbscan_predictions[tree_id][key])
+            for tree_id in both if dbscan_predictions[tree_id].get(key) is not None
+        ]
+        if len(pairs) == 0:
+            report[key] = None
+            continue
+
+        report[key] = {
+            "agreement": round(sum(1 for x, y in pairs if x["prediction"] == y["prediction"]) / len(pairs), 4),
+            "mean_probability_difference": round(sum(abs(x["probability"] - y["probability"]) for x, y in pairs) / len(pairs), 4)
+        }
+
+    return report
+
+
+def print_agreement_report(report: Dict[str, Any]) -> None:
+    print("----- vote vs. DBSCAN -----")
+    print(f"  predicted trees: vote {report['trees_vote']}, DBSCAN {report['trees_dbscan']}, both {report['trees_both']}")
+    for key in VOTE_KEYS.keys():
+        if report[key] is None:
+            continue
+        print(f"  {key:<12} agreement {report[key]['agreement']:.2%}, mean probability difference {report[key]['mean_probability_difference']:.3f}")
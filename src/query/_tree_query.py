@@ -0,0 +1,177 @@
+'''
+Spatial queries over the final dataset (export file trees_cologne.jsonln.tar.gz).
+
+The export is loaded once into memory: all tree positions (UTM) are put into one STRtree and the
+filterable attributes are kept as numpy arrays. Query coordinates are given as lat/lng (resp. GeoJSON
+[lng, lat] pairs for lines and polygons), distances in meter.
+
+Usage:
+load_tree_data()
+trees = query_radius(50.9413, 6.9583, 100, genus="Platanus", age_group=2)
+page = paginate(trees, offset=0, limit=50)
+'''
+import json
+import tarfile
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+from shapely import STRtree, LineString, Point, Polygon, points
+import utm
+
+
+EXPORT_FILE = "../../data/exports/trees_cologne.jsonln.tar.gz"
+LOCATION_TYPES = ["green_spaces_leisure", "green_spaces_agriculture", "highway", "unknown"]
+
+TREE_RECORDS: List[Dict[str, Any]] = []
+TREE_INDEX: Optional[STRtree] = None
+TREE_COLUMNS: Dict[str, np.ndarray] = {}
+
+
+def load_tree_data(file_path: str = EXPORT_FILE) -> None:
+    global TREE_RECORDS
+    global TREE_INDEX
+    global TREE_COLUMNS
+
+    tree_records: List[Dict[str, Any]] = []
+    with tarfile.open(file_path, "r:gz") as tar:
+        for member in tar.getmembers():
+            if member.isfile() is False:
+                continue
+            for line in tar.extractfile(member):
+                try:
+                    tree_records.append(json.loads(line))
+                except:
+                    continue
+
+    location_types = [tree["tree_location_type"] or {} for tree in tree_records]
+
+    TREE_COLUMNS = {
+        "utm_x": np.array([tree["geo_info"]["utm_x"] for tree in tree_records], dtype=float),
+        "utm_y": np.array([tree["geo_info"]["utm_y"] for tree in tree_records], dtype=float),
+        "genus": np.array([tree["tree_taxonomy"]["genus"] for tree in tree_records], dtype=object),
+        "age_group": np.array([tree["tree_age"]["age_group_2020"] if tree["tree_age"]["age_group_2020"] is not None else -1 for tree in tree_records], dtype=int),
+        "found_in_2017": np.array([tree["found_in_dataset"]["2017"] for tree in tree_records], dtype=bool),
+        "found_in_2020": np.array([tree["found_in_dataset"]["2020"] for tree in tree_records], dtype=bool),
+    }
+    for location_type in LOCATION_TYPES[:-1]:
+        TREE_COLUMNS[location_type] = np.array([location_type in x for x in location_types], dtype=bool)
+    TREE_COLUMNS["unknown"] = np.array([len(x) == 0 for x in location_types], dtype=bool)
+
+    TREE_RECORDS = tree_records
+    TREE_INDEX = STRtree(points(TREE_COLUMNS["utm_x"], TREE_COLUMNS["utm_y"]))
+
+
+# **************************
+#
+# **************************
+def _to_utm(lat: float, lng: float) -> Point:
+    x, y, _, _ = utm.from_latlon(lat, lng, force_zone_number=32, force_zone_letter="U")
+    return Point(x, y)
+
+
+def _to_utm_coordinates(lng_lat_list: List[List[float]]) -> np.ndarray:
+    lng_lat = np.array(lng_lat_list, dtype=float)
+    x, y, _, _ = utm.from_latlon(lng_lat[:, 1], lng_lat[:, 0], force_zone_number=32, force_zone_letter="U")
+    return np.column_stack([x, y])
+
+
+def _filter_indices(
+    indices: np.ndarray,
+    genus: Optional[str] = None,
+    age_group: Optional[int] = None,
+    location_type: Optional[str] = None,
+    found_in_dataset: Optional[Dict[str, bool]] = None
+) -> np.ndarray:
+    mask = np.ones(len(indices), dtype=bool)
+
+    if genus is not None:
+        mask &= TREE_COLUMNS["genus"][indices] == genus
+    if age_group is not None:
+        mask &= TREE_COLUMNS["age_group"][indices] == int(age_group)
+    if location_type is not None:
+        if location_type not in LOCATION_TYPES:
+            raise ValueError(f"unknown location_type: {location_type}")
+        mask &= TREE_COLUMNS[location_type][indices]
+    if found_in_dataset is not None:
+        for year, is_found in found_in_dataset.items():
+            mask &= TREE_COLUMNS[f"found_in_{year}"][indices] == is_found
+
+    return indices[mask]
+
+
+def _sort_by_distance(indices: np.ndarray, center: Point) -> np.ndarray:
+    distances = np.hypot(TREE_COLUMNS["utm_x"][indices] - center.x, TREE_COLUMNS["utm_y"][indices] - center.y)
+    return indices[np.argsort(distances, kind="stable")]
+
+
+def _get_records(indices: np.ndarray) -> List[Dict[str, Any]]:
+    return [TREE_RECORDS[i] for i in indices]
+
+
+# **************************
+# queries
+# filters: genus, age_group, location_type, found_in_dataset (i.e. {"2020": False})
+# **************************
+def query_radius(lat: float, lng: float, radius: float, **filters: Any) -> List[Dict[str, Any]]:
+    ''' trees within radius (meter) around lat/lng, sorted by distance '''
+    center = _to_utm(lat, lng)
+    indices = TREE_INDEX.query(center, predicate="dwithin", distance=radius)
+    indices = _filter_indices(indices, **filters)
+
+    return _get_records(_sort_by_distance(indices, center))
+
+
+def query_bounding_box(min_lat: float, min_lng: float, max_lat: float, max_lng: float, **filters: Any) -> List[Dict[str, Any]]:
+    return query_polygon([
+        [min_lng, min_lat], [max_lng, min_lat], [max_lng, max_lat], [min_lng, max_lat], [min_lng, min_lat]
+    ], **filters)
+
+
+def query_polygon(coordinates: List[List[float]], **filters: Any) -> List[Dict[str, Any]]:
+    ''' trees within polygon (exterior ring as list of [lng, lat] pairs) '''
+    polygon = Polygon(_to_utm_coordinates(coordinates))
+    indices = np.sort(TREE_INDEX.query(polygon, predicate="intersects"))
+    indices = _filter_indices(indices, **filters)
+
+    return _get_records(indices)
+
+
+def query_line(coordinates: List[List[float]], distance: float, **filters: Any) -> List[Dict[str, Any]]:
+    '''
+    trees along a line (i.e. a street as list of [lng, lat] pairs) within distance (meter),
+    sorted by position along the line
+    '''
+    line = LineString(_to_utm_coordinates(coordinates))
+    indices = TREE_INDEX.query(line, predicate="dwithin", distance=distance)
+    indices = _filter_indices(indices, **filters)
+
+    positions = line.project(points(TREE_COLUMNS["utm_x"][indices], TREE_COLUMNS["utm_y"][indices]))
+    return _get_records(indices[np.argsort(positions, kind="stable")])
+
+
+def query_nearest(lat: float, lng: float, k: int = 10, max_distance: float = 5000.0, **filters: Any) -> List[Dict[str, Any]]:
+    '''
+    k nearest trees around lat/lng (matching the filters), sorted by distance.
+    The search radius is doubled until k trees are found or max_distance (meter) is reached.
+    '''
+    center = _to_utm(lat, lng)
+    radius = 50.0
+
+    while True:
+        radius = min(radius, max_distance)
+        indices = TREE_INDEX.query(center, predicate="dwithin", distance=radius)
+        indices = _filter_indices(indices, **filters)
+        if len(indices) >= k or radius >= max_distance:
+            break
+        radius *= 2
+
+    return _get_records(_sort_by_distance(indices, center)[:k])
+
+
+def paginate(tree_records: List[Dict[str, Any]], offset: int = 0, limit: int = 100) -> Dict[str, Any]:
+    return {
+        "total": len(tree_records),
+        "offset": offset,
+        "limit": limit,
+        "results": tree_records[offset:offset+limit]
+    }
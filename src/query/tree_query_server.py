@@ -0,0 +1,143 @@
+'''
+Small local HTTP service for spatial queries over the final dataset (see _tree_query.py).
+
+Start in /src/query:
+$ python tree_query_server.py --port 8080
+
+GET endpoints (coordinates as lat/lng, distances in meter, line/polygon coordinates as "lng,lat;lng,lat;..."):
+/radius?lat=50.9413&lng=6.9583&radius=100
+/bbox?min_lat=50.94&min_lng=6.95&max_lat=50.95&max_lng=6.96
+/polygon?coordinates=6.95,50.94;6.96,50.94;6.96,50.95;6.95,50.94
+/line?coordinates=6.95,50.94;6.96,50.95&distance=15
+/nearest?lat=50.9413&lng=6.9583&k=10
+
+Optional filters: genus, age_group, location_type, found_in_2017, found_in_2020 (true/false)
+Pagination: offset (default 0), limit (default 100, max. 1000)
+Errors as {"error": ...}: 400 invalid / missing parameter (line: at least 2, polygon: at least 3 distinct points,
+k at least 1), 404 unknown endpoint, 500 internal error
+'''
+import argparse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+from typing import Any, Dict, List
+from urllib.parse import parse_qs, urlparse
+
+from shapely.errors import GEOSException
+
+from _tree_query import (
+    EXPORT_FILE, load_tree_data, paginate,
+    query_bounding_box, query_line, query_nearest, query_polygon, query_radius
+)
+
+
+DEFAULT_LIMIT = 100
+MAX_LIMIT = 1000
+
+
+def _parse_coordinates(value: str, min_points: int) -> List[List[float]]:
+    ''' "lng,lat;lng,lat;..." with at least min_points distinct points '''
+    coordinates = [[float(x) for x in pair.split(",")] for pair in value.split(";") if len(pair) > 0]
+    if any(len(pair) != 2 for pair in coordinates):
+        raise ValueError(f"coordinates: expected pairs of lng,lat: {value}")
+    if len({tuple(pair) for pair in coordinates}) < min_points:
+        raise ValueError(f"coordinates: at least {min_points} distinct points needed: {value}")
+    return coordinates
+
+
+def _parse_bool(value: str) -> bool:
+    if value.lower() in ["true", "1"]:
+        return True
+    if value.lower() in ["false", "0"]:
+        return False
+    raise ValueError(f"not a bool value: {value}")
+
+
+def _parse_filters(params: Dict[str, str]) -> Dict[str, Any]:
+    filters: Dict[str, Any] = {}
+    if params.get("genus") is not None:
+        filters["genus"] = params["genus"]
+    if params.get("age_group") is not None:
+        filters["age_group"] = int(params["age_group"])
+    if params.get("location_type") is not None:
+        filters["location_type"] = params["location_type"]
+
+    for year in ["2017", "2020"]:
+        if params.get(f"found_in_{year}") is not None:
+            if filters.get("found_in_dataset") is None:
+                filters["found_in_dataset"] = {}
+            filters["found_in_dataset"][year] = _parse_bool(params[f"found_in_{year}"])
+
+    return filters
+
+
+def _run_query(path: str, params: Dict[str, str]) -> List[Dict[str, Any]]:
+    filters = _parse_filters(params)
+
+    if path == "/radius":
+        return query_radius(float(params["lat"]), float(params["lng"]), float(params["radius"]), **filters)
+    if path == "/bbox":
+        return query_bounding_box(float(params["min_lat"]), float(params["min_lng"]), float(params["max_lat"]), float(params["max_lng"]), **filters)
+    if path == "/polygon":
+        return query_polygon(_parse_coordinates(params["coordinates"], min_points=3), **filters)
+    if path == "/line":
+        return query_line(_parse_coordinates(params["coordinates"], min_points=2), float(params["distance"]), **filters)
+    if path == "/nearest":
+        k = int(params.get("k", 10))
+        if k < 1:
+            raise ValueError(f"k: at least 1: {k}")
+        return query_nearest(float(params["lat"]), float(params["lng"]), k, **filters)
+
+    raise LookupError(path)
+
+
+class TreeQueryHandler(BaseHTTPRequestHandler):
+    def _send_json(self, status: int, data: Dict[str, Any]) -> None:
+        body = json.dumps(data, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self) -> None:
+        url = urlparse(self.path)
+        params = {key: values[0] for key, values in parse_qs(url.query).items()}
+
+        try:
+            offset = max(int(params.get("offset", 0)), 0)
+            limit = min(max(int(params.get("limit", DEFAULT_LIMIT)), 0), MAX_LIMIT)
+            tree_records = _run_query(url.path, params)
+        except LookupError as e:  # also KeyError: missing parameter
+            if url.path not in ["/radius", "/bbox", "/polygon", "/line", "/nearest"]:
+                self._send_json(404, {"error": f"unknown endpoint: {url.path}"})
+            else:
+                self._send_json(400, {"error": f"missing parameter: {e}"})
+            return
+        except ValueError as e:
+            self._send_json(400, {"error": str(e)})
+            return
+        except GEOSException as e:  # invalid geometry (i.e. self-intersecting polygon)
+            self._send_json(400, {"error": f"invalid geometry: {e}"})
+            return
+        except Exception as e:  # never close the connection without response
+            self._send_json(500, {"error": f"internal error: {e}"})
+            return
+
+        self._send_json(200, paginate(tree_records, offset, limit))
+
+    def log_message(self, format: str, *args: Any) -> None:  # keep console quiet
+        pass
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--file", default=EXPORT_FILE)
+    args = parser.parse_args()
+
+    print(f"load {args.file} ...")
+    load_tree_data(args.file)
+
+    print(f"serving on http://{args.host}:{args.port}")
+    ThreadingHTTPServer((args.host, args.port), TreeQueryHandler).serve_forever()